@@ -0,0 +1,296 @@
+"""Headless JSON API for kiosks and the mobile app.
+
+The Streamlit app reruns the whole page for every click; this service
+exposes the same controller operations as small HTTP endpoints instead.
+One process holds one model: its connection pool, query cache and
+complaint writer are shared by all requests.
+
+Handlers are async; the blocking model calls run on worker threads, at
+most ``BYSYKKEL_POOL_SIZE`` at a time so no thread waits for a pooled
+connection. Concurrent writes are serialized by the model's BEGIN
+IMMEDIATE transactions, which are short enough that serializing them here
+as well only added a thread hand-off per request.
+
+With ``BYSYKKEL_REPLICA_STALENESS`` set, reads come from a snapshot copy of
+the database at most that many seconds old (see model/replica.py), so
+heavy report requests can't hold up checkouts.
+
+/metrics is only filled with BYSYKKEL_METRICS=1 (see model/metrics.py).
+
+    pip install fastapi uvicorn
+    BYSYKKEL_DB=bysykkel.db uvicorn api.service:app --port 8000
+
+    POST /checkouts            {"user_id", "bike_id", "station_id"}
+    POST /dropoffs             {"user_id", "bike_id", "station_id"}
+    POST /bikes/{id}/issues    {"issues": [...], "notes"}
+    POST /users                {"user_name", "user_phone", "email", "latitude", "longitude"}
+    GET  /users, /bikes, /bikes/at-stations      one page + "next" cursor
+    GET  /stations, /stations/availability, /trips/active, /search, /stats/..., /metrics
+
+See benchmarks/load_test.py for a load test.
+"""
+import base64
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import anyio
+from anyio.to_thread import run_sync
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from controller.controller import BysykkelController
+from model.model import BysykkelModel
+from model.search import ENTITIES
+
+DB_PATH = os.environ.get("BYSYKKEL_DB", "bysykkel.db")
+POOL_SIZE = int(os.environ.get("BYSYKKEL_POOL_SIZE", 8))
+# Seconds a read may lag behind writes; unset reads the primary database
+REPLICA_STALENESS = os.environ.get("BYSYKKEL_REPLICA_STALENESS")
+MAX_PAGE_SIZE = 500
+
+
+class TripRequest(BaseModel):
+    """Body of a checkout or dropoff"""
+    user_id: int
+    bike_id: int
+    station_id: int
+
+
+class IssueReport(BaseModel):
+    issues: List[str]
+    notes: Optional[str] = None
+
+
+class NewUser(BaseModel):
+    user_name: str
+    user_phone: str
+    email: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
+
+class Service:
+    """The model, controller and thread limiter behind the endpoints"""
+
+    def __init__(self, db_path=DB_PATH, pool_size=POOL_SIZE, replica_staleness=REPLICA_STALENESS):
+        self.model = BysykkelModel(db_path, pool_size=pool_size, replica_staleness=replica_staleness)
+        self.model.migrate()
+        self.controller = BysykkelController(self.model)
+        # Replica reads have their own pool, so twice as many calls can run
+        self.limiter = anyio.CapacityLimiter(pool_size * (2 if replica_staleness is not None else 1))
+
+    async def call(self, func, *args):
+        """Run a blocking model/controller call on a worker thread"""
+        return await run_sync(func, *args, limiter=self.limiter)
+
+    def close(self):
+        self.model.close()
+
+
+def records(df):
+    """DataFrame rows as JSON-ready dicts (NaN becomes null)"""
+    return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+
+def encode_cursor(page, columns):
+    """Opaque cursor for the page after ``page``, or None on the last page"""
+    if page.empty:
+        return None
+    key = [value.item() if hasattr(value, "item") else value for value in page.iloc[-1][columns]]
+    return base64.urlsafe_b64encode(json.dumps(key).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, columns):
+    """Keyset values from a cursor made by ``encode_cursor`` over the same ``columns``"""
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor")
+    # One plain value per sort column, or the query fails (or compares nonsense)
+    if not isinstance(key, list) or len(key) != len(columns) or not all(
+        value is None or (isinstance(value, (str, int, float)) and not isinstance(value, bool)) for value in key
+    ):
+        raise HTTPException(400, "Invalid cursor")
+    # A tuple, so it can be part of the query cache key
+    return tuple(key)
+
+
+# Sort-key columns of the paginated endpoints, used as the keyset cursor
+USER_KEY = ["User_Name", "User_ID"]
+BIKE_KEY = ["Bike_Name", "Bike_ID"]
+BIKE_AT_STATION_KEY = ["Station_Name", "Bike_Name", "Bike_ID"]
+
+
+def page_response(page, limit, columns, total=None):
+    body = {"items": records(page), "next": encode_cursor(page, columns) if len(page) == limit else None}
+    if total is not None:
+        body["total"] = int(total)
+    return body
+
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.service = Service()
+    try:
+        yield
+    finally:
+        app.state.service.close()
+
+
+app = FastAPI(title="Bysykkel API", lifespan=lifespan)
+
+
+def service() -> Service:
+    return app.state.service
+
+
+# Writes
+
+async def trip_write(method, request):
+    """Run a checkout or dropoff: 409 if the rules refuse it, 500 if it failed"""
+    try:
+        success, result = await service().call(
+            method, request.user_id, request.bike_id, request.station_id, True
+        )
+    except Exception:
+        # Already logged by the model; don't leak database details
+        raise HTTPException(500, "Internal error, please try again")
+    if not success:
+        raise HTTPException(409, result)
+    return {"trip_id": result}
+
+
+@app.post("/checkouts", status_code=201)
+async def checkout(request: TripRequest):
+    return await trip_write(service().controller.checkout_bike, request)
+
+
+@app.post("/dropoffs")
+async def dropoff(request: TripRequest):
+    return await trip_write(service().controller.dropoff_bike, request)
+
+
+@app.post("/bikes/{bike_id}/issues", status_code=202)
+async def report_issues(bike_id: int, report: IssueReport):
+    if not report.issues:
+        raise HTTPException(422, "No issues selected")
+    # Queued for the background complaint writer; answers before the commit
+    success, result = await service().call(
+        service().controller.report_bike_issues, bike_id, report.issues, report.notes
+    )
+    if not success:
+        raise HTTPException(500, result)
+    return {"message": result}
+
+
+@app.post("/users", status_code=201)
+async def register_user(user: NewUser):
+    controller = service().controller
+    input_data = user.model_dump()
+    validation = controller.validate_user_input(input_data)
+    if not all(validation.values()):
+        raise HTTPException(422, {"message": "Validation failed", "validation": validation})
+    success, result = await service().call(controller.register_user, input_data, validation)
+    if not success:
+        raise HTTPException(500, result)
+    return {"user_id": result}
+
+
+# Reads
+
+@app.get("/health")
+async def health():
+    model = service().model
+    body = {"status": "ok", "pool": model.pool.stats()}
+    if model.replica is not None:
+        body["replica"] = model.replica.stats()
+    return body
+
+
+@app.get("/users")
+async def users(filter: str = "", after: Optional[str] = None,
+                limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+    model = service().model
+    page = await service().call(model.get_users_page, filter, decode_cursor(after, USER_KEY), limit)
+    total = await service().call(model.count_users, filter)
+    return page_response(page, limit, USER_KEY, total)
+
+
+@app.get("/users/{user_id}/trips")
+async def user_active_trips(user_id: int):
+    return records(await service().call(service().controller.get_active_trips, user_id))
+
+
+@app.get("/users/{user_id}/nearby-stations")
+async def nearby_stations(user_id: int, k: int = Query(3, ge=1, le=50), min_bikes: int = 1):
+    stations = await service().call(service().controller.get_nearby_stations, user_id, k, min_bikes)
+    if stations is None:
+        raise HTTPException(404, "User has no known location")
+    return records(stations)
+
+
+@app.get("/bikes")
+async def bikes(after: Optional[str] = None, limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+    model = service().model
+    page = await service().call(model.get_bikes_page, decode_cursor(after, BIKE_KEY), limit)
+    total = await service().call(model.count_bikes)
+    return page_response(page, limit, BIKE_KEY, total)
+
+
+@app.get("/bikes/at-stations")
+async def bikes_at_stations(station: str = "", bike: str = "", after: Optional[str] = None,
+                            limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+    model = service().model
+    page = await service().call(model.get_bikes_at_stations_page, station, bike,
+                                decode_cursor(after, BIKE_AT_STATION_KEY), limit)
+    total = await service().call(model.count_bikes_at_stations, station, bike)
+    return page_response(page, limit, BIKE_AT_STATION_KEY, total)
+
+
+@app.get("/stations")
+async def stations():
+    return records(await service().call(service().model.get_stations_with_availability))
+
+
+@app.get("/stations/availability")
+async def stations_availability():
+    return records(await service().call(service().controller.get_stations_availability))
+
+
+@app.get("/trips/active")
+async def active_trips():
+    return records(await service().call(service().controller.get_active_trips))
+
+
+@app.get("/search")
+async def search(entity: str, q: str, limit: int = Query(10, ge=1, le=100)):
+    if entity not in ENTITIES:
+        raise HTTPException(422, f"entity must be one of {', '.join(ENTITIES)}")
+    matches = await service().call(service().model.search_names, entity, q, limit)
+    return [{"id": row_id, "name": name} for row_id, name in matches]
+
+
+@app.get("/stats/subscriptions")
+async def subscription_counts():
+    return records(await service().call(service().model.get_subscription_counts))
+
+
+@app.get("/stats/station-trips")
+async def station_trips():
+    return records(await service().call(service().model.get_station_trips_count))
+
+
+@app.get("/stats/hourly")
+async def hourly_trips(station_id: Optional[int] = None):
+    return records(await service().call(service().model.get_hourly_trip_counts, station_id))
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(service().model.metrics_text(),
+                             media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,12 +1,65 @@
+import os
 import streamlit as st
 import pandas as pd
+from model.metrics import MetricsRegistry
 from model.model import BysykkelModel
 from view.view import BysykkelView
 from controller.controller import BysykkelController
 
+# Rows per page in the Users, Bikes and bikes-at-stations tables
+PAGE_SIZE = 50
+
+# BYSYKKEL_DIAGNOSTICS=1 adds the Diagnostics tab (query timings and plans);
+# BYSYKKEL_METRICS_PORT=9115 serves the same metrics at :9115/metrics.
+# Either turns on the instrumentation, which is off otherwise
+SHOW_DIAGNOSTICS = os.environ.get("BYSYKKEL_DIAGNOSTICS", "").strip().lower() in ("1", "true", "yes", "on")
+METRICS_PORT = os.environ.get("BYSYKKEL_METRICS_PORT")
+# BYSYKKEL_ARCHIVE=archive/ answers trip reports from the Parquet trip archive,
+# which the model keeps up to date in the background
+ARCHIVE_PATH = os.environ.get("BYSYKKEL_ARCHIVE")
+# BYSYKKEL_REPLICA_STALENESS=5 serves reads from a snapshot at most 5 s old
+REPLICA_STALENESS = os.environ.get("BYSYKKEL_REPLICA_STALENESS")
+
+@st.cache_resource
+def get_model():
+    """Create one model (and its connection pool) shared by all reruns and sessions"""
+    metrics = None
+    if SHOW_DIAGNOSTICS or METRICS_PORT:
+        metrics = MetricsRegistry(enabled=True, explain=True if SHOW_DIAGNOSTICS else None)
+    model = BysykkelModel(archive_path=ARCHIVE_PATH, replica_staleness=REPLICA_STALENESS, metrics=metrics)
+    model.migrate()
+    if METRICS_PORT and model.metrics.enabled:
+        model.metrics.serve(int(METRICS_PORT))
+    return model
+
+def empty_snapshot():
+    """Empty datasets with the expected columns, used when loading fails"""
+    users = pd.DataFrame(columns=["User_ID", "User_Name", "User_Phone"])
+    bikes_at_stations = pd.DataFrame(columns=["Station_ID", "Station_Name", "Bike_ID", "Bike_Name", "Current_Status"])
+    return {
+        "all_users": users,
+        "users": users,
+        "users_total": 0,
+        "bikes": pd.DataFrame(columns=["Bike_ID", "Bike_Name", "Current_Status"]),
+        "bikes_total": 0,
+        "subscriptions": pd.DataFrame(columns=["Type", "Purchased"]),
+        "station_trips": pd.DataFrame(columns=["Station_ID", "Station_Name", "Number_of_trips"]),
+        "hourly_trips": pd.DataFrame(columns=["Hour", "Trips_Started", "Trips_Ended"]),
+        "available_bikes": bikes_at_stations,
+        "bikes_at_stations": bikes_at_stations,
+        "bikes_at_stations_total": 0,
+        "suggestions": {},
+        "labels": {},
+        "stations": pd.DataFrame(columns=["Station_ID", "Station_Name"]),
+        "active_trips": pd.DataFrame(columns=["Trip_ID", "User_ID", "Bike_ID", "Bike_Name", "Start_Station_ID", "Start_Station_Name", "Start_Time"]),
+        "users_with_active_trips": pd.DataFrame(columns=["User_ID", "User_Name", "User_Phone", "Trip_ID", "Bike_ID", "Bike_Name", "Start_Station_ID", "Start_Station_Name", "Start_Time"]),
+        "stations_with_availability": pd.DataFrame(columns=["Station_ID", "Station_Name", "Latitude", "Longitude", "Max_Parking", "Available_Parking"]),
+        "station_availability": pd.DataFrame(columns=["Station_Name", "Free_Docks_Percent", "Bikes_Percent", "Location"]),
+    }
+
 def main():
     # Initialize components
-    model = BysykkelModel()
+    model = get_model()
     view = BysykkelView()
     controller = BysykkelController(model)
     
@@ -14,7 +67,9 @@ def main():
     view.show_title()
     
     # Create tabs 
-    dashboard_tab, add_user_tab, analysis_tab, checkout_tab, dropoff_tab, mapping_tab = view.show_tabs()
+    tabs = view.show_tabs(SHOW_DIAGNOSTICS)
+    (dashboard_tab, add_user_tab, analysis_tab, checkout_tab, dropoff_tab, mapping_tab, forecast_tab,
+     rebalancing_tab) = tabs[:8]
     
     # Initialize session state for filters if not exist
     if 'user_filter' not in st.session_state:
@@ -28,67 +83,72 @@ def main():
     if 'dropoff_step' not in st.session_state:
         st.session_state.dropoff_step = "select_user"
     
-    # Get common data
+    # Load everything the tabs need once, from one consistent snapshot.
+    # A filter is applied when its Filter button is clicked and then kept
+    # while paging through the results.
+    if st.session_state.get('filter_users_button', False):
+        st.session_state.applied_user_filter = st.session_state.get('user_filter', "")
+        view.reset_pages("users")
+    if st.session_state.get('filter_stations_button', False):
+        st.session_state.applied_station_filter = st.session_state.get('station_filter', "")
+        st.session_state.applied_bike_filter = st.session_state.get('bike_filter', "")
+        view.reset_pages("bikes_at_stations")
+    user_filter = st.session_state.get('applied_user_filter', "")
+    station_filter = st.session_state.get('applied_station_filter', "")
+    bike_filter = st.session_state.get('applied_bike_filter', "")
+    pages = {name: view.page_cursor(name) for name in ("users", "bikes", "bikes_at_stations")}
+
     try:
-        users_data = controller.get_dashboard_data()["users"]
-        stations_data = controller.get_stations()
-        available_bikes = controller.get_analysis_data()["bikes_at_stations"]
-        active_trips = controller.get_active_trips()
+        snapshot = controller.get_snapshot(user_filter, station_filter, bike_filter, pages, PAGE_SIZE)
     except Exception as e:
         st.error(f"Error loading data: {e}")
-        users_data = pd.DataFrame(columns=["User_ID", "User_Name", "User_Phone"])
-        stations_data = pd.DataFrame(columns=["Station_ID", "Station_Name"])
-        available_bikes = pd.DataFrame(columns=["Station_ID", "Station_Name", "Bike_ID", "Bike_Name"])
-        active_trips = pd.DataFrame(columns=["Trip_ID", "User_ID", "Bike_ID", "Bike_Name", "Start_Station_ID", "Start_Station_Name", "Start_Time"])
+        snapshot = empty_snapshot()
+
+    users_data = snapshot["all_users"]
+    stations_data = snapshot["stations"]
+    available_bikes = snapshot["available_bikes"]
+    active_trips = snapshot["active_trips"]
     
     # Process dashboard tab
     try:
-        # Check if the filter button was clicked
-        if st.session_state.get('filter_users_button', False):
-            user_filter = st.session_state.get('user_filter', "")
-            dashboard_data = controller.get_dashboard_data(user_filter)
-        else:
-            dashboard_data = controller.get_dashboard_data()
-        
-        # Show dashboard
         view.show_dashboard(
             dashboard_tab,
-            dashboard_data["users"],
-            dashboard_data["bikes"],
-            dashboard_data["subscriptions"]
+            snapshot["users"],
+            snapshot["bikes"],
+            snapshot["subscriptions"],
+            snapshot["users_total"],
+            snapshot["bikes_total"],
+            PAGE_SIZE,
+            snapshot["suggestions"]
         )
     except Exception as e:
         with dashboard_tab:
             st.error(f"Error loading dashboard data: {e}")
-        dashboard_data = {
-            "users": pd.DataFrame(columns=["User_ID", "User_Name", "User_Phone"]),
-            "bikes": pd.DataFrame(columns=["Bike_Name", "Current_Status"]),
-            "subscriptions": pd.DataFrame(columns=["Type", "Purchased"])
-        }
     
     # Process analysis tab
     try:
-        # Check if the filter button was clicked
-        if st.session_state.get('filter_stations_button', False):
-            station_filter = st.session_state.get('station_filter', "")
-            bike_filter = st.session_state.get('bike_filter', "")
-            analysis_data = controller.get_analysis_data(station_filter, bike_filter)
-        else:
-            analysis_data = controller.get_analysis_data()
-        
-        # Show analysis tab
         view.show_analysis(
             analysis_tab,
-            analysis_data["station_trips"],
-            analysis_data["bikes_at_stations"]
+            snapshot["station_trips"],
+            snapshot["bikes_at_stations"],
+            snapshot["hourly_trips"],
+            snapshot["bikes_at_stations_total"],
+            PAGE_SIZE,
+            snapshot["suggestions"]
         )
     except Exception as e:
         with analysis_tab:
             st.error(f"Error loading analysis data: {e}")
-        analysis_data = {
-            "station_trips": pd.DataFrame(columns=["Station_ID", "Station_Name", "Number_of_trips"]),
-            "bikes_at_stations": pd.DataFrame(columns=["Station_ID", "Station_Name", "Bike_ID", "Bike_Name"])
-        }
+
+    # Trip history report: only run when its button is clicked, then kept
+    # in the session until the next run
+    try:
+        if st.session_state.get('run_trip_report', False):
+            st.session_state.trip_reports = controller.get_trip_reports(*view.trip_report_window())
+        view.show_trip_reports(analysis_tab, st.session_state.get('trip_reports'), stations_data, snapshot["labels"])
+    except Exception as e:
+        with analysis_tab:
+            st.error(f"Error loading trip history: {e}")
     
     # Process user form
     try:
@@ -115,7 +175,11 @@ def main():
     
     # Handle checkout tab
     try:
-        checkout_data = view.show_checkout_tab(checkout_tab, users_data, stations_data, available_bikes)
+        # Suggest stations near the user picked in the checkout tab
+        nearby_stations = controller.get_nearby_stations(st.session_state.get("checkout_user"))
+        checkout_data = view.show_checkout_tab(
+            checkout_tab, users_data, stations_data, available_bikes, snapshot["labels"], nearby_stations
+        )
         
         if checkout_data["checkout_button"] and checkout_data["user_id"] and checkout_data["station_id"] and checkout_data["bike_id"]:
             success, result = controller.checkout_bike(
@@ -138,10 +202,10 @@ def main():
     # Handle dropoff tab with integrated issue reporting
     try: 
         # Get users with active trips instead of all users
-        users_with_active_trips = controller.get_users_with_active_trips()
+        users_with_active_trips = snapshot["users_with_active_trips"]
     
         # Display the dropoff interface with users who have active trips
-        dropoff_data = view.show_dropoff_tab(dropoff_tab, users_with_active_trips, stations_data)
+        dropoff_data = view.show_dropoff_tab(dropoff_tab, users_with_active_trips, stations_data, snapshot["labels"])
     
         # Process dropoff if the button was clicked
         if dropoff_data.get("dropoff_button", False):
@@ -169,7 +233,8 @@ def main():
         
             if success:
                 with dropoff_tab:
-                    st.success("Issues reported successfully!")
+                    # Only queued for the complaint writer, not committed yet
+                    st.success(f"{result}.")
                     # Reset the dropoff flow
                     st.session_state.dropoff_step = "select_user"
                     st.rerun()
@@ -184,19 +249,43 @@ def main():
     
     # Handle mapping tab
     try:
-        # Get stations data
-        stations_data = controller.get_stations_availability()
-        
-        # Check if the trip status toggle has changed
-        if "trip_in_progress" in st.session_state:
-            in_progress = st.session_state.trip_in_progress
-            stations_data = controller.get_stations_availability(in_progress)
-        
-        # Show mapping interface
-        view.show_mapping_tab(mapping_tab, stations_data)
+        # Availability for both trip states comes precomputed in the snapshot
+        view.show_mapping_tab(mapping_tab, snapshot["station_availability"])
     except Exception as e:
         with mapping_tab:
             st.error(f"Error loading mapping data: {e}")
 
+    # Handle forecast tab. The forecast and the rebalancing plan are only
+    # computed when their button is clicked, then kept in the session
+    try:
+        if st.session_state.get("run_forecast", False):
+            st.session_state.forecast = controller.get_demand_forecast(st.session_state.get("forecast_hours", 24))
+        view.show_forecast_tab(forecast_tab, st.session_state.get("forecast"))
+    except Exception as e:
+        with forecast_tab:
+            st.error(f"Error loading forecast: {e}")
+
+    # Handle rebalancing tab
+    try:
+        if st.session_state.get("plan_routes", False):
+            st.session_state.rebalancing_plan = controller.get_rebalancing_plan(
+                st.session_state.get("rebalance_trucks", 3), st.session_state.get("rebalance_capacity", 20),
+                forecast_hours=6 if st.session_state.get("rebalance_forecast") else 0,
+            )
+        view.show_rebalancing_tab(rebalancing_tab, st.session_state.get("rebalancing_plan"))
+    except Exception as e:
+        with rebalancing_tab:
+            st.error(f"Error planning rebalancing: {e}")
+
+    # Handle diagnostics tab, last so it includes this rerun's queries
+    if SHOW_DIAGNOSTICS:
+        diagnostics_tab = tabs[8]
+        try:
+            if view.show_diagnostics_tab(diagnostics_tab, controller.get_diagnostics())["reset"]:
+                controller.reset_diagnostics()
+        except Exception as e:
+            with diagnostics_tab:
+                st.error(f"Error loading diagnostics: {e}")
+
 if __name__ == "__main__":
     main()
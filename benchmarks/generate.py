@@ -0,0 +1,225 @@
+"""Deterministic synthetic Bysykkel database for benchmarks.
+
+The same scale and seed always produce the same database. Entity counts
+follow the number of trips:
+
+    small     10k trips       500 users      20 stations
+    medium    1M trips        50k users     200 stations
+    large     10M trips      500k users    1000 stations
+
+Trips start over one year with morning and afternoon peaks, busy stations
+get more traffic (Zipf-like weights) and the newest trips are still open,
+with their bikes out. Rows are written straight into empty tables; the
+migrations then build the indexes, triggers, search tables and rollups
+exactly as for an imported export.
+
+    python -m benchmarks.generate bench.db --scale medium [--seed 115]
+    python -m benchmarks.generate bench.db --trips 250000
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from bysykkel_database_new import create_tables
+from model.migrations import migrate
+
+SCALES = {
+    "small": 10_000,
+    "medium": 1_000_000,
+    "large": 10_000_000,
+}
+
+FIRST_NAMES = [
+    "Ole", "Kari", "Ola", "Ingrid", "Lars", "Siri", "Bjørn", "Åse", "Ørjan", "Kjersti",
+    "Anders", "Vilde", "Markus", "Madeleine", "Per", "Thomas", "Mari", "Stig", "Endre", "Tor",
+]
+LAST_NAMES = [
+    "Hansen", "Johansen", "Olsen", "Larsen", "Andersen", "Pedersen", "Nilsen", "Kristiansen",
+    "Jensen", "Karlsen", "Sørensen", "Berg", "Haugen", "Hagen", "Jakobsen", "Ødegård",
+]
+BIKE_NAMES = [
+    "Trine", "Ida", "Frida", "Sykkel", "Lyn", "Tordis", "Bris", "Ask", "Embla", "Fjord",
+]
+SUBSCRIPTION_TYPES = ["Day", "Week", "Month", "Year"]
+
+# Relative trip starts per hour of day: quiet nights, commuter peaks
+HOURLY_PROFILE = np.array([
+    1, 1, 1, 1, 1, 2, 5, 12, 16, 9, 6, 6, 7, 7, 7, 9, 14, 15, 10, 7, 5, 4, 3, 2,
+], dtype=float)
+
+# Centre of the generated stations (Bergen)
+CENTRE = (60.3913, 5.3221)
+
+CHUNK_ROWS = 200_000
+
+
+def entity_counts(trips):
+    """Number of users, stations and bikes for a given number of trips"""
+    stations = int(min(1000, max(20, trips // 5000)))
+    return {
+        "trips": trips,
+        "users": max(500, trips // 20),
+        "stations": stations,
+        "bikes": stations * 8,
+    }
+
+
+def _names(rng, first, last, n):
+    """n names like 'Kari Hansen' built from the given parts"""
+    first_names = np.array(first, dtype=object)[rng.integers(0, len(first), n)]
+    last_names = np.array(last, dtype=object)[rng.integers(0, len(last), n)]
+    return (first_names + " " + last_names).tolist()
+
+
+def _timestamps(seconds):
+    """'YYYY-MM-DD HH:MM:SS' strings for seconds since the start of 2023"""
+    values = np.datetime64("2023-01-01T00:00:00") + seconds.astype("timedelta64[s]")
+    return np.char.replace(np.datetime_as_string(values, unit="s"), "T", " ").tolist()
+
+
+def _insert(conn, table, columns, rows):
+    placeholders = ", ".join("?" for _ in columns)
+    conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+
+
+def generate(db_path, trips=SCALES["small"], seed=115, verbose=True):
+    """Create a synthetic database at ``db_path`` (replacing it) and return the counts"""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    counts = entity_counts(trips)
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+
+    def log(message):
+        if verbose:
+            print(f"[{time.perf_counter() - start:7.1f}s] {message}")
+
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = OFF")
+        create_tables(conn)
+
+        # Stations around the centre; the first ones are the busiest
+        n_stations = counts["stations"]
+        station_ids = np.arange(1, n_stations + 1)
+        max_parking = rng.integers(10, 41, n_stations)
+        _insert(conn, "Station",
+                ["Station_ID", "Station_Name", "Latitude", "Longitude", "Max_Parking", "Available_Parking"],
+                zip(station_ids.tolist(),
+                    [f"Stasjon {i}" for i in station_ids.tolist()],
+                    (CENTRE[0] + rng.normal(0, 0.02, n_stations)).round(6).tolist(),
+                    (CENTRE[1] + rng.normal(0, 0.04, n_stations)).round(6).tolist(),
+                    max_parking.tolist(),
+                    max_parking.tolist()))
+        station_weights = 1.0 / np.arange(1, n_stations + 1) ** 0.8
+        station_weights /= station_weights.sum()
+        log(f"{n_stations} stations")
+
+        n_users = counts["users"]
+        user_ids = np.arange(1, n_users + 1)
+        phones = rng.integers(10_000_000, 100_000_000, n_users)
+        with_location = rng.random(n_users) < 0.7
+        lat = np.where(with_location, CENTRE[0] + rng.normal(0, 0.02, n_users), np.nan).round(6)
+        lon = np.where(with_location, CENTRE[1] + rng.normal(0, 0.04, n_users), np.nan).round(6)
+        _insert(conn, "User",
+                ["User_ID", "User_Name", "User_Phone", "Latitude", "Longitude", "Email"],
+                zip(user_ids.tolist(),
+                    _names(rng, FIRST_NAMES, LAST_NAMES, n_users),
+                    phones.astype(str).tolist(),
+                    [None if np.isnan(v) else v for v in lat.tolist()],
+                    [None if np.isnan(v) else v for v in lon.tolist()],
+                    [f"user{i}@example.no" for i in user_ids.tolist()]))
+        log(f"{n_users} users")
+
+        # Most users have one subscription, some a second one
+        sub_users = np.concatenate([user_ids, rng.choice(user_ids, n_users // 4)])
+        sub_start = rng.integers(0, 365 * 86400, len(sub_users))
+        _insert(conn, "Subscription", ["SubscriptionID", "User_ID", "Type", "Start"],
+                zip(range(1, len(sub_users) + 1),
+                    sub_users.tolist(),
+                    np.array(SUBSCRIPTION_TYPES, dtype=object)[
+                        rng.choice(4, len(sub_users), p=[0.4, 0.3, 0.2, 0.1])].tolist(),
+                    _timestamps(sub_start)))
+        log(f"{len(sub_users)} subscriptions")
+
+        # Trips, written in chunks so 10M rows stay within memory
+        n_bikes = counts["bikes"]
+        n_trips = counts["trips"]
+        # The newest trips are still open, each with its own bike and user
+        n_open = min(n_bikes // 10, n_users, n_trips)
+        open_bikes = rng.choice(n_bikes, n_open, replace=False) + 1
+        open_users = rng.choice(user_ids, n_open, replace=False)
+        bike_station = rng.choice(n_stations, n_bikes, p=station_weights) + 1
+        hour_p = HOURLY_PROFILE / HOURLY_PROFILE.sum()
+        first_open = n_trips - n_open + 1
+        for chunk_start in range(1, n_trips + 1, CHUNK_ROWS):
+            ids = np.arange(chunk_start, min(chunk_start + CHUNK_ROWS, n_trips + 1))
+            n = len(ids)
+            # Trip starts increase with the id: day from the id, hour from the profile
+            day = ((ids - 1) * 364 // max(n_trips, 1)).astype(np.int64)
+            seconds = day * 86400 + rng.choice(24, n, p=hour_p) * 3600 + rng.integers(0, 3600, n)
+            duration = (rng.exponential(900, n) + 120).astype(np.int64)
+            users = rng.integers(1, n_users + 1, n)
+            bikes = rng.integers(1, n_bikes + 1, n)
+            starts = rng.choice(n_stations, n, p=station_weights) + 1
+            ends = rng.choice(n_stations, n, p=station_weights) + 1
+
+            is_open = ids >= first_open
+            if is_open.any():
+                bikes[is_open] = open_bikes[ids[is_open] - first_open]
+                users[is_open] = open_users[ids[is_open] - first_open]
+            end_times = _timestamps(seconds + duration)
+            end_station = ends.tolist()
+            for i in np.flatnonzero(is_open).tolist():
+                end_times[i] = None
+                end_station[i] = None
+            _insert(conn, "Trip",
+                    ["Trip_ID", "User_ID", "Bike_ID", "Start_Station_ID", "End_Station_ID", "Start_Time", "End_Time"],
+                    zip(ids.tolist(), users.tolist(), bikes.tolist(), starts.tolist(),
+                        end_station, _timestamps(seconds), end_times))
+            conn.commit()
+            log(f"{ids[-1]} of {n_trips} trips")
+        # Open trips start where their bike was
+        if n_open:
+            open_trip_ids = np.arange(first_open, n_trips + 1)
+            conn.executemany("UPDATE Trip SET Start_Station_ID = ? WHERE Trip_ID = ?",
+                             zip(bike_station[open_bikes - 1].tolist(), open_trip_ids.tolist()))
+
+        status = np.array(["Parked"] * n_bikes, dtype=object)
+        status[rng.random(n_bikes) < 0.02] = "Missing"
+        status[open_bikes - 1] = "Active"
+        _insert(conn, "Bike", ["Bike_ID", "Last_Station", "Bike_Name", "Current_Status"],
+                zip(range(1, n_bikes + 1),
+                    bike_station.tolist(),
+                    [f"{BIKE_NAMES[i % len(BIKE_NAMES)]} {i}" for i in range(1, n_bikes + 1)],
+                    status.tolist()))
+        conn.commit()
+        log(f"{n_bikes} bikes, {n_open} out on open trips")
+
+        # Indexes, triggers, search tables, availability counters, rollups, ANALYZE
+        conn.execute("PRAGMA synchronous = NORMAL")
+        migrate(conn)
+        log("migrations applied")
+    finally:
+        conn.close()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic Bysykkel database")
+    parser.add_argument("db", help="Database file to create (replaced if it exists)")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--trips", type=int, help="Number of trips (overrides --scale)")
+    parser.add_argument("--seed", type=int, default=115)
+    args = parser.parse_args(argv)
+    counts = generate(args.db, args.trips or SCALES[args.scale], args.seed)
+    print(", ".join(f"{count} {name}" for name, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
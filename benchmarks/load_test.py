@@ -0,0 +1,199 @@
+"""Load test for the JSON API (api.service), standard library only.
+
+Each worker thread keeps one HTTP/1.1 connection open and loops over a
+checkout followed by a dropoff at a random station, using its own share of
+the parked bikes and idle users so workers never fight over the same bike.
+With ``--read-ratio`` a share of the requests are dashboard reads instead.
+
+    uvicorn api.service:app --port 8000
+    python -m benchmarks.load_test --url http://127.0.0.1:8000 --workers 16 --duration 20
+
+Prints requests per second, checkout+dropoff cycles per second and
+p50/p95/p99 latency per endpoint. Run it against a copy of the database:
+it creates real trips.
+"""
+import argparse
+import http.client
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlencode, urlsplit
+
+READS = [
+    "/stations/availability",
+    "/users?limit=50",
+    "/bikes/at-stations?limit=50",
+    "/trips/active",
+    "/stats/station-trips",
+]
+
+
+class Client:
+    """One keep-alive connection to the API"""
+
+    def __init__(self, url, timeout=30.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        """Send a request; returns (status, decoded JSON or text)"""
+        payload = None if body is None else json.dumps(body).encode("utf-8")
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=payload, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed the kept-alive connection; reconnect once
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        if response.getheader("Content-Type", "").startswith("application/json"):
+            data = json.loads(data)
+        return response.status, data
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+def _all_pages(client, path, limit=500):
+    items, cursor = [], None
+    while True:
+        query = {"limit": limit}
+        if cursor:
+            query["after"] = cursor
+        status, body = client.request("GET", f"{path}?{urlencode(query)}")
+        if status != 200:
+            raise RuntimeError(f"GET {path} failed with {status}: {body}")
+        items += body["items"]
+        cursor = body["next"]
+        if not cursor:
+            return items
+
+
+def prepare(url, workers):
+    """Split parked bikes and users without an open trip between the workers"""
+    client = Client(url)
+    try:
+        parked = [(row["Bike_ID"], row["Station_ID"]) for row in _all_pages(client, "/bikes/at-stations")]
+        _, active = client.request("GET", "/trips/active")
+        busy_users = {trip["User_ID"] for trip in active}
+        users = [row["User_ID"] for row in _all_pages(client, "/users") if row["User_ID"] not in busy_users]
+        _, stations = client.request("GET", "/stations")
+        station_ids = [row["Station_ID"] for row in stations]
+    finally:
+        client.close()
+    workers = min(workers, len(parked), len(users))
+    if workers == 0:
+        raise RuntimeError("No parked bikes or idle users to test with")
+    shares = [(parked[i::workers], users[i::workers]) for i in range(workers)]
+    return shares, station_ids
+
+
+def run(url, workers=16, duration=10.0, read_ratio=0.0, seed=115):
+    """Run the load and return (latencies by endpoint, status counts, cycles, elapsed)"""
+    shares, station_ids = prepare(url, workers)
+    latencies = defaultdict(list)
+    statuses = Counter()
+    cycles = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(index, bikes, users):
+        rng = random.Random(seed + index)
+        client = Client(url)
+        local = defaultdict(list)
+        local_statuses = Counter()
+        done = 0
+
+        def timed(name, method, path, body=None):
+            start = time.perf_counter()
+            status, data = client.request(method, path, body)
+            local[name].append(time.perf_counter() - start)
+            local_statuses[f"{name} {status}"] += 1
+            return status, data
+
+        position = 0
+        try:
+            while time.perf_counter() < deadline:
+                if read_ratio and rng.random() < read_ratio:
+                    path = rng.choice(READS)
+                    timed("GET " + path.split("?")[0], "GET", path)
+                    continue
+                bike_id, station_id = bikes[position % len(bikes)]
+                user_id = users[position % len(users)]
+                trip = {"user_id": user_id, "bike_id": bike_id, "station_id": station_id}
+                status, _ = timed("POST /checkouts", "POST", "/checkouts", trip)
+                if status == 201:
+                    target = rng.choice(station_ids)
+                    status, _ = timed("POST /dropoffs", "POST", "/dropoffs", dict(trip, station_id=target))
+                    if status == 200:
+                        bikes[position % len(bikes)] = (bike_id, target)
+                        done += 1
+                position += 1
+        finally:
+            client.close()
+            with lock:
+                for name, values in local.items():
+                    latencies[name].extend(values)
+                statuses.update(local_statuses)
+                cycles[0] += done
+
+    threads = [threading.Thread(target=worker, args=(i, bikes, users))
+               for i, (bikes, users) in enumerate(shares)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, cycles[0], time.perf_counter() - start
+
+
+def percentiles(values):
+    """p50, p95, p99 in ms"""
+    if len(values) < 2:
+        value = values[0] * 1000 if values else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return cuts[49] * 1000, cuts[94] * 1000, cuts[98] * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the Bysykkel JSON API")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent connections")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run")
+    parser.add_argument("--read-ratio", type=float, default=0.0, help="Share of requests that are reads")
+    parser.add_argument("--seed", type=int, default=115)
+    args = parser.parse_args(argv)
+
+    latencies, statuses, cycles, elapsed = run(args.url, args.workers, args.duration, args.read_ratio, args.seed)
+    total = sum(len(values) for values in latencies.values())
+    print(f"{total} requests in {elapsed:.1f}s with {args.workers} workers: "
+          f"{total / elapsed:.0f} requests/s, {cycles / elapsed:.0f} checkout+dropoff cycles/s")
+    width = max((len(name) for name in latencies), default=10)
+    print(f"{'endpoint':<{width}}  {'n':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, values in sorted(latencies.items()):
+        p50, p95, p99 = percentiles(values)
+        print(f"{name:<{width}}  {len(values):>7} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f}")
+    failed = {key: count for key, count in statuses.items() if not key.endswith((" 200", " 201"))}
+    if failed:
+        print("Non-success responses: " + ", ".join(f"{key}: {count}" for key, count in sorted(failed.items())))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
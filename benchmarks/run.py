@@ -0,0 +1,382 @@
+"""Time the model and controller against a (synthetic) database.
+
+Every public BysykkelModel and BysykkelController method has a case below;
+methods without one are listed at the end of the report so new code
+doesn't go unmeasured. Reads run with an empty query cache by default
+(the cost of the query itself); ``--warm`` keeps the cache to measure hits.
+Checkout/dropoff throughput is measured with N concurrent workers, each
+cycling its own users and bikes through checkout and dropoff.
+
+Writes change the database, so they run after the reads. Results can be
+saved as a baseline and later runs compared against it:
+
+    python -m benchmarks.generate /tmp/bench.db --scale small
+    python -m benchmarks.run /tmp/bench.db --save-baseline benchmarks/baselines/small.json
+    python -m benchmarks.run /tmp/bench.db --baseline benchmarks/baselines/small.json
+
+A case regresses when its p50 or p95 is more than ``--tolerance`` slower
+than the baseline (and at least ``--min-delta-ms`` in absolute terms, so
+sub-millisecond noise doesn't count). With ``--fail-on-regression`` the
+exit status is 1 if any case regressed.
+"""
+import argparse
+import inspect
+import json
+import platform
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+
+from controller.controller import BysykkelController
+from model.model import BysykkelModel
+
+# Infrastructure methods that are exercised by every case anyway
+NOT_BENCHMARKED = {
+    "get_connection", "reading", "data_version", "close", "migrate", "read_transaction", "fetch_value", "fetch_row",
+    "fetch_rows", "run_write", "execute_write", "cache_stats", "flush_writes",
+    "clear_analysis_filters", "reset_diagnostics",
+    # Needs an archive directory: python -m model.columnar export times it
+    "export_trip_archive",
+}
+
+
+class Sample:
+    """Ids and names picked from the database for the cases to use"""
+
+    def __init__(self, model, seed):
+        rng = random.Random(seed)
+        self.located_user = model.fetch_value(
+            "SELECT User_ID FROM User WHERE Latitude IS NOT NULL ORDER BY User_ID LIMIT 1")
+        names = model.fetch_rows("SELECT User_Name FROM User ORDER BY User_ID LIMIT 1000")
+        self.user_term = rng.choice(names)[0].split()[-1][:5] if names else "Han"
+        self.station = model.fetch_row(
+            "SELECT Station_ID, Station_Name, Latitude, Longitude FROM Station ORDER BY Station_ID LIMIT 1")
+        self.station_term = (self.station[1] if self.station else "Stasjon")[:7]
+        self.bike_term = "Trine"
+        self.bike_id = model.fetch_value("SELECT Bike_ID FROM Bike ORDER BY Bike_ID LIMIT 1")
+        # Keyset cursor of page 2, to time a page that isn't the first
+        self.users_after = _last_key(model.get_users_page("", None, 50), ["User_Name", "User_ID"])
+        self.bikes_after = _last_key(model.get_bikes_page(None, 50), ["Bike_Name", "Bike_ID"])
+
+
+def _last_key(page, columns):
+    if page.empty:
+        return None
+    return tuple(value.item() if hasattr(value, "item") else value for value in page.iloc[-1][columns])
+
+
+def read_cases(model, controller, s):
+    """(name, callable) for every read path"""
+    lat, lon = (s.station[2], s.station[3]) if s.station else (60.39, 5.32)
+    return [
+        ("model.get_users_alphabetical", model.get_users_alphabetical),
+        ("model.get_users_filtered", lambda: model.get_users_filtered(s.user_term)),
+        ("model.search_names", lambda: model.search_names("User", s.user_term)),
+        ("model.search_names[fuzzy]", lambda: model.search_names("User", s.user_term[:3] + "x" + s.user_term[3:] + "sen")),
+        ("model.get_user_labels", model.get_user_labels),
+        ("model.get_station_labels", model.get_station_labels),
+        ("model.get_bike_labels", model.get_bike_labels),
+        ("model.get_bikes_with_status", model.get_bikes_with_status),
+        ("model.get_subscription_counts", model.get_subscription_counts),
+        ("model.get_station_trips_count", model.get_station_trips_count),
+        ("model.get_hourly_trip_counts", model.get_hourly_trip_counts),
+        ("model.get_station_trips_report", model.get_station_trips_report),
+        ("model.get_hourly_demand_report", model.get_hourly_demand_report),
+        ("model.get_demand_forecast", model.get_demand_forecast),
+        ("model.get_rebalancing_plan", model.get_rebalancing_plan),
+        ("model.get_bike_usage", model.get_bike_usage),
+        ("model.get_bikes_at_stations", model.get_bikes_at_stations),
+        ("model.get_filtered_bikes_at_stations",
+         lambda: model.get_filtered_bikes_at_stations(s.station_term, s.bike_term)),
+        ("model.get_users_page", lambda: model.get_users_page("", None, 50)),
+        ("model.get_users_page[page 2]", lambda: model.get_users_page("", s.users_after, 50)),
+        ("model.get_users_page[filtered]", lambda: model.get_users_page(s.user_term, None, 50)),
+        ("model.count_users", model.count_users),
+        ("model.count_users[filtered]", lambda: model.count_users(s.user_term)),
+        ("model.get_bikes_page", lambda: model.get_bikes_page(s.bikes_after, 50)),
+        ("model.count_bikes", model.count_bikes),
+        ("model.get_bikes_at_stations_page", lambda: model.get_bikes_at_stations_page("", "", None, 50)),
+        ("model.count_bikes_at_stations", model.count_bikes_at_stations),
+        ("model.get_all_stations", model.get_all_stations),
+        ("model.get_users_with_active_trips", model.get_users_with_active_trips),
+        ("model.get_active_trips", model.get_active_trips),
+        ("model.get_stations_with_availability", model.get_stations_with_availability),
+        ("model.station_index", model.station_index),
+        ("model.nearest_stations", lambda: model.nearest_stations(lat, lon, 5, 1)),
+        ("model.get_user_location", lambda: model.get_user_location(s.located_user or 1)),
+        ("controller.get_dashboard_data", lambda: controller.get_dashboard_data(s.user_term)),
+        ("controller.get_analysis_data", lambda: controller.get_analysis_data(s.station_term, s.bike_term)),
+        ("controller.get_snapshot", controller.get_snapshot),
+        ("controller.get_snapshot[filtered]",
+         lambda: controller.get_snapshot(s.user_term, s.station_term, s.bike_term)),
+        ("controller.get_label_maps", controller.get_label_maps),
+        ("controller.get_filter_suggestions",
+         lambda: controller.get_filter_suggestions({"users_total": 0, "bikes_at_stations_total": 0},
+                                                   s.user_term + "zz", s.station_term, "")),
+        ("controller.get_stations_availability", controller.get_stations_availability),
+        ("controller.get_trip_reports", controller.get_trip_reports),
+        ("controller.get_demand_forecast", controller.get_demand_forecast),
+        ("controller.get_rebalancing_plan", lambda: controller.get_rebalancing_plan(8, 20, forecast_hours=6)),
+        ("controller.get_nearby_stations", lambda: controller.get_nearby_stations(s.located_user)),
+        ("controller.get_stations", controller.get_stations),
+        ("controller.get_active_trips", controller.get_active_trips),
+        ("controller.get_users_with_active_trips", controller.get_users_with_active_trips),
+        ("model.metrics_text", model.metrics_text),
+        ("controller.get_diagnostics", controller.get_diagnostics),
+        ("controller.validate_user_input", lambda: controller.validate_user_input(
+            {"user_name": "Kari Nordmann", "email": "kari@example.no", "user_phone": "12345678"})),
+    ]
+
+
+def write_cases(model, controller, s):
+    """(name, callable) for single-threaded writes"""
+    user = {"user_name": "Bench Mark", "user_phone": "12345678", "email": "bench@example.no",
+            "latitude": 60.39, "longitude": 5.32}
+    return [
+        ("model.add_user", lambda: model.add_user("Bench Mark", "12345678", "bench@example.no")),
+        ("controller.register_user", lambda: controller.register_user(
+            user, {"name_valid": True, "email_valid": True, "phone_valid": True})),
+        ("model.report_bike_issue[wait]", lambda: model.report_bike_issue(s.bike_id, ["Flat tire"], "bench", wait=True)),
+        ("controller.report_bike_issues", lambda: controller.report_bike_issues(s.bike_id, ["Brakes"], "bench")),
+        ("controller.process_dropoff_and_issues", lambda: controller.process_dropoff_and_issues(
+            {"submit_issues": True, "bike_id": s.bike_id, "selected_issues": ["Chain"]})),
+    ]
+
+
+def maintenance_cases(model):
+    """(name, callable) for slow maintenance paths, timed once"""
+    return [
+        ("model.reconcile_station_availability", model.reconcile_station_availability),
+        ("model.train_demand_forecast[full]", lambda: model.train_demand_forecast(full=True)),
+        ("model.backfill_trip_rollups", model.backfill_trip_rollups),
+    ]
+
+
+def summarize(samples):
+    """p50/p95/p99/mean in ms for a list of durations in seconds"""
+    ms = np.asarray(samples) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {"n": len(ms), "p50": round(float(p50), 3), "p95": round(float(p95), 3),
+            "p99": round(float(p99), 3), "mean": round(float(ms.mean()), 3)}
+
+
+def time_case(model, func, repeat, warm):
+    samples = []
+    if warm:
+        func()
+    for _ in range(repeat):
+        if not warm:
+            model.cache.clear()
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def checkout_dropoff_throughput(model, workers, cycles, seed):
+    """Run checkout+dropoff cycles on ``workers`` threads; returns latency and throughput results"""
+    parked = model.fetch_rows(
+        "SELECT Bike_ID, Last_Station FROM Bike WHERE Current_Status = 'Parked' ORDER BY Bike_ID")
+    idle_users = [row[0] for row in model.fetch_rows(
+        "SELECT User_ID FROM User WHERE User_ID NOT IN (SELECT User_ID FROM Trip WHERE End_Time IS NULL) "
+        "ORDER BY User_ID LIMIT ?", (workers * 4,))]
+    stations = [row[0] for row in model.fetch_rows("SELECT Station_ID FROM Station")]
+    workers = min(workers, len(parked), len(idle_users))
+    if workers == 0:
+        return {}, {}
+
+    checkouts, dropoffs, failures = [], [], []
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        # Each worker owns every workers-th bike and user, so they never collide
+        bikes = parked[index::workers]
+        users = idle_users[index::workers]
+        local_checkouts, local_dropoffs, failed = [], [], 0
+        for cycle in range(cycles):
+            bike_pos = cycle % len(bikes)
+            bike_id, station_id = bikes[bike_pos]
+            user_id = users[cycle % len(users)]
+            start = time.perf_counter()
+            ok, _ = model.create_card_checkout(user_id, bike_id, station_id)
+            local_checkouts.append(time.perf_counter() - start)
+            if not ok:
+                failed += 1
+                continue
+            target = rng.choice(stations)
+            start = time.perf_counter()
+            ok, _ = model.create_card_dropoff(user_id, bike_id, target)
+            local_dropoffs.append(time.perf_counter() - start)
+            if ok:
+                bikes[bike_pos] = (bike_id, target)
+            else:
+                failed += 1
+        with lock:
+            checkouts.extend(local_checkouts)
+            dropoffs.extend(local_dropoffs)
+            failures.append(failed)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    results = {}
+    if checkouts:
+        results[f"model.create_card_checkout[{workers} workers]"] = summarize(checkouts)
+    if dropoffs:
+        results[f"model.create_card_dropoff[{workers} workers]"] = summarize(dropoffs)
+    # Controller wrappers, single-threaded, on one more cycle with a bike
+    # that is parked now (the workers moved the sampled ones)
+    controller = BysykkelController(model)
+    bike_id, station_id = model.fetch_row(
+        "SELECT Bike_ID, Last_Station FROM Bike WHERE Current_Status = 'Parked' ORDER BY Bike_ID LIMIT 1")
+    user_id = idle_users[0]
+    start = time.perf_counter()
+    ok, _ = controller.checkout_bike(user_id, bike_id, station_id)
+    results["controller.checkout_bike"] = summarize([time.perf_counter() - start])
+    if ok:
+        start = time.perf_counter()
+        controller.dropoff_bike(user_id, bike_id, station_id)
+        results["controller.dropoff_bike"] = summarize([time.perf_counter() - start])
+    throughput = {
+        "workers": workers,
+        "cycles_per_second": round(len(dropoffs) / elapsed, 1) if elapsed else 0.0,
+        "failures": sum(failures),
+    }
+    return results, throughput
+
+
+def uncovered(names):
+    """Public model/controller methods that no case times"""
+    covered = {name.split("[")[0] for name in names}
+    missing = []
+    for prefix, cls in (("model", BysykkelModel), ("controller", BysykkelController)):
+        for name, _ in inspect.getmembers(cls, inspect.isfunction):
+            if not name.startswith("_") and name not in NOT_BENCHMARKED and f"{prefix}.{name}" not in covered:
+                missing.append(f"{prefix}.{name}")
+    return missing
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """(name, metric, baseline ms, current ms) for every regressed case"""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        for metric in ("p50", "p95"):
+            before, after = previous[metric], current[metric]
+            if after > before * (1 + tolerance) and after - before >= min_delta_ms:
+                regressions.append((name, metric, before, after))
+    return regressions
+
+
+def print_report(results, baseline=None):
+    width = max(len(name) for name in results)
+    print(f"{'case':<{width}}  {'n':>4} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}" +
+          ("  p50 vs baseline" if baseline else ""))
+    for name, r in results.items():
+        line = f"{name:<{width}}  {r['n']:>4} {r['p50']:>10.3f} {r['p95']:>10.3f} {r['p99']:>10.3f}"
+        previous = (baseline or {}).get("results", {}).get(name)
+        if previous and previous["p50"] > 0:
+            line += f"  {r['p50'] / previous['p50']:>6.2f}x"
+        print(line)
+
+
+def run(db_path, repeat=20, workers=8, cycles=50, warm=False, maintenance=False, seed=115):
+    """Run all cases and return the results document (as saved for baselines)"""
+    model = BysykkelModel(db_path, pool_size=max(5, workers + 1))
+    controller = BysykkelController(model)
+    try:
+        model.migrate()
+        sample = Sample(model, seed)
+        results = {}
+        for name, func in read_cases(model, controller, sample):
+            results[name] = time_case(model, func, repeat, warm)
+        for name, func in write_cases(model, controller, sample):
+            results[name] = time_case(model, func, repeat, warm=True)
+        throughput_results, throughput = checkout_dropoff_throughput(model, workers, cycles, seed)
+        results.update(throughput_results)
+        if maintenance:
+            for name, func in maintenance_cases(model):
+                results[name] = time_case(model, func, 1, warm=False)
+        counts = {table: model.fetch_value(f"SELECT COUNT(*) FROM {table}")
+                  for table in ("User", "Station", "Bike", "Trip")}
+    finally:
+        model.close()
+    return {
+        "meta": {
+            "db": db_path,
+            "rows": counts,
+            "repeat": repeat,
+            "warm": warm,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "throughput": throughput,
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Bysykkel model and controller")
+    parser.add_argument("db", help="Database to benchmark (see benchmarks.generate); writes modify it")
+    parser.add_argument("--repeat", type=int, default=20, help="Timed calls per read/write case")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent checkout/dropoff workers")
+    parser.add_argument("--cycles", type=int, default=50, help="Checkout+dropoff cycles per worker")
+    parser.add_argument("--warm", action="store_true", help="Keep the query cache between calls")
+    parser.add_argument("--maintenance", action="store_true", help="Also time reconcile and rollup backfill")
+    parser.add_argument("--baseline", help="Compare against this saved result file")
+    parser.add_argument("--save-baseline", help="Write the results to this file")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed slowdown before a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="Ignore slowdowns smaller than this")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+
+    report = run(args.db, args.repeat, args.workers, args.cycles, args.warm, args.maintenance)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print(f"Rows: {report['meta']['rows']}")
+    print_report(report["results"], baseline)
+    t = report["throughput"]
+    if t:
+        print(f"\nCheckout+dropoff: {t['cycles_per_second']} cycles/s with {t['workers']} workers, "
+              f"{t['failures']} failures")
+    missing = uncovered(report["results"])
+    if missing:
+        print("\nNot benchmarked: " + ", ".join(missing) +
+              ("" if args.maintenance else " (maintenance paths need --maintenance)"))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nSaved baseline to {args.save_baseline}")
+
+    if baseline is not None:
+        regressions = compare(report["results"], baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.baseline}:")
+            for name, metric, before, after in regressions:
+                print(f"  {name} {metric}: {before:.3f} ms -> {after:.3f} ms")
+            if args.fail_on_regression:
+                return 1
+        else:
+            print(f"\nNo regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,299 +1,533 @@
+"""Load the Bysykkel CSV export into the SQLite database.
+
+Usage:
+    python bysykkel_database_new.py [csv_path] [--db bysykkel.db]
+    python bysykkel_database_new.py big.csv --chunksize 200000
+    python bysykkel_database_new.py big.csv --memory-limit-mb 256
+    python bysykkel_database_new.py nightly.csv --incremental
+
+Each entity (stations, bikes, users, subscriptions, trips) is deduplicated
+with vectorized pandas operations and written with executemany in a single
+transaction. The first occurrence of an ID in the file wins, as before.
+
+With --chunksize or --memory-limit-mb the export is streamed in bounded
+chunks instead of being read whole. Each chunk is committed on its own and
+written with INSERT OR IGNORE, so deduplication across chunks is done by
+the primary keys in the database rather than in Python.
+
+With --incremental nothing is deleted. A checkpoint per source file
+(Import_Checkpoint) records the byte offset that has been applied, and the
+next run only reads what was appended after it. Rows are upserted, so a
+trip that shows up again with an end time updates the stored one. Every
+chunk is committed together with its checkpoint, so a crashed import
+resumes where the last commit left off. If the file was truncated or
+rewritten the checkpoint no longer matches and the file is re-applied
+from the start. The trip statistics rollups are updated per chunk for the
+trips it touched, so a sync costs what it imports, not the whole history.
+"""
+import argparse
+import hashlib
+import io
+import os
 import sqlite3
+import time
 import pandas as pd
+from model import availability, columnar, rollups
+from model.migrations import migrate
+
+TABLES = ['User', 'Subscription', 'Station', 'Bike', 'Trip']
+
+SCHEMA = [
+    # User(#User_ID, User_Name, User_Phone, Email, Latitude, Longitude)
+    '''
+    CREATE TABLE IF NOT EXISTS User (
+        User_ID INTEGER PRIMARY KEY,
+        User_Name TEXT,
+        User_Phone TEXT,
+        Latitude REAL,
+        Longitude REAL,
+        Email TEXT
+    )
+    ''',
+    # Station(#Station_ID, Station_Name, Latitude, Longitude, Max_Parking, Available_Parking)
+    # Creating the Station table first since Bike references it
+    '''
+    CREATE TABLE IF NOT EXISTS Station (
+        Station_ID INTEGER PRIMARY KEY,
+        Station_Name TEXT,
+        Latitude REAL,
+        Longitude REAL,
+        Max_Parking INTEGER,
+        Available_Parking INTEGER
+    )
+    ''',
+    # Bike(#Bike_ID, *Last_Station, Bike_Name, Current_Status)
+    '''
+    CREATE TABLE IF NOT EXISTS Bike (
+        Bike_ID INTEGER PRIMARY KEY,
+        Last_Station INTEGER,
+        Bike_Name TEXT,
+        Current_Status TEXT,
+        FOREIGN KEY (Last_Station) REFERENCES Station(Station_ID)
+    )
+    ''',
+    # Subscription(#SubscriptionID, *User_ID, Type, Start)
+    '''
+    CREATE TABLE IF NOT EXISTS Subscription (
+        SubscriptionID INTEGER PRIMARY KEY,
+        User_ID INTEGER,
+        Type TEXT,
+        Start TEXT,
+        FOREIGN KEY (User_ID) REFERENCES User(User_ID)
+    )
+    ''',
+    # Trip(#Trip_ID, *User_ID, *Bike_ID, *End_Station_ID, *Start_Station_ID, Start_Time, End_Time)
+    '''
+    CREATE TABLE IF NOT EXISTS Trip (
+        Trip_ID INTEGER PRIMARY KEY,
+        User_ID INTEGER,
+        Bike_ID INTEGER,
+        Start_Station_ID INTEGER,
+        End_Station_ID INTEGER,
+        Start_Time TEXT,
+        End_Time TEXT,
+        FOREIGN KEY (User_ID) REFERENCES User(User_ID),
+        FOREIGN KEY (Bike_ID) REFERENCES Bike(Bike_ID),
+        FOREIGN KEY (Start_Station_ID) REFERENCES Station(Station_ID),
+        FOREIGN KEY (End_Station_ID) REFERENCES Station(Station_ID)
+    )
+    ''',
+    # Complaint(#Complaint_ID, *Bike_ID, *User_ID, Complaint_Type, Additional_Notes)
+    '''
+    CREATE TABLE IF NOT EXISTS Complaint (
+        Complaint_ID INTEGER PRIMARY KEY,
+        Bike_ID INTEGER,
+        User_ID INTEGER,
+        Complaint_Type TEXT,
+        Additional_Notes TEXT,
+        FOREIGN KEY (Bike_ID) REFERENCES Bike(Bike_ID),
+        FOREIGN KEY (User_ID) REFERENCES User(User_ID)
+    )
+    ''',
+    # Reparation(#Reparation_ID, *Bike_ID, *Complaint_ID, Status)
+    '''
+    CREATE TABLE IF NOT EXISTS Reparation (
+        Reparation_ID INTEGER PRIMARY KEY,
+        Bike_ID INTEGER,
+        Complaint_ID INTEGER,
+        Status TEXT,
+        FOREIGN KEY (Bike_ID) REFERENCES Bike(Bike_ID),
+        FOREIGN KEY (Complaint_ID) REFERENCES Complaint(Complaint_ID)
+    )
+    ''',
+]
+
+ID_COLUMNS = [
+    'user_id', 'subscription_id', 'trip_id', 'start_station_id', 'end_station_id',
+    'bike_id', 'bike_station_id',
+]
+
 
-# Connect to SQLite database (creates it if it doesn't exist)
-conn = sqlite3.connect('bysykkel.db')
-cursor = conn.cursor()
+def create_tables(conn):
+    """Create all tables if they don't exist"""
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
 
-# Enable foreign key constraints
-cursor.execute('PRAGMA foreign_keys = ON')
 
-# Read only the first 25 columns (adjust this number as needed)
-try:
+def _read_csv(csv_path, **kwargs):
+    """pd.read_csv restricted to the columns named in the header"""
     # First read just the header to see how many columns we should have
-    header = pd.read_csv('bysykkel-old.csv', nrows=0).columns
-    num_cols = len(header)
-    
-    # Then read the file using only the valid columns
-    df = pd.read_csv('bysykkel-old.csv', usecols=range(num_cols))
-    print(f"Successfully loaded {len(df)} rows with {num_cols} columns")
-except Exception as e:
-    print(f"Error loading CSV: {e}")
-
-# Create tables
-# User(#User_ID, User_Name, User_Phone, Latitude, Longitude)
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS User (
-    User_ID INTEGER PRIMARY KEY,
-    User_Name TEXT,
-    User_Phone TEXT,
-    Latitude REAL,
-    Longitude REAL
+    header = pd.read_csv(csv_path, nrows=0).columns
+    # Phone numbers are read as text so they don't turn into floats when
+    # some rows (or a whole chunk) have none
+    return pd.read_csv(
+        csv_path,
+        usecols=range(len(header)),
+        dtype={'user_phone_number': 'string'},
+        **kwargs
     )
-''')
-
-# Station(#Station_ID, Station_Name, Latitude, Longitude, Max_Parking, Available_Parking)
-# Creating the Station table first since Bike references it
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS Station (
-    Station_ID INTEGER PRIMARY KEY,
-    Station_Name TEXT,
-    Latitude REAL,
-    Longitude REAL,
-    Max_Parking INTEGER,
-    Available_Parking INTEGER
-    )
-''')
-
-# Bike(#Bike_ID, *Last_Station, Bike_Name, Current_Status)
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS Bike (
-    Bike_ID INTEGER PRIMARY KEY,
-    Last_Station INTEGER,
-    Bike_Name TEXT,
-    Current_Status TEXT,
-    FOREIGN KEY (Last_Station) REFERENCES Station(Station_ID)
+
+
+def read_export(csv_path):
+    """Read the whole CSV export"""
+    return normalize_export(_read_csv(csv_path))
+
+
+def iter_export(csv_path, chunksize):
+    """Yield the CSV export in normalized chunks of at most ``chunksize`` rows"""
+    for chunk in _read_csv(csv_path, chunksize=chunksize):
+        yield normalize_export(chunk)
+
+
+def chunksize_for_memory(csv_path, memory_limit_mb, sample_rows=1000):
+    """Estimate how many rows fit in ``memory_limit_mb`` from a sample of the file"""
+    sample = read_export_sample(csv_path, sample_rows)
+    bytes_per_row = max(sample.memory_usage(deep=True).sum() / max(len(sample), 1), 1)
+    # The chunk, its per-entity extracts and the tuples handed to sqlite all
+    # live at the same time, so leave room for roughly four copies of it
+    return max(int(memory_limit_mb * 1024 * 1024 / (bytes_per_row * 4)), 1)
+
+
+def read_export_sample(csv_path, nrows):
+    """Read the first ``nrows`` rows of the export"""
+    return normalize_export(_read_csv(csv_path, nrows=nrows))
+
+
+def normalize_export(df):
+    """Fix known column quirks and give ID columns a nullable integer type"""
+    # Fix the typo in column name: satart_station_available_spots -> start_station_available_spots
+    df = df.rename(columns={'satart_station_available_spots': 'start_station_available_spots'})
+    for col in ID_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('Int64')
+    return df
+
+
+def _unique(frame, key):
+    """Drop rows without a key and keep the first occurrence of each key"""
+    return frame[frame[key].notna()].drop_duplicates(subset=key, keep='first')
+
+
+def extract_stations(df):
+    """Stations from both trip ends, in file order (start station before end station)"""
+    columns = ['Station_ID', 'Station_Name', 'Latitude', 'Longitude', 'Max_Parking', 'Available_Parking']
+    ends = []
+    for prefix in ('start', 'end'):
+        end = df[[
+            f'{prefix}_station_id', f'{prefix}_station_name',
+            f'{prefix}_station_latitude', f'{prefix}_station_longitude',
+            f'{prefix}_station_max_spots', f'{prefix}_station_available_spots',
+        ]].set_axis(columns, axis=1)
+        ends.append(end)
+    # Interleave start/end per source row so "first occurrence" matches the file order
+    stations = pd.concat(ends, keys=[0, 1], names=['side', 'row']).swaplevel().sort_index()
+    return _unique(stations.reset_index(drop=True), 'Station_ID')
+
+
+def extract_bikes(df):
+    """One row per bike"""
+    bikes = df[['bike_id', 'bike_name', 'bike_status', 'bike_station_id']]
+    bikes = bikes.set_axis(['Bike_ID', 'Bike_Name', 'Current_Status', 'Last_Station'], axis=1)
+    return _unique(bikes, 'Bike_ID')
+
+
+def extract_users(df):
+    """One row per user"""
+    users = df[['user_id', 'user_name', 'user_phone_number']]
+    users = users.set_axis(['User_ID', 'User_Name', 'User_Phone'], axis=1)
+    return _unique(users, 'User_ID')
+
+
+def extract_subscriptions(df):
+    """One row per subscription"""
+    subs = df[['subscription_id', 'subscription_type', 'subscription_start_time', 'user_id']]
+    subs = subs.set_axis(['SubscriptionID', 'Type', 'Start', 'User_ID'], axis=1)
+    return _unique(subs, 'SubscriptionID')
+
+
+def extract_trips(df):
+    """One row per trip"""
+    trips = df[[
+        'trip_id', 'user_id', 'bike_id', 'start_station_id', 'end_station_id',
+        'trip_start_time', 'trip_end_time',
+    ]]
+    trips = trips.set_axis([
+        'Trip_ID', 'User_ID', 'Bike_ID', 'Start_Station_ID', 'End_Station_ID',
+        'Start_Time', 'End_Time',
+    ], axis=1)
+    return _unique(trips, 'Trip_ID')
+
+
+# Tables in foreign key order, with the function that extracts their rows
+ENTITIES = [
+    ('Station', 'stations', extract_stations),
+    ('Bike', 'bikes', extract_bikes),
+    ('User', 'users', extract_users),
+    ('Subscription', 'subscriptions', extract_subscriptions),
+    ('Trip', 'trips', extract_trips),
+]
+
+
+def _records(frame):
+    """Turn a DataFrame into plain Python tuples with None for missing values"""
+    values = frame.astype(object).where(frame.notna(), None)
+    return list(values.itertuples(index=False, name=None))
+
+
+def insert_frame(conn, table, frame, verb='INSERT'):
+    """Insert all rows of a DataFrame with a single executemany"""
+    columns = ', '.join(frame.columns)
+    placeholders = ', '.join('?' for _ in frame.columns)
+    cursor = conn.executemany(
+        f'{verb} INTO {table} ({columns}) VALUES ({placeholders})',
+        _records(frame)
     )
-''')
-
-# Subscription(#SubscriptionID, *User_ID, Type, Status, Start, End)
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS Subscription (
-    SubscriptionID INTEGER PRIMARY KEY,
-    User_ID INTEGER,
-    Type TEXT,
-    Start TEXT,
-    FOREIGN KEY (User_ID) REFERENCES User(User_ID)
-)
-''')
-
-# Trip(#Trip_ID, *User_ID, *Bike_ID, *End_Station_ID, *Start_Station_ID, Start_Time, End_Time)
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS Trip (
-    Trip_ID INTEGER PRIMARY KEY,
-    User_ID INTEGER,
-    Bike_ID INTEGER,
-    Start_Station_ID INTEGER,
-    End_Station_ID INTEGER,
-    Start_Time TEXT,
-    End_Time TEXT,
-    FOREIGN KEY (User_ID) REFERENCES User(User_ID),
-    FOREIGN KEY (Bike_ID) REFERENCES Bike(Bike_ID),
-    FOREIGN KEY (Start_Station_ID) REFERENCES Station(Station_ID),
-    FOREIGN KEY (End_Station_ID) REFERENCES Station(Station_ID)
-)
-''')
-
-# Complaint(#Complaint_ID, *Bike_ID, *User_ID, Complaint_Type)
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS Complaint (
-    Complaint_ID INTEGER PRIMARY KEY,
-    Bike_ID INTEGER,
-    User_ID INTEGER,
-    Complaint_Type TEXT,
-    FOREIGN KEY (Bike_ID) REFERENCES Bike(Bike_ID),
-    FOREIGN KEY (User_ID) REFERENCES User(User_ID)
-)
-''')
-
-# Reparation(#Reparation_ID, *Bike_ID, *Station_ID, Start_Time, End_Time)
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS Reparation (
-    Reparation_ID INTEGER PRIMARY KEY,
-    Bike_ID INTEGER,
-    Complaint_ID INTEGER,
-    Status TEXT,
-    FOREIGN KEY (Bike_ID) REFERENCES Bike(Bike_ID),
-    FOREIGN KEY (Complaint_ID) REFERENCES Complaint(Complaint_ID)
-)
-''')
-
-# === Set up error tracking ===
-success_count = {
-    'users': 0,
-    'subscriptions': 0,
-    'stations': 0,
-    'bikes': 0,
-    'trips': 0
-}
-
-# === First, clear the existing Station table for a clean insert ===
-cursor.execute('DELETE FROM Station')
-print("Cleared existing Station table for clean insert")
-
-# === Insert stations first to ensure foreign key constraints are met ===
-# Create a set to track unique station IDs we've processed
-processed_stations = set()
-
-for _, row in df.iterrows():
-    # Start-station
-    try:
-        # Only process each station ID once
-        if row['start_station_id'] not in processed_stations and pd.notna(row['start_station_id']):
-            # Fix the typo in column name: satart_station_available_spots -> start_station_available_spots
-            available_spots_col = 'start_station_available_spots'
-            if 'satart_station_available_spots' in df.columns:
-                available_spots_col = 'satart_station_available_spots'
-                
-            cursor.execute('''
-                INSERT INTO Station (Station_ID, Station_Name, Latitude, Longitude, Max_Parking, Available_Parking)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                row['start_station_id'], row['start_station_name'],
-                row['start_station_latitude'], row['start_station_longitude'],
-                row['start_station_max_spots'], row[available_spots_col]
-            ))
-            if cursor.rowcount > 0:
-                success_count['stations'] += 1
-                processed_stations.add(row['start_station_id'])
-    except Exception as e:
-        print(f"Error inserting start station {row['start_station_id']}: {e}")
-
-    # End-station
-    try:
-        # Only process each station ID once
-        if row['end_station_id'] not in processed_stations and pd.notna(row['end_station_id']):
-            cursor.execute('''
-                INSERT INTO Station (Station_ID, Station_Name, Latitude, Longitude, Max_Parking, Available_Parking)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                row['end_station_id'], row['end_station_name'],
-                row['end_station_latitude'], row['end_station_longitude'],
-                row['end_station_max_spots'], row['end_station_available_spots']
-            ))
-            if cursor.rowcount > 0:
-                success_count['stations'] += 1
-                processed_stations.add(row['end_station_id'])
-    except Exception as e:
-        print(f"Error inserting end station {row['end_station_id']}: {e}")
-
-# Commit stations now to ensure they're available for bike foreign keys
-conn.commit()
-print(f"Inserted {success_count['stations']} unique stations")
-
-# === Clear existing data for clean re-insert ===
-cursor.execute('DELETE FROM Bike')
-print("Cleared existing Bike table for clean insert")
-
-# === Insert bikes ===
-processed_bikes = set()  # Track which bikes we've processed
-
-for _, row in df.iterrows():
-    try:
-        # Only try to insert each unique bike once
-        if row['bike_id'] not in processed_bikes and pd.notna(row['bike_id']):
-            bike_id = row['bike_id']
-            bike_name = row['bike_name'] if pd.notna(row['bike_name']) else None
-            bike_status = row['bike_status'] if pd.notna(row['bike_status']) else None
-            bike_station_id = row['bike_station_id'] if pd.notna(row['bike_station_id']) else None
-            
-            cursor.execute('''
-                INSERT INTO Bike (Bike_ID, Bike_Name, Current_Status, Last_Station)
-                VALUES (?, ?, ?, ?)
-            ''', (bike_id, bike_name, bike_status, bike_station_id))
-            
-            # Add to processed set regardless of success to avoid duplicates
-            processed_bikes.add(bike_id)
-            success_count['bikes'] += 1
-            print(f"Successfully inserted bike {bike_id}")
-    except Exception as e:
-        print(f"Error inserting bike {row['bike_id']}: {e}")
-
-# Commit bikes before inserting trips
-conn.commit()
-print(f"Inserted {success_count['bikes']} unique bikes")
-
-# === Insert users ===
-cursor.execute('DELETE FROM User')
-print("Cleared existing User table for clean insert")
-
-processed_users = set()
-for _, row in df.iterrows():
+    return cursor.rowcount
+
+
+def import_dataframe(conn, df):
+    """Replace the contents of all entity tables with the rows in ``df``.
+
+    Everything happens in one transaction, so a failed import leaves the
+    database untouched. Returns the number of rows inserted per entity.
+    """
+    counts = {}
     try:
-        if row['user_id'] not in processed_users and pd.notna(row['user_id']):
-            cursor.execute('''
-                INSERT INTO User (User_ID, User_Name, User_Phone)
-                VALUES (?, ?, ?)
-            ''', (row['user_id'], row['user_name'], row['user_phone_number']))
-            processed_users.add(row['user_id'])
-            success_count['users'] += 1
-    except Exception as e:
-        print(f"Error inserting user {row['user_id']}: {e}")
-
-conn.commit()
-print(f"Inserted {success_count['users']} unique users")
-
-# === Insert subscriptions ===
-cursor.execute('DELETE FROM Subscription')
-print("Cleared existing Subscription table for clean insert")
-
-processed_subscriptions = set()
-for _, row in df.iterrows():
+        conn.execute('BEGIN')
+        # Rows are deleted and re-inserted with the same IDs, so only check
+        # foreign keys (e.g. Complaint -> Bike) once everything is back in place
+        conn.execute('PRAGMA defer_foreign_keys = ON')
+        # Trips already archived would be queued for export again when re-inserted
+        columnar.remember_exported(conn)
+        # Delete children before parents so foreign keys stay satisfied
+        for table, _, _ in reversed(ENTITIES):
+            conn.execute(f'DELETE FROM {table}')
+        for table, name, extract in ENTITIES:
+            counts[name] = insert_frame(conn, table, extract(df))
+        columnar.forget_exported(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return counts
+
+
+def import_stream(conn, chunks):
+    """Insert chunks one at a time, letting the primary keys skip rows already loaded.
+
+    Each chunk is its own transaction, so memory and journal size stay bounded
+    by the chunk size. Returns the number of new rows per entity.
+    """
+    counts = {name: 0 for _, name, _ in ENTITIES}
+    # A bike may reference a station that only shows up in a later chunk, so
+    # foreign keys are checked once at the end instead of per statement
+    conn.execute('PRAGMA foreign_keys = OFF')
     try:
-        if pd.notna(row['subscription_id']) and row['subscription_id'] not in processed_subscriptions:
-            cursor.execute('''
-                INSERT INTO Subscription (SubscriptionID, Type, Start, User_ID)
-                VALUES (?, ?, ?, ?)
-            ''', (row['subscription_id'], row['subscription_type'], row['subscription_start_time'], row['user_id']))
-            processed_subscriptions.add(row['subscription_id'])
-            success_count['subscriptions'] += 1
-    except Exception as e:
-        print(f"Error inserting subscription {row['subscription_id']}: {e}")
-
-conn.commit()
-print(f"Inserted {success_count['subscriptions']} unique subscriptions")
-
-# === Insert trips ===
-cursor.execute('DELETE FROM Trip')
-print("Cleared existing Trip table for clean insert")
-
-processed_trips = set()
-for _, row in df.iterrows():
+        for number, chunk in enumerate(chunks, start=1):
+            try:
+                conn.execute('BEGIN')
+                for table, name, extract in ENTITIES:
+                    counts[name] += insert_frame(conn, table, extract(chunk), verb='INSERT OR IGNORE')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            print(f"  Chunk {number}: {len(chunk)} rows")
+    finally:
+        conn.execute('PRAGMA foreign_keys = ON')
+
+    violations = conn.execute('PRAGMA foreign_key_check').fetchall()
+    if violations:
+        print(f"Warning: {len(violations)} rows reference missing parent rows")
+    return counts
+
+
+def upsert_frame(conn, table, frame):
+    """Insert new rows and update existing ones, keyed on the first column.
+
+    Missing values in the file never overwrite values already stored.
+    """
+    key, *rest = frame.columns
+    columns = ', '.join(frame.columns)
+    placeholders = ', '.join('?' for _ in frame.columns)
+    updates = ', '.join(f'{col} = COALESCE(excluded.{col}, {col})' for col in rest)
+    cursor = conn.executemany(
+        f'INSERT INTO {table} ({columns}) VALUES ({placeholders}) '
+        f'ON CONFLICT({key}) DO UPDATE SET {updates}',
+        _records(frame)
+    )
+    return cursor.rowcount
+
+
+# Bytes hashed just before the checkpoint offset to recognise the same file
+TAIL_BYTES = 64 * 1024
+
+
+def _tail_hash(f, offset):
+    """Hash of the bytes preceding ``offset`` in an open binary file"""
+    start = max(offset - TAIL_BYTES, 0)
+    f.seek(start)
+    return hashlib.sha256(f.read(offset - start)).hexdigest()
+
+
+def load_checkpoint(conn, source):
+    """Return (byte_offset, tail_hash, rows_imported) for a source file, if any"""
+    return conn.execute(
+        "SELECT Byte_Offset, Tail_Hash, Rows_Imported FROM Import_Checkpoint WHERE Source_File = ?",
+        (source,)
+    ).fetchone()
+
+
+def save_checkpoint(conn, source, offset, tail_hash, max_trip_id, rows_imported):
+    """Record how far a source file has been applied (inside the caller's transaction)"""
+    conn.execute(
+        """
+        INSERT INTO Import_Checkpoint (Source_File, Byte_Offset, Tail_Hash, Max_Trip_ID, Rows_Imported, Updated_At)
+        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(Source_File) DO UPDATE SET
+            Byte_Offset = excluded.Byte_Offset,
+            Tail_Hash = excluded.Tail_Hash,
+            Max_Trip_ID = MAX(COALESCE(Max_Trip_ID, 0), COALESCE(excluded.Max_Trip_ID, 0)),
+            Rows_Imported = excluded.Rows_Imported,
+            Updated_At = excluded.Updated_At
+        """,
+        (source, offset, tail_hash, max_trip_id, rows_imported)
+    )
+
+
+def _iter_records(f, chunksize):
+    """Yield (raw_bytes, end_offset) for up to ``chunksize`` CSV records at a time.
+
+    Lines are joined while a quoted field is still open, so records with
+    embedded newlines are never split across chunks.
+    """
+    lines = []
+    records = 0
+    open_quote = False
+    for line in iter(f.readline, b''):
+        lines.append(line)
+        if line.count(b'"') % 2:
+            open_quote = not open_quote
+        if open_quote:
+            continue
+        records += 1
+        if records >= chunksize:
+            yield b''.join(lines), f.tell()
+            lines, records = [], 0
+    if lines:
+        yield b''.join(lines), f.tell()
+
+
+def import_incremental(conn, csv_path, chunksize=50000):
+    """Apply the part of ``csv_path`` that was added since the last checkpoint"""
+    source = os.path.abspath(csv_path)
+    header = pd.read_csv(csv_path, nrows=0).columns
+    counts = {name: 0 for _, name, _ in ENTITIES}
+    size = os.path.getsize(csv_path)
+
+    with open(csv_path, 'rb') as f:
+        header_end = len(f.readline())
+        offset, rows_imported = header_end, 0
+        checkpoint = load_checkpoint(conn, source)
+        if checkpoint:
+            saved_offset, saved_hash, saved_rows = checkpoint
+            if saved_offset <= size and _tail_hash(f, saved_offset) == saved_hash:
+                offset, rows_imported = saved_offset, saved_rows
+            else:
+                print("Checkpoint does not match the file any more, re-applying it from the start")
+
+        if offset >= size:
+            print("No new rows since the last import")
+            return counts
+        print(f"Resuming {csv_path} at byte {offset} ({rows_imported} rows already applied)")
+
+        f.seek(offset)
+        conn.execute('PRAGMA foreign_keys = OFF')
+        try:
+            for data, end_offset in _iter_records(f, chunksize):
+                chunk = pd.read_csv(
+                    io.BytesIO(data),
+                    header=None,
+                    usecols=range(len(header)),
+                    dtype={header.get_loc('user_phone_number'): 'string'},
+                )
+                chunk = normalize_export(chunk.set_axis(header, axis=1))
+                rows_imported += len(chunk)
+                trip_ids = chunk['trip_id'].dropna().astype('int64').unique().tolist()
+                try:
+                    conn.execute('BEGIN')
+                    # Upserted trips may already be counted; count them again as they end up
+                    rollups.remove_trips(conn, trip_ids)
+                    for table, name, extract in ENTITIES:
+                        frame = extract(chunk)
+                        # Later rows in the file are newer, so they win
+                        frame = frame.drop_duplicates(subset=frame.columns[0], keep='last')
+                        counts[name] += upsert_frame(conn, table, frame)
+                    rollups.add_trips(conn, trip_ids)
+                    max_trip_id = chunk['trip_id'].max()
+                    save_checkpoint(
+                        conn, source, end_offset, _tail_hash(f, end_offset),
+                        None if pd.isna(max_trip_id) else int(max_trip_id), rows_imported
+                    )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                f.seek(end_offset)
+                print(f"  Applied {len(chunk)} rows (checkpoint at byte {end_offset})")
+        finally:
+            conn.execute('PRAGMA foreign_keys = ON')
+    return counts
+
+
+def print_summary(conn, counts, elapsed):
+    """Print insert counts and a short verification of the database"""
+    print(f"\nInsert Summary ({elapsed:.2f}s):")
+    for name, count in counts.items():
+        print(f"  {name.capitalize()}: {count} rows written")
+
+    print("\nData Verification:")
+    for table in TABLES:
+        count = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        print(f"  {table} table: {count} rows")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a Bysykkel CSV export into SQLite")
+    parser.add_argument('csv_path', nargs='?', default='bysykkel-old.csv', help="CSV export to load")
+    parser.add_argument('--db', default='bysykkel.db', help="SQLite database file")
+    parser.add_argument('--chunksize', type=int, help="Stream the export in chunks of this many rows")
+    parser.add_argument('--memory-limit-mb', type=float,
+                        help="Stream the export in chunks sized to stay under this memory budget")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only apply rows added since the last checkpoint for this file")
+    args = parser.parse_args(argv)
+
+    # Connect to SQLite database (creates it if it doesn't exist)
+    conn = sqlite3.connect(args.db)
     try:
-        if pd.notna(row['trip_id']) and row['trip_id'] not in processed_trips:
-            cursor.execute('''
-                INSERT INTO Trip (
-                    Trip_ID, User_ID, Bike_ID, Start_Station_ID, End_Station_ID,
-                    Start_Time, End_Time
-                ) VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                row['trip_id'], row['user_id'], row['bike_id'],
-                row['start_station_id'], row['end_station_id'],
-                row['trip_start_time'], row['trip_end_time']
-            ))
-            processed_trips.add(row['trip_id'])
-            success_count['trips'] += 1
-    except Exception as e:
-        print(f"Error inserting trip {row['trip_id']}: {e}")
-
-# === Print summary and commit changes ===
-print("\nInsert Summary:")
-for table, count in success_count.items():
-    print(f"  {table.capitalize()}: {count} rows inserted")
-
-# IMPORTANT: Commit changes to save them to the database
-conn.commit()
-
-# Verify data was inserted
-print("\nData Verification:")
-for table in ['User', 'Subscription', 'Station', 'Bike', 'Trip']:
-    cursor.execute(f"SELECT COUNT(*) FROM {table}")
-    count = cursor.fetchone()[0]
-    print(f"  {table} table: {count} rows")
-
-# === Verify station names ===
-cursor.execute("SELECT Station_ID, Station_Name FROM Station LIMIT 10")
-sample_stations = cursor.fetchall()
-print("\nSample Station Names:")
-for station in sample_stations:
-    print(f"  ID: {station[0]}, Name: {station[1]}")
-
-# === Verify bike details ===
-cursor.execute("SELECT Bike_ID, Bike_Name, Current_Status, Last_Station FROM Bike")
-all_bikes = cursor.fetchall()
-print("\nAll Bikes in the Database:")
-for bike in all_bikes:
-    print(f"  ID: {bike[0]}, Name: {bike[1]}, Status: {bike[2]}, Station: {bike[3]}")
-
-# Close the connection
-conn.close()
\ No newline at end of file
+        # Enable foreign key constraints
+        conn.execute('PRAGMA foreign_keys = ON')
+        create_tables(conn)
+
+        start = time.perf_counter()
+        chunksize = args.chunksize
+        if chunksize is None and args.memory_limit_mb is not None:
+            chunksize = chunksize_for_memory(args.csv_path, args.memory_limit_mb)
+
+        if args.incremental:
+            # The checkpoint table is created by the migrations
+            migrate(conn)
+            counts = import_incremental(conn, args.csv_path, chunksize or 50000)
+        elif chunksize:
+            print(f"Streaming {args.csv_path} in chunks of {chunksize} rows")
+            counts = import_stream(conn, iter_export(args.csv_path, chunksize))
+        else:
+            df = read_export(args.csv_path)
+            print(f"Successfully loaded {len(df)} rows with {len(df.columns)} columns")
+            counts = import_dataframe(conn, df)
+        # Indexes and statistics are (re)built after the bulk load
+        migrate(conn)
+        # The bulk load bypassed the availability triggers, so recount free docks
+        availability.reconcile(conn)
+        conn.commit()
+        if args.incremental:
+            # The chunks updated the trip statistics; finish an interrupted backfill, if any
+            rollups.backfill(conn, restart=False)
+        else:
+            # Imported trips bypass the dropoff path, so rebuild the trip statistics
+            rollups.backfill(conn)
+        if args.incremental:
+            # A nightly sync changes little: only re-analyze tables that need it
+            conn.execute('PRAGMA optimize')
+        else:
+            conn.execute('ANALYZE')
+        conn.commit()
+        print_summary(conn, counts, time.perf_counter() - start)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
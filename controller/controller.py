@@ -1,9 +1,23 @@
 import re
+import numpy as np
 import pandas as pd
+from model.cache import cached
+from model.metrics import instrumented
 
+STATEMENT_COLUMNS = ["method", "statement", "calls", "total_ms", "mean_ms", "p95_ms", "max_ms",
+                     "rows", "errors", "full_scan", "sql", "plan"]
+METHOD_COLUMNS = ["method", "calls", "total_ms", "mean_ms", "p95_ms", "max_ms"]
+
+@instrumented(skip=("get_diagnostics", "reset_diagnostics"))
 class BysykkelController:
     def __init__(self, model):
         self.model = model
+        # Derived tables are cached next to the model's query results
+        self.cache = model.cache
+        # Their misses are read methods too (see BysykkelModel.get_connection)
+        self.reading = model.reading
+        # Controller methods are timed in the model's metrics registry
+        self.metrics = model.metrics
         # Store the current filter state
         self.user_filter = ""
         self.station_filter = ""
@@ -48,6 +62,70 @@ class BysykkelController:
             "bikes_at_stations": bikes_at_stations
         }
     
+    def get_snapshot(self, user_filter="", station_filter="", bike_filter="", pages=None, page_size=50):
+        """Load every dataset the page needs once, in one read transaction.
+
+        All tabs of a rerun are rendered from this dict, so they show the same
+        state of the database and nothing is queried twice. The Users, Bikes
+        and bikes-at-stations tables are loaded one page at a time; ``pages``
+        maps "users", "bikes" and "bikes_at_stations" to the keyset cursor of
+        the page to show (None for the first page).
+        """
+        pages = pages or {}
+        self.user_filter = user_filter
+        self.station_filter = station_filter
+        self.bike_filter = bike_filter
+
+        with self.model.read_transaction():
+            all_users = self.model.get_users_alphabetical()
+            available_bikes = self.model.get_bikes_at_stations()
+            snapshot = {
+                "all_users": all_users,
+                "users": self.model.get_users_page(user_filter, pages.get("users"), page_size),
+                "users_total": self.model.count_users(user_filter),
+                "bikes": self.model.get_bikes_page(pages.get("bikes"), page_size),
+                "bikes_total": self.model.count_bikes(),
+                "subscriptions": self.model.get_subscription_counts(),
+                "station_trips": self.model.get_station_trips_count(),
+                "hourly_trips": self.model.get_hourly_trip_counts(),
+                "available_bikes": available_bikes,
+                "bikes_at_stations": self.model.get_bikes_at_stations_page(
+                    station_filter, bike_filter, pages.get("bikes_at_stations"), page_size
+                ),
+                "bikes_at_stations_total": self.model.count_bikes_at_stations(station_filter, bike_filter),
+                "stations": self.model.get_all_stations(),
+                "active_trips": self.model.get_active_trips(),
+                "users_with_active_trips": self.model.get_users_with_active_trips(),
+                "stations_with_availability": self.model.get_stations_with_availability(),
+                "station_availability": self.get_stations_availability(),
+                "labels": self.get_label_maps(),
+            }
+            snapshot["suggestions"] = self.get_filter_suggestions(snapshot, user_filter, station_filter, bike_filter)
+        return snapshot
+
+    def get_label_maps(self):
+        """Get id -> name dicts for users, stations and bikes, for O(1) selectbox labels"""
+        return {
+            "users": self.model.get_user_labels(),
+            "stations": self.model.get_station_labels(),
+            "bikes": self.model.get_bike_labels(),
+        }
+
+    def get_filter_suggestions(self, snapshot, user_filter="", station_filter="", bike_filter=""):
+        """Get close name matches for filters that matched nothing, e.g. because of a typo"""
+        suggestions = {}
+        if user_filter and snapshot["users_total"] == 0:
+            suggestions["users"] = [name for _, name in self.model.search_names("User", user_filter, 5)]
+        if snapshot["bikes_at_stations_total"] == 0:
+            names = []
+            if station_filter:
+                names += [name for _, name in self.model.search_names("Station", station_filter, 5)]
+            if bike_filter:
+                names += [name for _, name in self.model.search_names("Bike", bike_filter, 5)]
+            if names:
+                suggestions["bikes_at_stations"] = names
+        return suggestions
+
     def clear_analysis_filters(self):
         """Clear the analysis tab filters"""
         self.station_filter = ""
@@ -87,6 +165,13 @@ class BysykkelController:
                 return False, str(e)
         return False, "Validation failed"
     
+    def get_nearby_stations(self, user_id, k=3, min_available_bikes=1):
+        """Get the stations with parked bikes closest to a user, None if the user has no location"""
+        location = self.model.get_user_location(user_id) if user_id is not None else None
+        if location is None:
+            return None
+        return self.model.nearest_stations(location[0], location[1], k, min_available_bikes)
+
     def get_stations(self):
         """Get all stations"""
         return self.model.get_all_stations()
@@ -95,13 +180,13 @@ class BysykkelController:
         """Get active trips for a user or all active trips"""
         return self.model.get_active_trips(user_id)
     
-    def checkout_bike(self, user_id, bike_id, station_id):
+    def checkout_bike(self, user_id, bike_id, station_id, raise_errors=False):
         """Process bike checkout"""
-        return self.model.create_card_checkout(user_id, bike_id, station_id)
+        return self.model.create_card_checkout(user_id, bike_id, station_id, raise_errors)
     
-    def dropoff_bike(self, user_id, bike_id, station_id):
+    def dropoff_bike(self, user_id, bike_id, station_id, raise_errors=False):
         """Process bike dropoff"""
-        return self.model.create_card_dropoff(user_id, bike_id, station_id)
+        return self.model.create_card_dropoff(user_id, bike_id, station_id, raise_errors)
     
     def report_bike_issues(self, bike_id, issues, notes=None):
         """Report issues with a bike"""
@@ -139,36 +224,153 @@ class BysykkelController:
         """Get users who have active trips"""
         return self.model.get_users_with_active_trips()
     
-    def get_stations_availability(self, in_progress=False):
+    @cached('Station')
+    def get_stations_availability(self):
         """
-        Get stations with availability percentage
+        Get stations with availability percentages and a map link
     
-        Args:
-            in_progress: Boolean indicating if a trip is in progress
+        Both percentages are computed in one vectorized pass, so switching
+        "Trip in progress" only picks the other column:
+            Free_Docks_Percent  free docks, what matters with a bike to park
+            Bikes_Percent       occupied docks, i.e. bikes available to rent
     
+        A station without docks (Max_Parking 0 or unknown) has neither free
+        docks nor bikes, so both percentages are 0.
+
         Returns:
-            DataFrame with station info and calculated availability
+            DataFrame with Station_Name, the two (numeric) percentages and Location
         """
-        # Get stations data from model
         stations_df = self.model.get_stations_with_availability()
+        max_parking = stations_df['Max_Parking'].where(stations_df['Max_Parking'] > 0)
+        free_share = stations_df['Available_Parking'] / max_parking * 100
+        bikes_share = (100 - free_share).fillna(0)
+        free_share = free_share.fillna(0)
     
-        # Calculate availability percentage based on in_progress flag
-        if in_progress:
-            # If trip is in progress, availability is percentage of available spots
-            stations_df['Availability'] = (stations_df['Available_Parking'] / stations_df['Max_Parking'] * 100).round(0).astype(int)
-        else:
-            # If trip is not in progress, availability is percentage of non-available spots
-            stations_df['Availability'] = ((stations_df['Max_Parking'] - stations_df['Available_Parking']) / stations_df['Max_Parking'] * 100).round(0).astype(int)
-    
-        # Add Map link column
-        stations_df['Location'] = stations_df.apply(
-            lambda row: f'<a href="https://www.google.com/maps?q={row.Latitude},{row.Longitude}" target="_blank">Google Maps</a>', 
-            axis=1
-        )
-            
-        # Select only the needed columns
-        result_df = stations_df[['Station_Name', 'Availability', 'Location']]
+        # Map links built column-wise instead of one Python call per row
+        location = ('<a href="https://www.google.com/maps?q='
+                    + stations_df['Latitude'].astype(str) + ','
+                    + stations_df['Longitude'].astype(str)
+                    + '" target="_blank">Google Maps</a>')
     
-        # Add % sign to availability
-        result_df.loc[:, 'Availability'] = result_df['Availability'].astype(str) + '%'    
-        return result_df
\ No newline at end of file
+        return pd.DataFrame({
+            'Station_Name': stations_df['Station_Name'],
+            'Free_Docks_Percent': free_share.round(0).astype('int64'),
+            'Bikes_Percent': bikes_share.round(0).astype('int64'),
+            'Location': location,
+        })
+
+    def get_trip_reports(self, start=None, end=None, station_id=None):
+        """
+        Get trips per station and per hour of day for trips in [start, end)
+
+        Read from the trip archive when the model has one (trips exported so
+        far), otherwise from the Trip table.
+
+        Returns:
+            dict with
+                stations    Station_ID, Station_Name, Trips_Started, Trips_Ended, busiest first
+                hourly      Hour, Trips_Started, Trips_Ended (for ``station_id`` if given)
+                source      "archive" or "database"
+                start, end  the window asked for
+        """
+        stations = self.model.get_station_trips_report(start, end)
+        return {
+            'stations': stations.sort_values(['Trips_Started', 'Trips_Ended'], ascending=False,
+                                             kind='stable').reset_index(drop=True),
+            'hourly': self.model.get_hourly_demand_report(start, end, station_id),
+            'source': 'archive' if self.model.archive is not None else 'database',
+            'start': start,
+            'end': end,
+        }
+
+    def get_demand_forecast(self, hours=24):
+        """
+        Get the demand forecast for the next ``hours`` hours, with projected bikes per station
+
+        Bikes docked now plus the cumulative expected arrivals minus
+        departures gives each station's projected bikes hour by hour, for
+        all stations at once.
+
+        Returns:
+            dict with
+                summary     one row per station: Bikes_Now, Max_Parking, expected Departures
+                            and Arrivals, Projected_Bikes at the end, Hours_Until_Empty and
+                            Hours_Until_Full (NaN if it doesn't happen), most urgent first
+                hourly      Station_ID, Time, Departures, Arrivals, Projected_Bikes
+                start       first forecast hour
+                trained_through  last day of history the model has seen (None if none)
+        """
+        forecast = self.model.get_demand_forecast(hours=hours)
+        stations = self.model.get_stations_with_availability().set_index('Station_ID')
+        departures = forecast.pivot(index='Station_ID', columns='Time', values='Departures')
+        arrivals = forecast.pivot(index='Station_ID', columns='Time', values='Arrivals')
+        stations = stations.reindex(departures.index)
+
+        capacity = stations['Max_Parking'].fillna(0).to_numpy()
+        bikes_now = (stations['Max_Parking'] - stations['Available_Parking']).fillna(0).to_numpy()
+        projected = np.clip(bikes_now[:, None] + np.cumsum(arrivals.to_numpy() - departures.to_numpy(), axis=1),
+                            0, capacity[:, None])
+
+        def hours_until(reached):
+            # Hours until the first forecast hour where the condition holds
+            return np.where(reached.any(axis=1), reached.argmax(axis=1) + 1, np.nan)
+
+        summary = pd.DataFrame({
+            'Station_ID': departures.index,
+            'Station_Name': stations['Station_Name'].to_numpy(),
+            'Bikes_Now': bikes_now.astype(int),
+            'Max_Parking': capacity.astype(int),
+            'Departures': departures.sum(axis=1).to_numpy().round(1),
+            'Arrivals': arrivals.sum(axis=1).to_numpy().round(1),
+            'Projected_Bikes': projected[:, -1].round(1) if projected.shape[1] else bikes_now,
+            # Less than one bike left to rent, or less than one free dock
+            'Hours_Until_Empty': hours_until(projected < 1),
+            'Hours_Until_Full': hours_until(projected > capacity[:, None] - 1),
+        })
+        urgency = summary[['Hours_Until_Empty', 'Hours_Until_Full']].min(axis=1)
+        summary = summary.assign(_urgency=urgency).sort_values(['_urgency', 'Station_Name']).drop(columns='_urgency')
+
+        hourly = forecast.sort_values(['Station_ID', 'Time']).reset_index(drop=True)
+        hourly['Projected_Bikes'] = projected.ravel()
+        last_day = self.model.forecaster.last_day
+        return {
+            'summary': summary.reset_index(drop=True),
+            'hourly': hourly,
+            'start': departures.columns[0] if len(departures.columns) else None,
+            'trained_through': None if last_day is None else str(np.datetime64(last_day, 'D')),
+        }
+
+    def get_rebalancing_plan(self, trucks=3, capacity=20, forecast_hours=0):
+        """
+        Get truck routes that move bikes from over-full to under-full stations
+
+        With ``forecast_hours`` the station targets allow for the demand
+        expected over that many hours (see model/rebalance.py).
+
+        Returns:
+            the model's plan (stops, routes, stations, seconds), with the stops'
+            Latitude and Longitude for the map
+        """
+        plan = self.model.get_rebalancing_plan(trucks, capacity, forecast_hours=forecast_hours)
+        coordinates = self.model.get_stations_with_availability()[['Station_ID', 'Latitude', 'Longitude']]
+        # A new dict: the plan itself is shared through the query cache
+        return {**plan, 'stops': plan['stops'].merge(coordinates, on='Station_ID', how='left')}
+
+    def get_diagnostics(self):
+        """Get per-statement and per-method timings, connection waits and cache stats"""
+        metrics = self.model.metrics
+        statements = pd.DataFrame(metrics.statements(), columns=STATEMENT_COLUMNS)
+        return {
+            "enabled": metrics.enabled,
+            "since": metrics.started,
+            "statements": statements,
+            "full_scans": statements[statements["full_scan"] != ""],
+            "methods": pd.DataFrame(metrics.methods(), columns=METHOD_COLUMNS),
+            "connection_wait": metrics.connection_wait(),
+            "cache": self.model.cache_stats(),
+            "prometheus": self.model.metrics_text(),
+        }
+
+    def reset_diagnostics(self):
+        """Start the diagnostics timings over"""
+        self.model.metrics.reset()
@@ -0,0 +1,76 @@
+"""Materialized station availability.
+
+``Station.Available_Parking`` is kept as a counter of free docks. Triggers
+added by migration 3 adjust it whenever a bike leaves or arrives at a
+station (checkout, dropoff, moving a bike), so reading availability is a
+plain column read. A bike occupies a dock at ``Last_Station`` unless it
+is out on a trip (``Current_Status = 'Active'``).
+
+Bulk loads write the table directly and bypass the triggers, so they call
+``reconcile(conn)`` afterwards. It can also be run by hand:
+
+    python -m model.availability [bysykkel.db]
+"""
+import sqlite3
+import sys
+
+# Bikes that take up a dock at their Last_Station
+DOCKED = "Current_Status IS NOT 'Active' AND Last_Station IS NOT NULL"
+
+TRIGGERS = [
+    # A docked bike leaves its station (checked out, or moved elsewhere)
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_bike_undock
+    AFTER UPDATE OF Current_Status, Last_Station ON Bike
+    WHEN OLD.Last_Station IS NOT NULL AND OLD.Current_Status IS NOT 'Active'
+        AND (NEW.Current_Status IS 'Active' OR NEW.Last_Station IS NOT OLD.Last_Station)
+    BEGIN
+        UPDATE Station SET Available_Parking = Available_Parking + 1
+        WHERE Station_ID = OLD.Last_Station;
+    END
+    """,
+    # A bike is docked at a station (dropped off, or moved there)
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_bike_dock
+    AFTER UPDATE OF Current_Status, Last_Station ON Bike
+    WHEN NEW.Last_Station IS NOT NULL AND NEW.Current_Status IS NOT 'Active'
+        AND (OLD.Current_Status IS 'Active' OR NEW.Last_Station IS NOT OLD.Last_Station
+             OR OLD.Last_Station IS NULL)
+    BEGIN
+        UPDATE Station SET Available_Parking = Available_Parking - 1
+        WHERE Station_ID = NEW.Last_Station;
+    END
+    """,
+]
+
+RECONCILE = f"""
+    UPDATE Station
+    SET Available_Parking = Max_Parking - (
+        SELECT COUNT(*) FROM Bike
+        WHERE Bike.Last_Station = Station.Station_ID AND {DOCKED}
+    )
+    WHERE Available_Parking IS NOT Max_Parking - (
+        SELECT COUNT(*) FROM Bike
+        WHERE Bike.Last_Station = Station.Station_ID AND {DOCKED}
+    )
+"""
+
+
+def reconcile(conn):
+    """Rebuild every station's free-dock counter from the Bike table.
+
+    Runs in the caller's transaction (the caller commits) and returns the
+    number of stations whose counter was wrong.
+    """
+    return conn.execute(RECONCILE).rowcount
+
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "bysykkel.db"
+    conn = sqlite3.connect(db_path)
+    try:
+        fixed = reconcile(conn)
+        conn.commit()
+        print(f"Reconciled availability, {fixed} stations corrected")
+    finally:
+        conn.close()
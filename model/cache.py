@@ -0,0 +1,227 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from types import MappingProxyType
+
+
+class QueryCache:
+    """Read-through cache for model query results.
+
+    Entries expire after ``ttl`` seconds and the least recently used entry is
+    evicted once ``max_entries`` is reached. Every entry is tagged with the
+    tables its query reads, so a write only drops the results that depend on
+    the tables it touched.
+
+    Writes by other processes (or connections that don't go through the
+    model) never call ``invalidate``. With ``version``, a callable returning
+    a token that changes whenever the database does (``PRAGMA
+    data_version``), every lookup compares it with the token the entries
+    were read at and drops them all when it moved on. Results read while it
+    changed are not stored, so all entries reflect the same database state.
+
+    The model's own commits run inside ``committing()``: the token is
+    checked just before (anything new then was someone else's) and taken
+    again right after, so they only drop what ``invalidate`` drops. A
+    foreign commit landing between the two goes unnoticed until the entries
+    expire (``ttl``).
+    """
+
+    def __init__(self, max_entries=256, ttl=60.0, version=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version = version
+        self._version = None  # token the entries were read at
+        self._local = threading.local()  # version pinned by a read transaction
+        self._commit_lock = threading.Lock()
+        self._committing = False  # an own commit is in progress, the token may be ours
+        self._entries = OrderedDict()  # key -> (expires_at, tables, value)
+        self._by_table = {}  # table -> set of keys
+        self._generations = {}  # table -> number of invalidations so far
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.flushes = 0
+
+    def _sync(self):
+        """Drop every entry if the database changed since they were read; returns the token (caller holds the lock)"""
+        if self.version is None:
+            return None
+        current = self.version()
+        if current != self._version and not self._committing:
+            if self._entries:
+                self.flushes += 1
+            # Count it as an invalidation of every table, for in-flight misses and the read replica
+            for table in set(self._by_table) | set(self._generations):
+                self._generations[table] = self._generations.get(table, 0) + 1
+            self._entries.clear()
+            self._by_table.clear()
+            self._version = current
+        return current
+
+    @contextmanager
+    def committing(self):
+        """Wrap a commit made through the model, so it doesn't count as a foreign write"""
+        if self.version is None:
+            yield
+            return
+        with self._commit_lock:
+            with self._lock:
+                # Still inside the write transaction: any change so far is foreign
+                self._sync()
+                self._committing = True
+            try:
+                yield
+            except BaseException:
+                with self._lock:
+                    self._committing = False
+                raise
+            with self._lock:
+                self._committing = False
+                self._version = self.version()
+
+    def _bypassed(self, current):
+        """True inside a read transaction whose snapshot is older than the entries (caller holds the lock)"""
+        pinned = getattr(self._local, "version", None)
+        return pinned is not None and pinned != current
+
+    @contextmanager
+    def pin(self, version):
+        """Use the cache on this thread only while the database is still at ``version``"""
+        self._local.version = version
+        try:
+            yield
+        finally:
+            self._local.version = None
+
+    def _drop(self, key):
+        """Remove one entry and its table tags (caller holds the lock)"""
+        _, tables, _ = self._entries.pop(key)
+        for table in tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+
+    def get(self, key):
+        """Return (True, value) on a hit and (False, None) on a miss"""
+        with self._lock:
+            if self._bypassed(self._sync()):
+                self.misses += 1
+                return False, None
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[2]
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return False, None
+
+    def generation(self, tables):
+        """Snapshot of the database token and the invalidation counters for ``tables``"""
+        with self._lock:
+            return self._sync(), tuple(self._generations.get(table, 0) for table in tables)
+
+    def set(self, key, value, tables, generation=None):
+        """Store a result together with the tables it was read from.
+
+        If ``generation`` is given and one of the tables was invalidated since
+        it was taken, the result may be stale and is not stored.
+        """
+        with self._lock:
+            current = self._sync()
+            if self._bypassed(current):
+                return
+            if generation is not None and generation != (
+                current, tuple(self._generations.get(table, 0) for table in tables)
+            ):
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, tuple(tables), value)
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def generations(self):
+        """Invalidation counters of every table invalidated so far"""
+        with self._lock:
+            return dict(self._generations)
+
+    def invalidate(self, tables):
+        """Drop every cached result that reads from any of ``tables``"""
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+                for key in list(self._by_table.get(table, ())):
+                    if key in self._entries:
+                        self._drop(key)
+                        self.invalidations += 1
+
+    def clear(self):
+        """Drop all cached results"""
+        with self._lock:
+            self._entries.clear()
+            self._by_table.clear()
+
+    def stats(self):
+        """Return hit/miss counters and the current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "flushes": self.flushes,
+                "entries": len(self._entries),
+            }
+
+
+def _copy(value):
+    """Hand out copies of mutable results so callers can't change the cached one"""
+    if isinstance(value, MappingProxyType):
+        return value  # already read-only, no need to copy
+    copy = getattr(value, "copy", None)
+    return copy() if callable(copy) else value
+
+
+def cached(*tables):
+    """Cache a model read method; the result depends on ``tables``.
+
+    Misses run inside ``self.reading()``, which lets the model send their
+    queries to the read replica.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            key = (func.__name__, args, tuple(sorted(kwargs.items())))
+            hit, value = self.cache.get(key)
+            if not hit:
+                generation = self.cache.generation(tables)
+                with self.reading():
+                    value = func(self, *args, **kwargs)
+                self.cache.set(key, value, tables, generation)
+            return _copy(value)
+        return wrapper
+    return decorator
+
+
+def invalidates(*tables):
+    """Mark a model write method; cached reads of ``tables`` are dropped afterwards"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.cache.invalidate(tables)
+        return wrapper
+    return decorator
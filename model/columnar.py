@@ -0,0 +1,442 @@
+"""Columnar archive of closed trips for historical reports.
+
+Closed trips are exported from SQLite into a Parquet dataset, joined with
+their stations, bike and user, and partitioned Hive-style by start month
+and start station:
+
+    archive/month=2023-05/start_station=12/part-<batch>-0.parquet
+
+Migration 7 adds ``Trip_Export_Queue``; triggers put every trip in it
+when it is closed (or inserted already closed), and the migration queues
+all trips closed before it. ``TripArchive.export`` writes the queued trips
+in batches through Arrow and only then removes them from the queue, so
+each export appends just the trips closed since the last one. A full
+re-import deletes and re-inserts every trip, which would queue them all
+again; ``remember_exported`` and ``forget_exported`` bracket it so trips
+already in the archive stay out of the queue. A crash
+between writing and dequeuing exports that batch again on the next run
+(at least once); ``compact`` rewrites partitions that have collected many
+small files, dropping duplicate trips on the way.
+
+A model with an archive runs ``ArchiveExporter``: a background thread
+that exports every ``interval`` seconds, and sooner after a dropoff, but
+at most once per ``min_interval`` seconds. Each export adds a small file
+to every partition it touches, so after exporting it compacts the
+partitions it has touched once they hold ``min_files`` files; the busy
+current-month partitions are rewritten about every ``min_files`` exports
+instead of collecting files without end. Trips closed just before the
+process stops stay queued for the next export.
+
+Reports read only the partitions and row groups their filters can match
+(partition pruning and Parquet statistics), so scanning years of history
+never touches the live database. pyarrow is optional: without it the
+model answers the same reports from the Trip table.
+
+    python -m model.columnar export bysykkel.db archive/
+    python -m model.columnar compact archive/
+    python -m model.columnar report archive/ [start] [end]
+"""
+import atexit
+import os
+import sys
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:  # the archive is optional
+    pa = None
+
+from model.tracing import logger
+
+TABLES = [
+    "CREATE TABLE IF NOT EXISTS Trip_Export_Queue (Trip_ID INTEGER PRIMARY KEY)",
+]
+
+TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_trip_export_close AFTER UPDATE OF End_Time ON Trip
+    WHEN OLD.End_Time IS NULL AND NEW.End_Time IS NOT NULL
+    BEGIN
+        INSERT OR IGNORE INTO Trip_Export_Queue (Trip_ID) VALUES (NEW.Trip_ID);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_trip_export_insert AFTER INSERT ON Trip
+    WHEN NEW.End_Time IS NOT NULL
+    BEGIN
+        INSERT OR IGNORE INTO Trip_Export_Queue (Trip_ID) VALUES (NEW.Trip_ID);
+    END
+    """,
+]
+
+# Everything closed so far still has to be exported once
+INITIAL_QUEUE = [
+    "INSERT OR IGNORE INTO Trip_Export_Queue (Trip_ID) SELECT Trip_ID FROM Trip WHERE End_Time IS NOT NULL",
+]
+
+EXPORT_QUERY = """
+    SELECT t.Trip_ID, t.User_ID, u.User_Name, t.Bike_ID, b.Bike_Name,
+           t.Start_Station_ID, ss.Station_Name AS Start_Station_Name,
+           t.End_Station_ID, es.Station_Name AS End_Station_Name,
+           t.Start_Time, t.End_Time
+    FROM Trip_Export_Queue q
+    JOIN Trip t ON t.Trip_ID = q.Trip_ID
+    LEFT JOIN User u ON u.User_ID = t.User_ID
+    LEFT JOIN Bike b ON b.Bike_ID = t.Bike_ID
+    LEFT JOIN Station ss ON ss.Station_ID = t.Start_Station_ID
+    LEFT JOIN Station es ON es.Station_ID = t.End_Station_ID
+    WHERE q.Trip_ID > ?
+    ORDER BY q.Trip_ID
+    LIMIT ?
+"""
+
+def _has_queue(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Trip_Export_Queue'"
+                        ).fetchone() is not None
+
+
+def remember_exported(conn):
+    """Note the trips already exported, before a reload deletes the Trip table"""
+    conn.execute("DROP TABLE IF EXISTS temp.Reload_Exported")
+    conn.execute("CREATE TEMP TABLE Reload_Exported (Trip_ID INTEGER PRIMARY KEY)")
+    if _has_queue(conn):
+        conn.execute("""
+            INSERT INTO temp.Reload_Exported (Trip_ID)
+            SELECT Trip_ID FROM Trip
+            WHERE End_Time IS NOT NULL AND Trip_ID NOT IN (SELECT Trip_ID FROM Trip_Export_Queue)
+        """)
+
+
+def forget_exported(conn):
+    """Take the trips noted by ``remember_exported`` back out of the queue after the reload"""
+    if _has_queue(conn):
+        conn.execute("DELETE FROM Trip_Export_Queue WHERE Trip_ID IN (SELECT Trip_ID FROM temp.Reload_Exported)")
+    conn.execute("DROP TABLE temp.Reload_Exported")
+
+
+# Trips dequeued per write transaction, so a large export doesn't hold the write lock
+DEQUEUE_CHUNK = 20_000
+
+
+def available():
+    """True if pyarrow is installed"""
+    return pa is not None
+
+
+def _require():
+    if pa is None:
+        raise RuntimeError("The trip archive needs pyarrow (pip install pyarrow)")
+
+
+def _schema():
+    return pa.schema([
+        ("Trip_ID", pa.int64()),
+        ("User_ID", pa.int64()),
+        ("User_Name", pa.string()),
+        ("Bike_ID", pa.int64()),
+        ("Bike_Name", pa.string()),
+        ("Start_Station_ID", pa.int32()),
+        ("Start_Station_Name", pa.string()),
+        ("End_Station_ID", pa.int32()),
+        ("End_Station_Name", pa.string()),
+        ("Start_Time", pa.timestamp("s")),
+        ("End_Time", pa.timestamp("s")),
+        ("Duration_s", pa.int32()),
+        ("Start_Hour", pa.int8()),
+        ("End_Hour", pa.int8()),
+        ("month", pa.string()),
+        ("start_station", pa.int32()),
+    ])
+
+
+def _partitioning():
+    return ds.partitioning(pa.schema([("month", pa.string()), ("start_station", pa.int32())]), flavor="hive")
+
+
+def to_arrow(trips):
+    """Arrow table with derived columns for a DataFrame from EXPORT_QUERY"""
+    start = pd.to_datetime(trips["Start_Time"], errors="coerce")
+    end = pd.to_datetime(trips["End_Time"], errors="coerce")
+    columns = {
+        **{name: trips[name] for name in (
+            "Trip_ID", "User_ID", "User_Name", "Bike_ID", "Bike_Name", "Start_Station_ID",
+            "Start_Station_Name", "End_Station_ID", "End_Station_Name")},
+        "Start_Time": start,
+        "End_Time": end,
+        "Duration_s": (end - start).dt.total_seconds(),
+        "Start_Hour": start.dt.hour,
+        "End_Hour": end.dt.hour,
+        # datetime64[M] formats as YYYY-MM far faster than strftime
+        "month": pd.Series(np.datetime_as_string(start.to_numpy().astype("datetime64[M]"))).replace("NaT", "unknown"),
+        "start_station": trips["Start_Station_ID"],
+    }
+    schema = _schema()
+    return pa.table([pa.array(columns[field.name], type=field.type, from_pandas=True) for field in schema],
+                    schema=schema)
+
+
+class TripArchive:
+    """Partitioned Parquet dataset of closed trips under ``path``"""
+
+    def __init__(self, path, refresh_after=60.0):
+        _require()
+        self.path = path
+        # Files written by another process show up after this many seconds
+        self.refresh_after = refresh_after
+        self._dataset = None
+        self._listed_at = 0.0
+        # Partition directories exported to since they were last compacted
+        self._touched = set()
+        # Compaction replaces files; reports in this process wait for it
+        self._lock = threading.RLock()
+
+    def dataset(self):
+        """The dataset (its file listing is reused for ``refresh_after`` seconds)"""
+        if self._dataset is None or time.monotonic() - self._listed_at > self.refresh_after:
+            if not os.path.isdir(self.path):
+                return None
+            self._dataset = ds.dataset(self.path, schema=_schema(), format="parquet", partitioning=_partitioning())
+            self._listed_at = time.monotonic()
+        return self._dataset
+
+    def write(self, table, batch_name=None):
+        """Append an Arrow table of trips as new files in their partitions"""
+        batch_name = batch_name or f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        ds.write_dataset(
+            table, self.path, format="parquet", partitioning=_partitioning(),
+            basename_template=f"part-{batch_name}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            max_partitions=100_000,  # months x stations
+        )
+        self._dataset = None
+
+    def export(self, conn, batch_size=500_000, commit=None):
+        """Move the queued (newly closed) trips into the archive; returns trips exported.
+
+        ``commit`` commits the dequeue transactions instead of ``conn.commit``.
+        """
+        commit = commit or conn.commit
+        exported = 0
+        after = 0
+        while True:
+            trips = pd.read_sql_query(EXPORT_QUERY, conn, params=(after, batch_size))
+            if conn.in_transaction:
+                conn.commit()
+            if trips.empty:
+                return exported
+            table = to_arrow(trips)
+            self.write(table)
+            self._touched.update(
+                self._partition_dir(month, station)
+                for month, station in set(zip(table["month"].to_pylist(), table["start_station"].to_pylist()))
+            )
+            ids = trips["Trip_ID"].tolist()
+            # Dequeue exactly the trips written (a range could also drop an
+            # old trip closed meanwhile), in short write transactions
+            for chunk in range(0, len(ids), DEQUEUE_CHUNK):
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.executemany("DELETE FROM Trip_Export_Queue WHERE Trip_ID = ?",
+                                     [(i,) for i in ids[chunk:chunk + DEQUEUE_CHUNK]])
+                    commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            exported += len(ids)
+            after = ids[-1]
+
+    def _partition_dir(self, month, station):
+        return os.path.normpath(os.path.join(self.path, f"month={month}", f"start_station={station}"))
+
+    def compact(self, min_files=8, touched_only=False):
+        """Rewrite partitions with at least ``min_files`` files as one file each.
+
+        With ``touched_only`` only partitions ``export`` wrote to since their
+        last compaction are considered.
+        """
+        with self._lock:
+            return self._compact(min_files, touched_only)
+
+    def _compact(self, min_files, touched_only):
+        self._dataset = None  # list every file there is now
+        dataset = self.dataset()
+        if dataset is None:
+            return 0
+        by_dir = {}
+        for path in dataset.files:
+            by_dir.setdefault(os.path.normpath(os.path.dirname(path)), []).append(path)
+        compacted = 0
+        for directory, files in by_dir.items():
+            if touched_only and directory not in self._touched:
+                continue
+            if len(files) < min_files:
+                continue
+            table = ds.dataset(files, schema=_schema(), format="parquet",
+                               partitioning=_partitioning(), partition_base_dir=self.path).to_table()
+            # Keep one row per trip if a batch was exported twice
+            frame = table.to_pandas().drop_duplicates("Trip_ID").sort_values("Trip_ID")
+            self.write(pa.Table.from_pandas(frame, schema=_schema(), preserve_index=False),
+                       f"compact-{uuid.uuid4().hex[:8]}")
+            for path in files:
+                os.remove(path)
+            self._touched.discard(directory)
+            compacted += 1
+        self._dataset = None
+        return compacted
+
+    # Reports
+
+    @staticmethod
+    def _time_filter(column, start, end):
+        """Filter on a timestamp column, plus the month partitions it can match"""
+        expression = None
+        if start is not None:
+            start = pd.Timestamp(start)
+            expression = ds.field(column) >= pa.scalar(start.to_pydatetime(), pa.timestamp("s"))
+            if column == "Start_Time":
+                expression &= ds.field("month") >= start.strftime("%Y-%m")
+        if end is not None:
+            end = pd.Timestamp(end)
+            condition = ds.field(column) < pa.scalar(end.to_pydatetime(), pa.timestamp("s"))
+            if column == "Start_Time":
+                condition &= ds.field("month") <= end.strftime("%Y-%m")
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    @staticmethod
+    def _and(*expressions):
+        result = None
+        for expression in expressions:
+            if expression is not None:
+                result = expression if result is None else result & expression
+        return result
+
+    def _count_by(self, group, filter_expression):
+        """Trips per value of ``group`` among the rows matching the filter"""
+        with self._lock:
+            dataset = self.dataset()
+            if dataset is None:
+                return pd.Series(dtype="int64")
+            table = dataset.to_table(columns=[group], filter=filter_expression)
+        if table.num_rows == 0:
+            return pd.Series(dtype="int64")
+        counts = table.group_by(group).aggregate([([], "count_all")]).to_pandas()
+        return counts.set_index(group)["count_all"].astype("int64")
+
+    def station_trip_counts(self, start=None, end=None):
+        """Trips started and ended per station; trips counted by start time in [start, end)"""
+        window = self._time_filter("Start_Time", start, end)
+        started = self._count_by("Start_Station_ID", window)
+        ended = self._count_by("End_Station_ID", window)
+        counts = pd.DataFrame({"Trips_Started": started, "Trips_Ended": ended}).fillna(0).astype("int64")
+        counts.index = counts.index.astype("int64")
+        counts.index.name = "Station_ID"
+        return counts.reset_index()
+
+    def hourly_demand(self, start=None, end=None, station_id=None):
+        """Departures and arrivals per hour of day, for all stations or one"""
+        departures = self._count_by("Start_Hour", self._and(
+            self._time_filter("Start_Time", start, end),
+            None if station_id is None else ds.field("start_station") == int(station_id),
+        ))
+        arrivals = self._count_by("End_Hour", self._and(
+            self._time_filter("End_Time", start, end),
+            None if station_id is None else ds.field("End_Station_ID") == int(station_id),
+        ))
+        hours = pd.DataFrame({"Hour": range(24)})
+        hours["Trips_Started"] = hours["Hour"].map(departures).fillna(0).astype("int64")
+        hours["Trips_Ended"] = hours["Hour"].map(arrivals).fillna(0).astype("int64")
+        return hours
+
+
+class ArchiveExporter:
+    """Runs the model's ``export_trip_archive`` on a background thread"""
+
+    def __init__(self, model, interval=300.0, min_interval=30.0, min_files=8):
+        self.model = model
+        self.interval = interval
+        self.min_interval = min_interval
+        self.min_files = min_files
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.exports = 0
+        self.trips = 0
+        self.compactions = 0
+        self.failures = 0
+
+    def start(self):
+        """Start the export thread"""
+        with self._lock:
+            if self._thread is None and not self._stop.is_set():
+                self._thread = threading.Thread(target=self._run, name="archive-exporter", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def nudge(self):
+        """Export soon (trips were closed), without waiting for the full interval"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            try:
+                self.trips += self.model.export_trip_archive()
+                self.exports += 1
+                self.compactions += self.model.archive.compact(self.min_files, touched_only=True)
+            except Exception:
+                self.failures += 1
+                logger.exception("Exporting trips to the archive failed")
+            # Nudges meanwhile are handled after the pause, in one export
+            self._stop.wait(self.min_interval)
+
+    def stats(self):
+        """Return exports run, trips exported, partitions compacted and failures"""
+        return {"exports": self.exports, "trips": self.trips, "compactions": self.compactions,
+                "failures": self.failures}
+
+    def close(self):
+        """Stop the thread, letting an export in progress finish"""
+        self._stop.set()
+        self._wake.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+
+def _main(argv):
+    import sqlite3
+
+    if len(argv) < 2 or argv[0] not in ("export", "compact", "report"):
+        sys.exit("usage: python -m model.columnar export bysykkel.db archive/ | compact archive/ "
+                 "| report archive/ [start] [end]")
+    command = argv[0]
+    if command == "export":
+        conn = sqlite3.connect(argv[1])
+        try:
+            start = time.perf_counter()
+            exported = TripArchive(argv[2]).export(conn)
+            print(f"Exported {exported} trips in {time.perf_counter() - start:.1f}s")
+        finally:
+            conn.close()
+    elif command == "compact":
+        print(f"Compacted {TripArchive(argv[1]).compact()} partitions")
+    else:
+        archive = TripArchive(argv[1])
+        start, end = (argv[2:4] + [None, None])[:2]
+        print(archive.station_trip_counts(start, end).sort_values("Trips_Started", ascending=False).head(20))
+        print(archive.hourly_demand(start, end))
+
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
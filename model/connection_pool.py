@@ -0,0 +1,172 @@
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from model.metrics import InstrumentedConnection
+from model.search import register_functions
+
+# Pragmas applied once to every new connection. journal_mode=WAL is persistent
+# in the database file, the rest are per-connection settings.
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,  # negative value means KiB, so ~16 MB page cache
+    "temp_store": "MEMORY",
+    "mmap_size": 64 * 1024 * 1024,
+}
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be leased within the timeout"""
+
+
+class ConnectionPool:
+    """A small pool of long-lived SQLite connections.
+
+    Connections are created lazily up to ``size``, configured once with the
+    pragmas above and reused between leases. A thread that already holds a
+    lease gets the same connection back when it asks again, so nested calls
+    (e.g. a controller reading several model methods) share one connection.
+
+    With a ``metrics`` registry the connections record every statement and
+    each lease records how long it waited for a connection. With ``uri``
+    the path is an SQLite URI such as ``file:copy.db?mode=ro``.
+    """
+
+    def __init__(self, db_path, size=5, timeout=5.0, pragmas=None, metrics=None, uri=False):
+        self.db_path = db_path
+        self.uri = uri
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._local = threading.local()
+        self._closed = False
+        self.metrics = metrics
+
+    def _connect(self):
+        """Open a new connection and apply the configured pragmas"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.timeout,
+            check_same_thread=False,  # connections move between threads via the pool
+            factory=sqlite3.Connection if self.metrics is None else InstrumentedConnection,
+            uri=self.uri,
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        # casefold() for the short-term name filters
+        register_functions(conn)
+        if self.metrics is not None:
+            conn.metrics = self.metrics
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn):
+        """Check that a pooled connection is still usable"""
+        try:
+            # Base class execute: the health check is not a query worth recording
+            sqlite3.Connection.execute(conn, "SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn):
+        """Close a connection and free its slot in the pool"""
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def _acquire(self):
+        """Take an idle connection, open a new one or wait for one to be returned"""
+        if self._closed:
+            raise PoolTimeout("Connection pool is closed")
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    try:
+                        return self._connect()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeout(
+                        f"No database connection available after {self.timeout}s "
+                        f"(pool size {self.size})"
+                    )
+            if self._is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def _release(self, conn):
+        """Return a connection to the pool, rolling back any open transaction"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        if self._closed:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Lease a connection for the duration of a ``with`` block"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            # Nested lease on the same thread: hand out the connection we already hold
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        start = time.perf_counter()
+        conn = self._acquire()
+        if self.metrics is not None and self.metrics.enabled:
+            self.metrics.observe_wait(time.perf_counter() - start)
+        self._local.conn = conn
+        self._local.depth = 1
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._local.depth = 0
+            self._release(conn)
+
+    def holds_lease(self):
+        """True if the calling thread currently has a connection leased"""
+        return getattr(self._local, "conn", None) is not None
+
+    def stats(self):
+        """Return the number of open and idle connections"""
+        return {"size": self.size, "open": self._created, "idle": self._idle.qsize()}
+
+    def close(self):
+        """Close all idle connections; leased ones are closed when returned"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
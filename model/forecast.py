@@ -0,0 +1,210 @@
+"""Hourly demand forecasts per station, for rebalancing.
+
+Trained from the ``Station_Hourly_Trips`` rollup (trips started and ended
+per station, date and hour, kept up to date by dropoffs; see
+model/rollups.py) rather than from the Trip table itself.
+
+The model is seasonal by weekday and hour of day. For every station,
+weekday and hour it keeps exponentially weighted sums of departures and
+arrivals, and per station and weekday the weighted number of days seen.
+A day's weight halves every ``half_life_weeks`` weeks, so the forecast
+follows changing demand. The rate is their ratio, shrunk towards the
+station's profile for that hour over the whole week by ``prior_days``
+days, so weekdays with little history (and new stations) don't swing on
+a handful of trips:
+
+    rate[s, d, h] = (sums[s, d, h] + prior_days * profile[s, h]) / (days[s, d] + prior_days)
+
+Training is incremental: ``update`` reads only the days completed since
+the last update, ages the sums to the newest day and adds the new days,
+as array operations over all stations at once. The current day is used
+once it is over. Rollup rows can still land on a day after it was
+trained (trips closed after midnight count on their end day, imports
+correct trips), so the last ``revisit_days`` days are read again on every
+update and replace what was learned from them. Older corrections come in
+with a full retraining, which ``update`` also starts by itself whenever
+the rollups were rebuilt (``Rollup_State`` moved).
+
+    python -m model.forecast [bysykkel.db] [hours]
+"""
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# Day is counted from 1970-01-01 like datetime64[D] (2440587.5 is its julianday)
+HISTORY_QUERY = """
+    SELECT Station_ID, CAST(julianday(Trip_Date) - 2440587.5 AS INTEGER) AS Day,
+           Trip_Hour, Starts, Ends
+    FROM Station_Hourly_Trips
+    WHERE Trip_Date > ? AND Trip_Date < ?
+"""
+
+ROLLUP_STATE_QUERY = "SELECT Last_Trip_ID, Complete FROM Rollup_State WHERE Name = 'trips'"
+
+# No trips yet: sorts after every real day
+NO_DAY = np.iinfo(np.int64).max
+
+
+def weekday(days):
+    """Monday=0 weekday of days since 1970-01-01 (a Thursday)"""
+    return (days + 3) % 7
+
+
+class DemandForecaster:
+    """Seasonal (weekday x hour) departure and arrival rates for every station"""
+
+    def __init__(self, half_life_weeks=4.0, prior_days=2.0, revisit_days=2):
+        self.half_life_weeks = half_life_weeks
+        self.prior_days = prior_days
+        self.revisit_days = revisit_days
+        self.decay_per_day = 0.5 ** (1 / (7 * half_life_weeks))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything learned (the next update retrains from all history)"""
+        with self._lock:
+            self.station_ids = np.zeros(0, dtype=np.int64)
+            self.sums = np.zeros((2, 0, 7, 24))  # departures, arrivals
+            self.days = np.zeros((0, 7))
+            self.first_day = np.zeros(0, dtype=np.int64)
+            self.last_day = None  # newest day trained, the reference for the weights
+            self.updated_for = None  # date of the last update() call
+            self.rollup_state = None  # Rollup_State row the model was trained from
+            self._recent = None  # rollup rows of the last revisit_days days trained
+
+    def is_due(self, today=None):
+        """True if a day may have completed since the last update"""
+        return self.updated_for != pd.Timestamp(today if today is not None else pd.Timestamp.now()).normalize()
+
+    def _add_stations(self, station_ids):
+        """Grow the arrays to include ``station_ids`` (kept sorted)"""
+        merged = np.union1d(self.station_ids, station_ids).astype(np.int64)
+        if len(merged) == len(self.station_ids):
+            return
+        rows = np.searchsorted(merged, self.station_ids)
+        sums = np.zeros((2, len(merged), 7, 24))
+        days = np.zeros((len(merged), 7))
+        first_day = np.full(len(merged), NO_DAY, dtype=np.int64)
+        sums[:, rows], days[rows], first_day[rows] = self.sums, self.days, self.first_day
+        self.station_ids, self.sums, self.days, self.first_day = merged, sums, days, first_day
+
+    def _fold(self, history, newest):
+        """Weighted departure and arrival sums of rollup rows, relative to ``newest``"""
+        day = history["Day"].to_numpy(dtype=np.int64)
+        rows = np.searchsorted(self.station_ids, history["Station_ID"].to_numpy())
+        weight = self.decay_per_day ** (newest - day)
+        cells = (rows * 7 + weekday(day)) * 24 + history["Trip_Hour"].to_numpy()
+        size = len(self.station_ids) * 7 * 24
+        return np.stack([
+            np.bincount(cells, weights=history[column].to_numpy() * weight, minlength=size).reshape(-1, 7, 24)
+            for column in ("Starts", "Ends")
+        ])
+
+    def _day_weights(self, first_day, newest):
+        """Weighted number of days per station and weekday, from its first day through ``newest``"""
+        days = np.zeros((len(first_day), 7))
+        known = first_day != NO_DAY
+        if not known.any():
+            return days
+        calendar = np.arange(first_day[known].min(), newest + 1)
+        calendar_weight = self.decay_per_day ** (newest - calendar)
+        for day_of_week in range(7):
+            on_day = weekday(calendar) == day_of_week
+            # Weight of the days on or after each index: reversed cumulative sum
+            after_index = np.append(np.cumsum(calendar_weight[on_day][::-1])[::-1], 0.0)
+            days[:, day_of_week] = after_index[np.searchsorted(calendar[on_day], first_day)]
+        return days
+
+    def update(self, conn, today=None):
+        """Train on the days completed since the last update; returns the number of days added"""
+        today = pd.Timestamp(today if today is not None else pd.Timestamp.now()).normalize()
+        rollup_state = conn.execute(ROLLUP_STATE_QUERY).fetchone()
+        if self.last_day is not None and rollup_state != self.rollup_state:
+            # Rebuilt (or being rebuilt) rollups: what was learned may not match them
+            self.reset()
+        with self._lock:
+            previous = self.last_day
+            # The last revisit_days days trained are read again
+            after = "" if previous is None else str(np.datetime64(previous - self.revisit_days, "D"))
+            history = pd.read_sql_query(HISTORY_QUERY, conn, params=(after, str(today.date())))
+            stations = pd.read_sql_query("SELECT Station_ID FROM Station", conn)["Station_ID"]
+            self.updated_for = today
+            self.rollup_state = rollup_state
+            self._add_stations(np.union1d(stations.to_numpy(), history["Station_ID"].to_numpy()))
+            if history.empty and previous is None:
+                return 0
+
+            day = history["Day"].to_numpy(dtype=np.int64)
+            newest = max(int(day.max()) if len(day) else previous, previous if previous is not None else 0)
+            # Age what was learned so far to the newest day, then swap the old
+            # rows of the revisited days for the ones just read. New arrays, not
+            # in place, so rates() never sees a half-updated model
+            decay = 1.0 if previous is None else self.decay_per_day ** (newest - previous)
+            sums = self.sums * decay
+            if self._recent is not None and not self._recent.empty:
+                sums -= self._fold(self._recent, newest)
+            if not history.empty:
+                sums += self._fold(history, newest)
+            np.maximum(sums, 0.0, out=sums)  # rounding left over from the subtraction
+
+            # A station's days count from its first day with trips, quiet days included
+            first_day = self.first_day.copy()
+            if not history.empty:
+                rows = np.searchsorted(self.station_ids, history["Station_ID"].to_numpy())
+                first = history.groupby(rows)["Day"].min()
+                first_day[first.index] = np.minimum(first_day[first.index], first.to_numpy())
+
+            self._recent = history[history["Day"] > newest - self.revisit_days]
+            self.sums, self.days, self.first_day = sums, self._day_weights(first_day, newest), first_day
+            self.last_day = newest
+            return newest - previous if previous is not None else newest - int(day.min()) + 1
+
+    def rates(self):
+        """Station ids and their departure and arrival rates, shape (2, stations, 7 weekdays, 24 hours)"""
+        with self._lock:
+            station_ids, sums, days = self.station_ids, self.sums, self.days
+        total_days = days.sum(axis=1)[None, :, None]
+        profile = np.divide(sums.sum(axis=2), total_days, out=np.zeros((2, len(days), 24)), where=total_days > 0)
+        return station_ids, (sums + self.prior_days * profile[:, :, None, :]) / (days[None, :, :, None] + self.prior_days)
+
+    def predict(self, start=None, hours=24):
+        """Expected departures and arrivals per station for each hour from ``start`` (default: this hour)"""
+        start = pd.Timestamp(start if start is not None else pd.Timestamp.now()).floor("h")
+        times = pd.date_range(start, periods=hours, freq="h")
+        days = times.to_numpy().astype("datetime64[D]").astype(np.int64)
+        station_ids, rates = self.rates()
+        rate = rates[:, :, weekday(days), times.hour.to_numpy()]  # (2, stations, hours)
+        return pd.DataFrame({
+            "Station_ID": np.repeat(station_ids, len(times)),
+            "Time": np.tile(times.to_numpy(), len(station_ids)),
+            "Departures": rate[0].ravel(),
+            "Arrivals": rate[1].ravel(),
+        })
+
+
+def _main(argv):
+    db_path = argv[0] if argv else "bysykkel.db"
+    hours = int(argv[1]) if len(argv) > 1 else 24
+    forecaster = DemandForecaster()
+    conn = sqlite3.connect(db_path)
+    try:
+        start = time.perf_counter()
+        days = forecaster.update(conn)
+        print(f"Trained on {days} days for {len(forecaster.station_ids)} stations "
+              f"in {time.perf_counter() - start:.2f}s")
+    finally:
+        conn.close()
+    forecast = forecaster.predict(hours=hours)
+    totals = forecast.groupby("Station_ID")[["Departures", "Arrivals"]].sum()
+    totals["Net"] = totals["Arrivals"] - totals["Departures"]
+    print(f"Next {hours} hours, stations losing the most bikes:")
+    print(totals.sort_values("Net").head(10).round(1))
+
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -0,0 +1,119 @@
+"""Nearest-station lookup on station coordinates.
+
+``StationGrid`` buckets the stations into a uniform latitude/longitude grid.
+A query only looks at the cells around the point, ring by ring, and stops
+once the k-th best station is closer than anything outside the rings
+searched so far. Distances are great-circle (haversine) distances computed
+with numpy over the candidate stations at once.
+
+The grid is immutable; ``BysykkelModel.station_index()`` builds one from
+the current stations and caches it until Station or Bike changes.
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km; any argument may be an array"""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class StationGrid:
+    """Grid index over stations for k-nearest queries.
+
+    ``stations`` needs Station_ID, Station_Name, Latitude, Longitude and
+    Parked_Bikes columns; stations without coordinates are left out.
+    """
+
+    def __init__(self, stations, cell_deg=0.01):
+        stations = stations.dropna(subset=["Latitude", "Longitude"]).reset_index(drop=True)
+        self.stations = stations
+        self.cell_deg = cell_deg
+        self._lat = stations["Latitude"].to_numpy(dtype=float)
+        self._lon = stations["Longitude"].to_numpy(dtype=float)
+        self._bikes = stations["Parked_Bikes"].to_numpy()
+
+        rows = np.floor(self._lat / cell_deg).astype(np.int64)
+        cols = np.floor(self._lon / cell_deg).astype(np.int64)
+        self._cells = {}
+        for position, cell in enumerate(zip(rows.tolist(), cols.tolist())):
+            self._cells.setdefault(cell, []).append(position)
+        self._cells = {cell: np.array(positions) for cell, positions in self._cells.items()}
+        if len(stations):
+            self._row_range = (rows.min(), rows.max())
+            self._col_range = (cols.min(), cols.max())
+
+    def __len__(self):
+        return len(self.stations)
+
+    def _ring(self, row, col, radius):
+        """Station positions in the cells exactly ``radius`` cells from (row, col)"""
+        if radius == 0:
+            cells = [(row, col)]
+        else:
+            cells = [(row + dr, col + dc)
+                     for dr in range(-radius, radius + 1)
+                     for dc in (range(-radius, radius + 1) if abs(dr) == radius else (-radius, radius))]
+        found = [self._cells[cell] for cell in cells if cell in self._cells]
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def _covered_km(self, lat, radius):
+        """Lower bound on the distance to any station outside rings 0..``radius``"""
+        if radius == 0:
+            return 0.0
+        # Longitude cells are narrowest at the latitude farthest from the equator
+        widest_lat = min(abs(lat) + (radius + 1) * self.cell_deg, 90.0)
+        shrink = math.cos(math.radians(widest_lat))
+        return radius * self.cell_deg * KM_PER_DEGREE * shrink
+
+    def nearest(self, lat, lon, k=5, min_available_bikes=0):
+        """The k closest stations with at least ``min_available_bikes`` parked bikes.
+
+        Returns the station rows plus a Distance_km column, closest first.
+        """
+        if not len(self) or k <= 0:
+            return self.stations.head(0).assign(Distance_km=pd.Series(dtype=float))
+
+        row = math.floor(lat / self.cell_deg)
+        col = math.floor(lon / self.cell_deg)
+        # Rings needed to reach every cell from the query cell
+        max_radius = max(abs(row - self._row_range[0]), abs(row - self._row_range[1]),
+                         abs(col - self._col_range[0]), abs(col - self._col_range[1]))
+
+        positions = []
+        distances = []
+        radius = 0
+        while radius <= max_radius:
+            if (2 * radius + 1) ** 2 > 4 * len(self._cells):
+                # Far from the stations (or a sparse grid): walking empty
+                # cells costs more than measuring every station
+                positions = [np.flatnonzero(self._bikes >= min_available_bikes)]
+                distances = [haversine_km(lat, lon, self._lat[positions[0]], self._lon[positions[0]])]
+                break
+            ring = self._ring(row, col, radius)
+            ring = ring[self._bikes[ring] >= min_available_bikes]
+            if len(ring):
+                positions.append(ring)
+                distances.append(haversine_km(lat, lon, self._lat[ring], self._lon[ring]))
+            found = sum(len(p) for p in positions)
+            # Done once k stations are closer than anything not searched yet
+            if found >= k and np.partition(np.concatenate(distances), k - 1)[k - 1] <= self._covered_km(lat, radius):
+                break
+            radius += 1
+
+        if not positions:
+            return self.stations.head(0).assign(Distance_km=pd.Series(dtype=float))
+        positions = np.concatenate(positions)
+        distances = np.concatenate(distances)
+        order = np.argsort(distances, kind="stable")[:k]
+        result = self.stations.iloc[positions[order]].copy()
+        result["Distance_km"] = distances[order]
+        return result.reset_index(drop=True)
@@ -0,0 +1,534 @@
+"""Per-query instrumentation for the model layer.
+
+Pooled connections are ``InstrumentedConnection`` objects: every statement
+run through them (``conn.execute``, cursors, ``pd.read_sql_query``) is
+timed from execute to the last fetched row, its rows are counted and the
+first time a statement is seen its ``EXPLAIN QUERY PLAN`` is stored, with
+full table scans flagged. Statements are attributed to the innermost
+model/controller method running on the thread (see ``instrumented``), and
+the pool reports how long each lease waited for a connection.
+
+Everything is aggregated in a ``MetricsRegistry`` in the process:
+``statements()``/``methods()`` for the Diagnostics tab and
+``render_prometheus()`` for scraping. Configure with environment variables
+or by passing a registry to the model. Instrumentation costs every
+statement some time (a checkout + dropoff cycle ~25%), so it is off
+unless asked for; the app turns it on for the Diagnostics tab and the
+metrics port:
+
+    BYSYKKEL_METRICS=1          turn instrumentation on
+    BYSYKKEL_EXPLAIN=1          also collect query plans
+    BYSYKKEL_METRICS_PORT=9115  serve /metrics on this port (see app.py)
+
+    python -m model.metrics bysykkel.db     print the plans of the model's queries
+"""
+import hashlib
+import inspect
+import re
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from model.tracing import _env_flag, logger
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Only these statements get a query plan
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+# Distinct (method, statement) series kept before new ones are lumped together
+MAX_SERIES = 1000
+
+
+class Histogram:
+    """Cumulative latency histogram with count, sum and max"""
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (max for the last bucket)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class StatementStats:
+    """Aggregates for one statement run by one method"""
+
+    __slots__ = ("latency", "rows", "errors")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+        self.errors = 0
+
+
+class Plan:
+    """EXPLAIN QUERY PLAN of a statement"""
+
+    __slots__ = ("details", "full_scans")
+
+    def __init__(self, details):
+        self.details = details
+        # "SCAN t" without an index is a full scan; virtual tables (FTS),
+        # subquery results and constant rows are not tables
+        self.full_scans = [
+            detail[5:] for detail in details
+            if detail.startswith("SCAN ") and " USING " not in detail
+            and "VIRTUAL TABLE" not in detail and not detail.startswith(("SCAN (", "SCAN CONSTANT ROW"))
+        ]
+
+
+def normalize(sql):
+    """Collapse whitespace and placeholder lists so equal statements share one key"""
+    sql = " ".join(sql.split())
+    return re.sub(r"\?(?:\s*,\s*\?)+", "?, ...", sql)
+
+
+def statement_id(sql):
+    """Short stable id of a normalized statement, used as metric label"""
+    return hashlib.sha1(sql.encode("utf-8")).hexdigest()[:10]
+
+
+class MetricsRegistry:
+    """In-process store of query, method and connection-wait metrics"""
+
+    def __init__(self, enabled=None, explain=None):
+        self.enabled = _env_flag("BYSYKKEL_METRICS") if enabled is None else enabled
+        self.explain = _env_flag("BYSYKKEL_EXPLAIN") if explain is None else explain
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._normalized = {}  # raw sql -> normalized sql
+        self._statements = {}  # (method, sql) -> StatementStats
+        self._plans = {}  # sql -> Plan, or None if it couldn't be explained
+        self._methods = {}  # method -> Histogram
+        self._wait = Histogram()
+        self._collectors = []
+        self._server = None
+        self.started = time.time()
+
+    # Attribution
+
+    @contextmanager
+    def operation(self, name):
+        """Attribute the statements run inside the block to ``name``"""
+        if not self.enabled:
+            yield
+            return
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                histogram = self._methods.get(name)
+                if histogram is None:
+                    histogram = self._methods[name] = Histogram()
+                histogram.observe(elapsed)
+
+    def current_operation(self):
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else ""
+
+    # Recording
+
+    def observe_wait(self, seconds):
+        """Record how long a lease waited for a pooled connection"""
+        with self._lock:
+            self._wait.observe(seconds)
+
+    def _key(self, sql):
+        normalized = self._normalized.get(sql)
+        if normalized is None:
+            normalized = normalize(sql)
+            if len(self._normalized) < MAX_SERIES * 4:
+                self._normalized[sql] = normalized
+        return normalized
+
+    def needs_plan(self, sql):
+        """True if ``sql`` should be explained (first run of an explainable statement)"""
+        if not self.explain:
+            return False
+        key = self._key(sql)
+        return key not in self._plans and key.lstrip("( ").upper().startswith(EXPLAINABLE)
+
+    def record_plan(self, conn, sql, params):
+        """Store the EXPLAIN QUERY PLAN of ``sql`` run with ``params`` on ``conn``"""
+        key = self._key(sql)
+        try:
+            # The base class execute, so explaining isn't itself instrumented
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            plan = Plan([row[3] for row in rows])
+        except sqlite3.Error as e:
+            logger.debug("Could not explain %s: %s", key, e)
+            plan = None
+        with self._lock:
+            if len(self._plans) < MAX_SERIES:
+                self._plans[key] = plan
+
+    def observe_statement(self, sql, seconds, rows, error=False):
+        """Record one run of ``sql``"""
+        key = (self.current_operation(), self._key(sql))
+        with self._lock:
+            stats = self._statements.get(key)
+            if stats is None:
+                if len(self._statements) >= MAX_SERIES:
+                    key = (key[0], "(other statements)")
+                    stats = self._statements.get(key)
+                if stats is None:
+                    stats = self._statements[key] = StatementStats()
+            stats.latency.observe(seconds)
+            stats.rows += rows
+            if error:
+                stats.errors += 1
+
+    def add_collector(self, collect):
+        """Register ``collect()`` returning (name, help, [(labels, value), ...]) gauges for the export"""
+        self._collectors.append(collect)
+
+    def reset(self):
+        """Forget everything recorded so far (query plans are kept)"""
+        with self._lock:
+            self._statements.clear()
+            self._methods.clear()
+            self._wait = Histogram()
+            self.started = time.time()
+
+    # Reading
+
+    def statements(self):
+        """One dict per (method, statement), most total time first"""
+        with self._lock:
+            items = list(self._statements.items())
+            plans = dict(self._plans)
+        result = []
+        for (method, sql), stats in items:
+            plan = plans.get(sql)
+            latency = stats.latency
+            result.append({
+                "method": method,
+                "statement": statement_id(sql),
+                "calls": latency.count,
+                "total_ms": latency.total * 1000,
+                "mean_ms": latency.total / latency.count * 1000 if latency.count else 0.0,
+                "p95_ms": latency.quantile(0.95) * 1000,
+                "max_ms": latency.max * 1000,
+                "rows": stats.rows,
+                "errors": stats.errors,
+                "full_scan": ", ".join(plan.full_scans) if plan else "",
+                "sql": sql,
+                "plan": "\n".join(plan.details) if plan else "",
+            })
+        result.sort(key=lambda row: row["total_ms"], reverse=True)
+        return result
+
+    def methods(self):
+        """One dict per instrumented method, most total time first"""
+        with self._lock:
+            items = [(name, h.count, h.total, h.quantile(0.95), h.max) for name, h in self._methods.items()]
+        result = [
+            {"method": name, "calls": count, "total_ms": total * 1000,
+             "mean_ms": total / count * 1000 if count else 0.0, "p95_ms": p95 * 1000, "max_ms": peak * 1000}
+            for name, count, total, p95, peak in items
+        ]
+        result.sort(key=lambda row: row["total_ms"], reverse=True)
+        return result
+
+    def connection_wait(self):
+        """Lease count and wait times in ms"""
+        with self._lock:
+            wait = self._wait
+            return {"leases": wait.count, "total_ms": wait.total * 1000,
+                    "p95_ms": wait.quantile(0.95) * 1000, "max_ms": wait.max * 1000}
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            statements = [(key, stats.latency, stats.rows, stats.errors) for key, stats in self._statements.items()]
+            methods = list(self._methods.items())
+            wait = self._wait
+            plans = dict(self._plans)
+
+        _histogram(lines, "bysykkel_query_duration_seconds",
+                   "Time from execute to the last fetched row of SQL statements",
+                   [({"method": method, "statement": statement_id(sql)}, latency)
+                    for (method, sql), latency, _, _ in statements])
+        _counter(lines, "bysykkel_query_rows_total", "Rows returned (or changed, for writes) by SQL statements",
+                 [({"method": method, "statement": statement_id(sql)}, rows)
+                  for (method, sql), _, rows, _ in statements])
+        _counter(lines, "bysykkel_query_errors_total", "SQL statements that raised an error",
+                 [({"method": method, "statement": statement_id(sql)}, errors)
+                  for (method, sql), _, _, errors in statements])
+        explained = [(sql, plan) for sql, plan in plans.items() if plan is not None]
+        _gauge(lines, "bysykkel_query_full_scan", "1 if the statement's query plan scans a whole table",
+               [({"statement": statement_id(sql)}, int(bool(plan.full_scans))) for sql, plan in explained])
+        _gauge(lines, "bysykkel_statement_info", "Normalized SQL text of each statement id",
+               [({"statement": statement_id(sql), "sql": sql[:500]}, 1) for sql, _ in explained])
+        _histogram(lines, "bysykkel_method_duration_seconds", "Duration of model and controller methods",
+                   [({"method": name}, histogram) for name, histogram in methods])
+        _histogram(lines, "bysykkel_connection_wait_seconds", "Time spent waiting for a pooled connection",
+                   [({}, wait)])
+        for collect in self._collectors:
+            try:
+                for name, help_text, samples in collect():
+                    _gauge(lines, name, help_text, samples)
+            except Exception:
+                logger.exception("Metrics collector failed")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve ``render_prometheus()`` at http://host:port/metrics on a daemon thread"""
+        if self._server is not None:
+            return self._server
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("metrics: " + format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        return self._server
+
+
+def _labels(labels, extra=None):
+    items = list(labels.items()) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+
+def _histogram(lines, name, help_text, series):
+    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, histogram in series:
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(labels, {'le': bound})} {cumulative}")
+        lines.append(f"{name}_bucket{_labels(labels, {'le': '+Inf'})} {histogram.count}")
+        lines.append(f"{name}_sum{_labels(labels)} {histogram.total:.6f}")
+        lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+
+
+def _counter(lines, name, help_text, series):
+    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+    lines += [f"{name}{_labels(labels)} {value}" for labels, value in series]
+
+
+def _gauge(lines, name, help_text, series):
+    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    lines += [f"{name}{_labels(labels)} {value}" for labels, value in series]
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports each statement to the connection's registry.
+
+    A statement is timed from ``execute`` until its last row is fetched
+    (or the cursor runs another statement, is closed or goes away).
+    """
+
+    _pending = None  # [sql, start, rows] of the statement being fetched
+
+    def _begin(self, sql, params):
+        self._finish()
+        metrics = self.connection.metrics
+        if metrics is None or not metrics.enabled:
+            return None
+        if metrics.needs_plan(sql):
+            metrics.record_plan(self.connection, sql, params)
+        self._pending = [sql, time.perf_counter(), 0]
+        return metrics
+
+    def _finish(self, error=False):
+        pending = self._pending
+        if pending is None:
+            return
+        self._pending = None
+        sql, start, rows = pending
+        if not self.description and self.rowcount > 0:
+            rows = self.rowcount  # a write: count the rows it changed
+        self.connection.metrics.observe_statement(sql, time.perf_counter() - start, rows, error)
+
+    def execute(self, sql, parameters=()):
+        self._begin(sql, parameters)
+        try:
+            super().execute(sql, parameters)
+        except Exception:
+            self._finish(error=True)
+            raise
+        if not self.description:
+            self._finish()  # nothing to fetch
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        if isinstance(seq_of_parameters, (list, tuple)):
+            # Only a materialized sequence can be peeked at for the plan
+            self._begin(sql, seq_of_parameters[0] if seq_of_parameters else ())
+        else:
+            self._finish()
+            metrics = self.connection.metrics
+            if metrics is not None and metrics.enabled:
+                self._pending = [sql, time.perf_counter(), 0]
+        try:
+            super().executemany(sql, seq_of_parameters)
+        except Exception:
+            self._finish(error=True)
+            raise
+        self._finish()
+        return self
+
+    def fetchone(self):
+        row = super().fetchone()
+        if self._pending is not None:
+            if row is None:
+                self._finish()
+            else:
+                self._pending[2] += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if self._pending is not None:
+            self._pending[2] += len(rows)
+            if not rows or len(rows) < (self.arraysize if size is None else size):
+                self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if self._pending is not None:
+            self._pending[2] += len(rows)
+            self._finish()
+        return rows
+
+    def __next__(self):
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._finish()
+            raise
+        if self._pending is not None:
+            self._pending[2] += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # A result that was only partly read (fetch_value etc.) ends here
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose statements are recorded in ``metrics``"""
+
+    metrics = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # The shortcuts on sqlite3.Connection bypass cursor(), so route them through it
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def instrumented(skip=()):
+    """Time every public method of the class and attribute its queries to it.
+
+    The instance needs a ``metrics`` attribute (a MetricsRegistry or None).
+    Methods in ``skip`` and generator/context-manager helpers are left alone.
+    """
+    def decorator(cls):
+        for name, func in list(vars(cls).items()):
+            if name.startswith("_") or name in skip or not inspect.isfunction(func):
+                continue
+            setattr(cls, name, _timed(f"{cls.__name__}.{name}", func))
+        return cls
+    return decorator
+
+
+def _timed(label, func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        metrics = self.metrics
+        if metrics is None or not metrics.enabled:
+            return func(self, *args, **kwargs)
+        with metrics.operation(label):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+def explain_model_queries(db_path):
+    """Run the model's read methods once and return their statements with plans"""
+    from controller.controller import BysykkelController
+    from model.model import BysykkelModel
+
+    model = BysykkelModel(db_path, metrics=MetricsRegistry(enabled=True, explain=True))
+    try:
+        BysykkelController(model).get_snapshot()
+        return model.metrics.statements()
+    finally:
+        model.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: python -m model.metrics bysykkel.db")
+    for row in explain_model_queries(sys.argv[1]):
+        flag = f"  FULL SCAN: {row['full_scan']}" if row["full_scan"] else ""
+        print(f"{row['method']} [{row['statement']}] {row['mean_ms']:.2f} ms, {row['rows']} rows{flag}")
+        print(f"    {row['sql'][:200]}")
+        for line in row["plan"].splitlines():
+            print(f"      {line}")
@@ -0,0 +1,147 @@
+"""Versioned schema migrations for the Bysykkel database.
+
+The current version is stored in SQLite's ``PRAGMA user_version``. Each
+migration runs once, in order, inside its own transaction. Run them at
+startup with ``migrate(conn)`` (``BysykkelModel.migrate()`` does this for the
+app) or from the command line:
+
+    python -m model.migrations [bysykkel.db]
+"""
+import sqlite3
+import sys
+from model import availability, columnar, rollups, search
+
+# (version, description, statements)
+MIGRATIONS = [
+    (1, "Indexes for the hot Trip/Bike/Station queries", [
+        # Active trips: get_active_trips, get_users_with_active_trips and the
+        # checkout/dropoff lookups only ever look at trips without an end time
+        """
+        CREATE INDEX IF NOT EXISTS idx_trip_active_user
+        ON Trip(User_ID, Bike_ID) WHERE End_Time IS NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_trip_active_start
+        ON Trip(Start_Time) WHERE End_Time IS NULL
+        """,
+        # get_station_trips_count joins Station to Trip on End_Station_ID
+        "CREATE INDEX IF NOT EXISTS idx_trip_end_station ON Trip(End_Station_ID)",
+        "CREATE INDEX IF NOT EXISTS idx_trip_start_station ON Trip(Start_Station_ID)",
+        # get_bikes_at_stations / get_filtered_bikes_at_stations
+        """
+        CREATE INDEX IF NOT EXISTS idx_bike_parked_station
+        ON Bike(Last_Station, Bike_Name) WHERE Current_Status = 'Parked'
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_bike_status ON Bike(Current_Status, Last_Station)",
+        # Sorted listings and GROUP BY
+        "CREATE INDEX IF NOT EXISTS idx_user_name ON User(User_Name)",
+        "CREATE INDEX IF NOT EXISTS idx_station_name ON Station(Station_Name)",
+        "CREATE INDEX IF NOT EXISTS idx_subscription_type ON Subscription(Type)",
+    ]),
+    (2, "Checkpoints for incremental CSV imports", [
+        # One row per source file: how far it has been applied and a hash of
+        # the bytes just before that point, used to detect rewritten files
+        """
+        CREATE TABLE IF NOT EXISTS Import_Checkpoint (
+            Source_File TEXT PRIMARY KEY,
+            Byte_Offset INTEGER NOT NULL,
+            Tail_Hash TEXT,
+            Max_Trip_ID INTEGER,
+            Rows_Imported INTEGER NOT NULL DEFAULT 0,
+            Updated_At TEXT
+        )
+        """,
+    ]),
+    (3, "Materialized station availability maintained by triggers", [
+        *availability.TRIGGERS,
+        # Start the counters from the actual bike positions
+        availability.RECONCILE,
+    ]),
+    (4, "Trip statistics rollups for the Analysis tab", [
+        *rollups.TABLES,
+        *rollups.INITIAL_FILL,
+    ]),
+    (5, "Indexes for keyset pagination", [
+        # (User_Name, User_ID) and (Bike_Name, Bike_ID) page order; the rowid
+        # is implicitly the last column of every index
+        "CREATE INDEX IF NOT EXISTS idx_bike_name ON Bike(Bike_Name)",
+    ]),
+    (6, "Trigram search indexes on user, station and bike names", [
+        *search.TABLES,
+        *search.TRIGGERS,
+        *search.REBUILD,
+    ]),
+    (7, "Queue of closed trips for the columnar trip archive", [
+        *columnar.TABLES,
+        *columnar.TRIGGERS,
+        *columnar.INITIAL_QUEUE,
+    ]),
+    (8, "Trips per station and hour of day over all days", [
+        *rollups.HOUR_TOTALS_FILL,
+    ]),
+    (9, "Indexes for trip reports over a time window", [
+        # get_station_trips_report / get_hourly_demand_report without an archive:
+        # closed trips by start (or end) time, covering every column they read
+        """
+        CREATE INDEX IF NOT EXISTS idx_trip_closed_start
+        ON Trip(Start_Time, Start_Station_ID, End_Station_ID, End_Time) WHERE End_Time IS NOT NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_trip_closed_end
+        ON Trip(End_Time, End_Station_ID) WHERE End_Time IS NOT NULL
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn):
+    """Return the schema version stored in the database"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, target=None, analyze=True):
+    """Apply all pending migrations up to ``target`` and return the applied versions"""
+    target = LATEST_VERSION if target is None else target
+    current = get_version(conn)
+    applied = []
+
+    for version, description, statements in MIGRATIONS:
+        if version <= current or version > target:
+            continue
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # Re-check inside the write lock in case another process migrated first
+            if get_version(conn) >= version:
+                conn.rollback()
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            # PRAGMA does not accept bound parameters; version is an int from MIGRATIONS
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+            applied.append(version)
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    # Refresh planner statistics so the new indexes are actually picked
+    if applied and analyze:
+        conn.execute("ANALYZE")
+        conn.commit()
+
+    return applied
+
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "bysykkel.db"
+    conn = sqlite3.connect(db_path)
+    try:
+        applied = migrate(conn)
+        if applied:
+            print(f"Applied migrations: {', '.join(str(v) for v in applied)}")
+        else:
+            print(f"Database already at version {get_version(conn)}")
+    finally:
+        conn.close()
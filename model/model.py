@@ -1,347 +1,770 @@
+import random
 import sqlite3
+import threading
+import time
 import pandas as pd
+from contextlib import contextmanager
+from types import MappingProxyType
+from model import availability, columnar, rebalance, rollups, search
+from model.cache import QueryCache, cached, invalidates
+from model.connection_pool import ConnectionPool
+from model.forecast import DemandForecaster
+from model.geo import StationGrid
+from model.metrics import MetricsRegistry, instrumented
+from model.migrations import migrate
+from model.records import TripRef
+from model.replica import ReadReplica
+from model.tracing import Tracer, logger
+from model.write_queue import ComplaintWriter
 
+# Helpers whose queries count towards the model method calling them
+NOT_INSTRUMENTED = (
+    "get_connection", "reading", "read_transaction", "data_version", "close", "fetch_value", "fetch_row",
+    "fetch_rows", "run_write", "execute_write", "cache_stats", "metrics_text",
+)
+
+@instrumented(skip=NOT_INSTRUMENTED)
 class BysykkelModel:
-    def __init__(self, db_path='bysykkel.db'):
+    def __init__(self, db_path='bysykkel.db', pool_size=5, pool_timeout=5.0,
+                 cache_size=256, cache_ttl=60.0, tracer=None, metrics=None, archive_path=None,
+                 archive_interval=300.0, replica_staleness=None, replica_dir=None):
         self.db_path = db_path
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.pool = ConnectionPool(db_path, size=pool_size, timeout=pool_timeout,
+                                   metrics=self.metrics if self.metrics.enabled else None)
+        # PRAGMA data_version of an idle connection changes with every commit made
+        # by any other connection, including other processes: the cache's check.
+        # Commits made by run_write are announced to the cache as its own
+        self._watch = sqlite3.connect(db_path, timeout=pool_timeout, check_same_thread=False)
+        self._watch_lock = threading.Lock()
+        self.cache = QueryCache(max_entries=cache_size, ttl=cache_ttl, version=self.data_version)
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.complaints = ComplaintWriter(self)
+        self.metrics.add_collector(self._collect_metrics)
+        # Historical reports read the Parquet trip archive when there is one;
+        # closed trips are exported to it in the background
+        self.archive = None
+        self.exporter = None
+        if archive_path:
+            if columnar.available():
+                self.archive = columnar.TripArchive(archive_path)
+                self.exporter = columnar.ArchiveExporter(self, interval=archive_interval)
+                self.exporter.start()
+            else:
+                logger.warning("pyarrow is not installed; trip reports will read the database")
+        # Seasonal demand model, trained from the hourly trip rollup on first use
+        self.forecaster = DemandForecaster()
+        # With a staleness bound (seconds) read methods query a snapshot copy
+        self._reads = threading.local()
+        self.replica = None
+        if replica_staleness is not None:
+            self.replica = ReadReplica(self, max_staleness=float(replica_staleness), directory=replica_dir)
+            self.replica.start()
         
     def get_connection(self):
-        """Create and return a database connection"""
-        return sqlite3.connect(self.db_path)
+        """Lease a pooled database connection (use as a context manager).
+
+        Inside read methods the connection goes to the read replica when its
+        snapshot is fresh enough, unless this thread already holds one to the
+        primary (a read inside a write keeps seeing that write).
+        """
+        if self.replica is not None and getattr(self._reads, "depth", 0) and not self.pool.holds_lease():
+            if self.replica.holds_lease() or self.replica.is_fresh():
+                return self.replica.connection()
+            self.replica.fallbacks += 1
+        return self.pool.connection()
+
+    @contextmanager
+    def reading(self):
+        """Mark the calling thread as running a read method (see get_connection)"""
+        self._reads.depth = getattr(self._reads, "depth", 0) + 1
+        try:
+            yield
+        finally:
+            self._reads.depth -= 1
+
+    def data_version(self):
+        """Token that changes whenever anything was committed to the database"""
+        with self._watch_lock:
+            return self._watch.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        """Write queued complaint reports, then close all pooled connections"""
+        self.complaints.close()
+        if self.exporter is not None:
+            self.exporter.close()
+        if self.replica is not None:
+            self.replica.close()
+        self.pool.close()
+        with self._watch_lock:
+            self._watch.close()
+
+    def migrate(self):
+        """Apply pending schema migrations (indexes etc.) and return their versions"""
+        with self.pool.connection() as conn:
+            applied = migrate(conn)
+        if self.replica is not None:
+            # Reads must not hit a snapshot without the new tables
+            self.replica.refresh()
+        return applied
+
+    @contextmanager
+    def read_transaction(self):
+        """Run several reads against one consistent snapshot of the database.
+
+        Model calls made on this thread inside the block reuse the leased
+        connection, so they all see the same committed state.
+        """
+        with self.reading(), self.get_connection() as conn:
+            if conn.in_transaction:
+                # Already inside a transaction on this thread; just join it
+                yield conn
+                return
+            conn.execute("BEGIN")
+            try:
+                if self.replica is not None and self.replica.holds_lease():
+                    # An immutable snapshot; the replica invalidates the cache when it moves on
+                    yield conn
+                    return
+                # Start the snapshot between two equal data versions, so it is exactly
+                # that version; cached results are only used while they are of it too
+                while True:
+                    version = self.data_version()
+                    conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+                    if self.data_version() == version:
+                        break
+                    conn.rollback()
+                    conn.execute("BEGIN")
+                with self.cache.pin(version):
+                    yield conn
+            finally:
+                # Nothing was written, ending the transaction just releases the snapshot
+                conn.rollback()
+
+    def fetch_value(self, query, params=()):
+        """Return the first column of the first row, or None if there is no row"""
+        with self.get_connection() as conn:
+            row = conn.execute(query, params).fetchone()
+            return None if row is None else row[0]
+
+    def fetch_row(self, query, params=(), record=None):
+        """Return the first row as a tuple (or as a ``record`` class), or None"""
+        with self.get_connection() as conn:
+            row = conn.execute(query, params).fetchone()
+            return row if record is None else record.from_row(row)
+
+    def fetch_rows(self, query, params=(), record=None):
+        """Return all rows as tuples (or as ``record`` objects)"""
+        with self.get_connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+            return rows if record is None else [record(*row) for row in rows]
+
+    def run_write(self, work, retries=5):
+        """Run ``work(conn)`` in a short BEGIN IMMEDIATE transaction and commit it.
+
+        The write lock is taken up front, so the checks and writes inside
+        ``work`` can't interleave with another writer. If the database stays
+        locked past the busy timeout the whole transaction is retried with
+        backoff. Returns whatever ``work`` returns.
+        """
+        for attempt in range(retries + 1):
+            with self.pool.connection() as conn:
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    result = work(conn)
+                    with self.cache.committing():
+                        conn.commit()
+                    return result
+                except sqlite3.OperationalError as e:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    message = str(e).lower()
+                    if attempt == retries or ("locked" not in message and "busy" not in message):
+                        raise
+                    logger.warning("Database busy, retrying write (attempt %d of %d)", attempt + 1, retries)
+                except Exception:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    raise
+            time.sleep(0.05 * 2 ** attempt * (1 + random.random()))
+
+    def execute_write(self, query, params=()):
+        """Run one write statement, commit it and return (rowcount, lastrowid)"""
+        def write(conn):
+            cursor = conn.execute(query, params)
+            return cursor.rowcount, cursor.lastrowid
+        return self.run_write(write)
+
+    @invalidates('Station')
+    def reconcile_station_availability(self):
+        """Rebuild Station.Available_Parking from the Bike table; returns stations fixed"""
+        return self.run_write(availability.reconcile)
+
+    @invalidates('Trip')
+    def backfill_trip_rollups(self, batch_size=50000, restart=True):
+        """Rebuild the trip statistics rollups from history, in batches"""
+        with self.pool.connection() as conn:
+            return rollups.backfill(conn, batch_size, restart)
+
+    def cache_stats(self):
+        """Return query cache hit/miss metrics"""
+        return self.cache.stats()
+
+    def metrics_text(self):
+        """Return all query, method, cache and pool metrics in Prometheus text format"""
+        return self.metrics.render_prometheus()
+
+    def _collect_metrics(self):
+        """Cache, pool and complaint writer gauges for the metrics export"""
+        cache = self.cache.stats()
+        pool = self.pool.stats()
+        complaints = self.complaints.stats()
+        metrics = [
+            ("bysykkel_cache_lookups", "Query cache lookups by result",
+             [({"result": "hit"}, cache["hits"]), ({"result": "miss"}, cache["misses"])]),
+            ("bysykkel_cache_entries", "Results in the query cache", [({}, cache["entries"])]),
+            ("bysykkel_pool_connections", "Pooled database connections by state",
+             [({"state": "open"}, pool["open"]), ({"state": "idle"}, pool["idle"])]),
+            ("bysykkel_complaints_queued", "Complaint reports waiting to be written", [({}, complaints["queued"])]),
+        ]
+        if self.replica is not None:
+            replica = self.replica.stats()
+            metrics += [
+                ("bysykkel_replica_age_seconds", "Age of the read replica snapshot",
+                 [({}, replica["age"])] if replica["age"] is not None else []),
+                ("bysykkel_replica_refreshes", "Read replica refreshes by outcome",
+                 [({"outcome": "copied"}, replica["refreshes"]), ({"outcome": "unchanged"}, replica["unchanged"]),
+                  ({"outcome": "failed"}, replica["failures"])]),
+                ("bysykkel_replica_fallbacks", "Reads sent to the primary because the snapshot was too old",
+                 [({}, replica["fallbacks"])]),
+            ]
+        if self.exporter is not None:
+            exporter = self.exporter.stats()
+            metrics += [
+                ("bysykkel_archive_exports", "Trip archive exports by outcome",
+                 [({"outcome": "exported"}, exporter["exports"]), ({"outcome": "failed"}, exporter["failures"])]),
+                ("bysykkel_archive_trips_exported", "Trips written to the archive", [({}, exporter["trips"])]),
+                ("bysykkel_archive_compactions", "Archive partitions compacted", [({}, exporter["compactions"])]),
+            ]
+        return metrics
     
+    @cached('User')
     def get_users_alphabetical(self):
         """Get all users sorted alphabetically by name"""
-        conn = self.get_connection()
-        users = pd.read_sql_query(
-            "SELECT User_ID, User_Name, User_Phone FROM User WHERE User_Name IS NOT NULL AND User_Name != '' ORDER BY User_Name ASC",
-            conn
-        )
-        conn.close()
-        return users
+        with self.get_connection() as conn:
+            users = pd.read_sql_query(
+                "SELECT User_ID, User_Name, User_Phone FROM User WHERE User_Name IS NOT NULL AND User_Name != '' ORDER BY User_Name ASC",
+                conn
+            )
+            return users
     
+    @cached('User')
     def get_users_filtered(self, name_filter):
-        """Get users filtered by name"""
-        conn = self.get_connection()
-        users = pd.read_sql_query(
-            "SELECT User_ID, User_Name, User_Phone FROM User WHERE User_Name LIKE ? ORDER BY User_Name ASC",
-            conn,
-            params=[f'%{name_filter}%']
-        )
-        conn.close()
-        return users
+        """Get users filtered by name, names starting with the filter first"""
+        where, params = search.filter_clause("User", name_filter)
+        with self.get_connection() as conn:
+            users = pd.read_sql_query(
+                f"SELECT User_ID, User_Name, User_Phone FROM User WHERE {where} ORDER BY User_Name ASC",
+                conn,
+                params=params
+            )
+        prefix = users["User_Name"].str.casefold().str.startswith(name_filter.strip().casefold())
+        return users.iloc[(~prefix).argsort(kind="stable")].reset_index(drop=True)
+
+    @cached('User', 'Station', 'Bike')
+    def search_names(self, entity, term, limit=10):
+        """Get the best (id, name) matches for a term in User, Station or Bike, with typo tolerance"""
+        with self.get_connection() as conn:
+            return search.search(conn, entity, term, limit)
     
+    # Id -> name maps for the selectbox labels. Cached like the query
+    # results, so they are built once per change of the table, not per rerun;
+    # they are read-only, so the cache hands out the same map every time.
+
+    @cached('User')
+    def get_user_labels(self):
+        """Get a read-only map of User_ID -> User_Name"""
+        return MappingProxyType(dict(self.fetch_rows("SELECT User_ID, User_Name FROM User")))
+
+    @cached('Station')
+    def get_station_labels(self):
+        """Get a read-only map of Station_ID -> Station_Name"""
+        return MappingProxyType(dict(self.fetch_rows("SELECT Station_ID, Station_Name FROM Station")))
+
+    @cached('Bike')
+    def get_bike_labels(self):
+        """Get a read-only map of Bike_ID -> Bike_Name"""
+        return MappingProxyType(dict(self.fetch_rows("SELECT Bike_ID, Bike_Name FROM Bike")))
+
+    @cached('Bike')
     def get_bikes_with_status(self):
         """Get all bikes with their current status"""
-        conn = self.get_connection()
-        bikes = pd.read_sql_query(
-            "SELECT Bike_ID, Bike_Name, Current_Status FROM Bike WHERE Bike_Name IS NOT NULL AND Bike_Name != ''",
-            conn
-        )
-        conn.close()
-        return bikes
+        with self.get_connection() as conn:
+            bikes = pd.read_sql_query(
+                "SELECT Bike_ID, Bike_Name, Current_Status FROM Bike WHERE Bike_Name IS NOT NULL AND Bike_Name != ''",
+                conn
+            )
+            return bikes
     
+    @cached('Subscription')
     def get_subscription_counts(self):
         """Get count of each subscription type"""
-        conn = self.get_connection()
-        subs = pd.read_sql_query(
-            """
-            SELECT Type AS Type, COUNT(*) AS Purchased
-            FROM Subscription
-            GROUP BY Type
-            ORDER BY Purchased DESC
-            """,
-            conn
-        )
-        conn.close()
-        return subs
+        with self.get_connection() as conn:
+            subs = pd.read_sql_query(
+                """
+                SELECT Type AS Type, COUNT(*) AS Purchased
+                FROM Subscription
+                GROUP BY Type
+                ORDER BY Purchased DESC
+                """,
+                conn
+            )
+            return subs
     
+    @cached('Station', 'Trip')
     def get_station_trips_count(self):
         """Get count of trips ending at each station"""
-        conn = self.get_connection()
-        station_trips = pd.read_sql_query(
-            """
-            SELECT s.Station_ID, s.Station_Name, COUNT(t.Trip_ID) AS Number_of_trips
-            FROM Station s
-            LEFT JOIN Trip t ON s.Station_ID = t.End_Station_ID
-            GROUP BY s.Station_ID, s.Station_Name
-            ORDER BY s.Station_ID
-            """,
-            conn
-        )
-        conn.close()
-        return station_trips
+        with self.get_connection() as conn:
+            station_trips = pd.read_sql_query(
+                """
+                SELECT s.Station_ID, s.Station_Name, COALESCE(r.Trips_Ended, 0) AS Number_of_trips
+                FROM Station s
+                LEFT JOIN Station_Trip_Stats r ON s.Station_ID = r.Station_ID
+                ORDER BY s.Station_ID
+                """,
+                conn
+            )
+            return station_trips
     
+    @cached('Trip')
+    def get_hourly_trip_counts(self, station_id=None):
+        """Get trips started and ended per hour of day, for all stations or one"""
+        query = """
+            SELECT Trip_Hour AS Hour, SUM(Starts) AS Trips_Started, SUM(Ends) AS Trips_Ended
+            FROM Station_Hour_Totals
+        """
+        params = []
+        if station_id is not None:
+            query += " WHERE Station_ID = ?"
+            params.append(int(station_id))
+        query += " GROUP BY Trip_Hour ORDER BY Trip_Hour"
+        with self.get_connection() as conn:
+            return pd.read_sql_query(query, conn, params=params)
+
+    @cached('Bike', 'Trip')
+    def get_bike_usage(self):
+        """Get the number of closed trips per bike, most used first"""
+        with self.get_connection() as conn:
+            return pd.read_sql_query(
+                """
+                SELECT b.Bike_ID, b.Bike_Name, COALESCE(u.Trips, 0) AS Trips
+                FROM Bike b
+                LEFT JOIN Bike_Usage u ON b.Bike_ID = u.Bike_ID
+                ORDER BY Trips DESC, b.Bike_Name
+                """,
+                conn
+            )
+
+    # Historical reports over a time window. With a trip archive they are
+    # answered from its Parquet files (trips exported so far); without one
+    # from the Trip table. Both count closed trips only.
+
+    @invalidates('Trip_Archive')
+    def export_trip_archive(self, batch_size=500_000):
+        """Append the trips closed since the last export to the archive; returns trips exported"""
+        if self.archive is None:
+            raise RuntimeError("No trip archive configured")
+        with self.pool.connection() as conn:
+            def commit():
+                with self.cache.committing():
+                    conn.commit()
+            return self.archive.export(conn, batch_size, commit)
+
+    @staticmethod
+    def _window(column, start, end):
+        """SQL condition (and params) for ``column`` in [start, end)"""
+        where, params = "", []
+        if start is not None:
+            where += f" AND {column} >= ?"
+            params.append(pd.Timestamp(start).strftime("%Y-%m-%d %H:%M:%S"))
+        if end is not None:
+            where += f" AND {column} < ?"
+            params.append(pd.Timestamp(end).strftime("%Y-%m-%d %H:%M:%S"))
+        return where, params
+
+    @cached('Trip_Archive', 'Trip', 'Station')
+    def get_station_trips_report(self, start=None, end=None):
+        """Get trips started and ended per station, for trips starting in [start, end)"""
+        if self.archive is not None:
+            counts = self.archive.station_trip_counts(start, end)
+        else:
+            window, params = self._window("Start_Time", start, end)
+            with self.get_connection() as conn:
+                counts = pd.read_sql_query(
+                    f"""
+                    SELECT Station_ID, SUM(Started) AS Trips_Started, SUM(Ended) AS Trips_Ended
+                    FROM (
+                        SELECT Start_Station_ID AS Station_ID, COUNT(*) AS Started, 0 AS Ended
+                        FROM Trip WHERE End_Time IS NOT NULL {window} GROUP BY Start_Station_ID
+                        UNION ALL
+                        SELECT End_Station_ID, 0, COUNT(*)
+                        FROM Trip WHERE End_Time IS NOT NULL {window} GROUP BY End_Station_ID
+                    )
+                    WHERE Station_ID IS NOT NULL
+                    GROUP BY Station_ID
+                    """,
+                    conn,
+                    params=params + params
+                )
+        stations = self.get_all_stations()
+        report = stations.merge(counts, on="Station_ID", how="left")
+        report[["Trips_Started", "Trips_Ended"]] = report[["Trips_Started", "Trips_Ended"]].fillna(0).astype("int64")
+        return report.sort_values("Station_ID").reset_index(drop=True)
+
+    @cached('Trip_Archive', 'Trip')
+    def get_hourly_demand_report(self, start=None, end=None, station_id=None):
+        """Get departures and arrivals per hour of day in [start, end), for all stations or one"""
+        if self.archive is not None:
+            return self.archive.hourly_demand(start, end, station_id)
+        queries = []
+        for column, station_column in (("Start_Time", "Start_Station_ID"), ("End_Time", "End_Station_ID")):
+            where, params = self._window(column, start, end)
+            if station_id is not None:
+                where += f" AND {station_column} = ?"
+                params.append(int(station_id))
+            queries.append((
+                f"SELECT CAST(strftime('%H', {column}) AS INTEGER) AS Hour, COUNT(*) AS Trips "
+                f"FROM Trip WHERE End_Time IS NOT NULL {where} GROUP BY Hour",
+                params
+            ))
+        hours = pd.DataFrame({"Hour": range(24)})
+        with self.get_connection() as conn:
+            for name, (query, params) in zip(("Trips_Started", "Trips_Ended"), queries):
+                counts = pd.read_sql_query(query, conn, params=params).set_index("Hour")["Trips"]
+                hours[name] = hours["Hour"].map(counts).fillna(0).astype("int64")
+        return hours
+
+    @invalidates('Forecast')
+    def train_demand_forecast(self, full=False):
+        """Train the demand forecast on the days completed since it was last trained; returns days added"""
+        if full:
+            self.forecaster.reset()
+        # Reads the whole rollup the first time; the replica serves it when there is one
+        with self.reading(), self.get_connection() as conn:
+            return self.forecaster.update(conn)
+
+    def get_demand_forecast(self, start=None, hours=24):
+        """Get expected departures and arrivals per station and hour, for ``hours`` hours from ``start`` (default: now)"""
+        if self.forecaster.is_due():
+            # Once a day: fold in yesterday's trips
+            self.train_demand_forecast()
+        start = pd.Timestamp(start if start is not None else pd.Timestamp.now()).floor("h")
+        return self._demand_forecast(start, int(hours))
+
+    @cached('Forecast')
+    def _demand_forecast(self, start, hours):
+        return self.forecaster.predict(start, hours)
+
+    def get_rebalancing_plan(self, trucks=3, capacity=20, target_fill=0.5, forecast_hours=0, depot=None):
+        """Plan truck routes moving bikes from over-full to under-full stations (see model/rebalance.py)
+
+        With ``forecast_hours`` the targets allow for the net demand expected over that many hours.
+        """
+        start = pd.Timestamp.now().floor("h") if forecast_hours else None
+        return self._rebalancing_plan(int(trucks), int(capacity), float(target_fill), int(forecast_hours),
+                                      None if depot is None else tuple(depot), start)
+
+    @cached('Station', 'Bike', 'Forecast')
+    def _rebalancing_plan(self, trucks, capacity, target_fill, forecast_hours, depot, start):
+        net_flow = None
+        if forecast_hours:
+            forecast = self.get_demand_forecast(start, forecast_hours)
+            totals = forecast.groupby("Station_ID")[["Arrivals", "Departures"]].sum()
+            net_flow = totals["Arrivals"] - totals["Departures"]
+        return rebalance.plan(self.get_stations_with_availability(), self.get_bikes_at_stations(),
+                              trucks, capacity, target_fill, depot=depot, net_flow=net_flow)
+
+    @cached('Station', 'Bike')
     def get_bikes_at_stations(self):
         """Get bikes available at each station"""
-        conn = self.get_connection()
-        bikes_at_stations = pd.read_sql_query(
-            """
-            SELECT s.Station_ID, s.Station_Name, b.Bike_ID, b.Bike_Name, b.Current_Status
-            FROM Station s
-            JOIN Bike b ON s.Station_ID = b.Last_Station
-            WHERE b.Current_Status = 'Parked'
-            ORDER BY s.Station_Name, b.Bike_Name
-            """,
-            conn
-        )
-        conn.close()
-        return bikes_at_stations
+        with self.get_connection() as conn:
+            bikes_at_stations = pd.read_sql_query(
+                """
+                SELECT s.Station_ID, s.Station_Name, b.Bike_ID, b.Bike_Name, b.Current_Status
+                FROM Station s
+                JOIN Bike b ON s.Station_ID = b.Last_Station
+                WHERE b.Current_Status = 'Parked'
+                ORDER BY s.Station_Name, b.Bike_Name
+                """,
+                conn
+            )
+            return bikes_at_stations
     
+    @cached('Station', 'Bike')
     def get_filtered_bikes_at_stations(self, station_filter=None, bike_filter=None):
         """Get bikes at stations filtered by station name and bike name"""
-        conn = self.get_connection()
-    
-        # Start with the base query
-        query = """
+        # Name filters go through the search indexes
+        where, params = self._bikes_at_stations_where(station_filter, bike_filter)
+        query = f"""
         SELECT s.Station_ID, s.Station_Name, b.Bike_ID, b.Bike_Name, b.Current_Status
         FROM Station s
         INNER JOIN Bike b ON s.Station_ID = b.Last_Station
-        WHERE b.Current_Status = 'Parked'
+        {where}
         """
     
-        # List to hold parameter values for the SQL query
-        params = []
-    
-        # Add filters if they exist
-        if station_filter and station_filter.strip():
-            query += " AND s.Station_Name LIKE ?"
-            params.append(f'%{station_filter}%')
-    
-        if bike_filter and bike_filter.strip():
-            query += " AND b.Bike_Name LIKE ?"
-            params.append(f'%{bike_filter}%')
-    
         # Add order by clause
         query += " ORDER BY s.Station_Name, b.Bike_Name"
     
         # Execute the query with parameters
-        try:
-            bikes_at_stations = pd.read_sql_query(query, conn, params=params)
-            print(f"Query returned {len(bikes_at_stations)} results") 
-            return bikes_at_stations
-        except Exception as e:
-            print(f"Error executing query: {e}")
-            return pd.DataFrame()  # Return empty DataFrame on error
-        finally:
-            conn.close()
+        with self.get_connection() as conn:
+            try:
+                bikes_at_stations = pd.read_sql_query(query, conn, params=params)
+                self.tracer.trace("Filtered bikes query returned %d results", len(bikes_at_stations))
+                return bikes_at_stations
+            except Exception:
+                logger.exception("Error executing filtered bikes query")
+                return pd.DataFrame()  # Return empty DataFrame on error
     
-    def get_all_stations(self):
-        """Get all stations"""
-        conn = self.get_connection()
-        stations = pd.read_sql_query(
-            "SELECT Station_ID, Station_Name FROM Station ORDER BY Station_Name",
-            conn
-        )
-        conn.close()
-        return stations
+    # Keyset pagination: ``after`` is the sort key of the last row on the
+    # previous page, so every page is an index range scan of ``limit`` rows
+    # no matter how deep into the table it is.
 
-    def create_card_checkout(self, user_id, bike_id, station_id):
-        """Create a card CHECKOUT and update bike status"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            # Check if the user already has an active trip
-            user_active_trips = pd.read_sql_query(
-                """SELECT Trip_ID 
-                FROM Trip 
-                WHERE User_ID = ? 
-                AND End_Time IS NULL
-                """, 
+    @staticmethod
+    def _users_where(name_filter):
+        where = "WHERE User_Name IS NOT NULL AND User_Name != ''"
+        params = []
+        if name_filter and name_filter.strip():
+            clause, params = search.filter_clause("User", name_filter)
+            where += f" AND {clause}"
+        return where, params
+
+    @cached('User')
+    def get_users_page(self, name_filter="", after=None, limit=50):
+        """Get one page of users sorted by name; ``after`` is (User_Name, User_ID)"""
+        where, params = self._users_where(name_filter)
+        if after is not None:
+            where += " AND (User_Name, User_ID) > (?, ?)"
+            params.extend(after)
+        with self.get_connection() as conn:
+            return pd.read_sql_query(
+                f"SELECT User_ID, User_Name, User_Phone FROM User {where} "
+                "ORDER BY User_Name, User_ID LIMIT ?",
                 conn,
-                params=[user_id]
+                params=params + [limit]
             )
 
-            if not user_active_trips.empty:
-                conn.close()
-                return False, "User already has an active trip"
-            
-            # Check if the bike exists and is available at the specified station
-            bike_status = pd.read_sql_query(
-                """
-                SELECT Current_Status, Last_Station
-                FROM Bike
-                WHERE Bike_ID = ?
+    @cached('User')
+    def count_users(self, name_filter=""):
+        """Get the total number of users matching the filter"""
+        where, params = self._users_where(name_filter)
+        return self.fetch_value(f"SELECT COUNT(*) FROM User {where}", params)
+
+    @cached('Bike')
+    def get_bikes_page(self, after=None, limit=50):
+        """Get one page of bikes sorted by name; ``after`` is (Bike_Name, Bike_ID)"""
+        where = "WHERE Bike_Name IS NOT NULL AND Bike_Name != ''"
+        params = []
+        if after is not None:
+            where += " AND (Bike_Name, Bike_ID) > (?, ?)"
+            params.extend(after)
+        with self.get_connection() as conn:
+            return pd.read_sql_query(
+                f"SELECT Bike_ID, Bike_Name, Current_Status FROM Bike {where} "
+                "ORDER BY Bike_Name, Bike_ID LIMIT ?",
+                conn,
+                params=params + [limit]
+            )
+
+    @cached('Bike')
+    def count_bikes(self):
+        """Get the total number of named bikes"""
+        return self.fetch_value("SELECT COUNT(*) FROM Bike WHERE Bike_Name IS NOT NULL AND Bike_Name != ''")
+
+    @staticmethod
+    def _bikes_at_stations_where(station_filter, bike_filter):
+        where = "WHERE b.Current_Status = 'Parked'"
+        params = []
+        filters = (("Station", station_filter, "s.Station_ID", "s.Station_Name"),
+                   ("Bike", bike_filter, "b.Bike_ID", "b.Bike_Name"))
+        for entity, term, id_expr, name_expr in filters:
+            if term and term.strip():
+                clause, clause_params = search.filter_clause(entity, term, id_expr, name_expr)
+                where += f" AND {clause}"
+                params += clause_params
+        return where, params
+
+    @cached('Station', 'Bike')
+    def get_bikes_at_stations_page(self, station_filter="", bike_filter="", after=None, limit=50):
+        """Get one page of parked bikes per station; ``after`` is (Station_Name, Bike_Name, Bike_ID)"""
+        where, params = self._bikes_at_stations_where(station_filter, bike_filter)
+        if after is not None:
+            where += " AND (s.Station_Name, b.Bike_Name, b.Bike_ID) > (?, ?, ?)"
+            params.extend(after)
+        with self.get_connection() as conn:
+            return pd.read_sql_query(
+                f"""
+                SELECT s.Station_ID, s.Station_Name, b.Bike_ID, b.Bike_Name, b.Current_Status
+                FROM Station s
+                JOIN Bike b ON s.Station_ID = b.Last_Station
+                {where}
+                ORDER BY s.Station_Name, b.Bike_Name, b.Bike_ID
+                LIMIT ?
                 """,
                 conn,
-                params=[bike_id]
+                params=params + [limit]
             )
-        
-            # Check if the query returned results
-            if bike_status.empty:
-                conn.close()
-                return False, f"Bike with ID {bike_id} not found"
-            
-            # Now check if it's available at the right station
-            if bike_status.iloc[0]['Current_Status'] != 'Parked' or bike_status.iloc[0]['Last_Station'] != station_id:
-                conn.close()
-                return False, "Bike is not available at this station"
-            
-            # Update bike status
-            cursor.execute(
+
+    @cached('Station', 'Bike')
+    def count_bikes_at_stations(self, station_filter="", bike_filter=""):
+        """Get the total number of parked bikes matching the filters"""
+        where, params = self._bikes_at_stations_where(station_filter, bike_filter)
+        return self.fetch_value(
+            f"SELECT COUNT(*) FROM Station s JOIN Bike b ON s.Station_ID = b.Last_Station {where}",
+            params
+        )
+
+    @cached('Station')
+    def get_all_stations(self):
+        """Get all stations"""
+        with self.get_connection() as conn:
+            stations = pd.read_sql_query(
+                "SELECT Station_ID, Station_Name FROM Station ORDER BY Station_Name",
+                conn
+            )
+            return stations
+
+    @invalidates('Bike', 'Trip', 'Station')
+    def create_card_checkout(self, user_id, bike_id, station_id, raise_errors=False):
+        """Create a card CHECKOUT and update bike status.
+
+        Returns (True, trip id) or (False, why not). Database errors are
+        returned the same way unless ``raise_errors``, which lets callers
+        tell them apart from a bike or user that isn't available.
+        """
+        user_id, bike_id, station_id = int(user_id), int(bike_id), int(station_id)
+
+        def checkout(conn):
+            # Check if the user already has an active trip
+            if conn.execute(
+                "SELECT 1 FROM Trip WHERE User_ID = ? AND End_Time IS NULL LIMIT 1",
+                (user_id,)
+            ).fetchone():
+                return False, "User already has an active trip"
+
+            # Take the bike only if it is still parked at this station. The
+            # rowcount decides who wins when two kiosks pick the same bike.
+            taken = conn.execute(
                 """
                 UPDATE Bike
                 SET Current_Status = 'Active'
-                WHERE Bike_ID = ?
+                WHERE Bike_ID = ? AND Current_Status = 'Parked' AND Last_Station = ?
                 """,
-                (bike_id,)
-            )
-        
+                (bike_id, station_id)
+            ).rowcount
+            if taken == 0:
+                exists = conn.execute("SELECT 1 FROM Bike WHERE Bike_ID = ?", (bike_id,)).fetchone()
+                if exists is None:
+                    return False, f"Bike with ID {bike_id} not found"
+                return False, "Bike is not available at this station"
+
             # Create a new trip record
-            cursor.execute(
+            cursor = conn.execute(
                 """
                 INSERT INTO Trip (User_ID, Bike_ID, Start_Station_ID, Start_Time)
                 VALUES (?, ?, ?, CURRENT_TIMESTAMP)
                 """,
                 (user_id, bike_id, station_id)
             )
-        
-            trip_id = cursor.lastrowid
-        
-            # Debug: Verify the trip was created
-            print(f"Created trip with ID: {trip_id}")
-            trip_check = pd.read_sql_query(
-                "SELECT * FROM Trip WHERE Trip_ID = ?",
-                conn,
-                params=[trip_id]
-            )
-            print(f"Trip details: {trip_check}")
-        
-            conn.commit()
-            conn.close()
-            return True, trip_id
+            return True, cursor.lastrowid
+
+        try:
+            success, result = self.run_write(checkout)
         except Exception as e:
-            print(f"Exception in checkout: {e}")
-            conn.rollback()
-            conn.close()
+            logger.exception("Exception in checkout")
+            if raise_errors:
+                raise
             return False, str(e)
+
+        # Diagnostics: verify the trip was created (only when traced)
+        if success and self.tracer.sampled():
+            logger.debug("Created trip %s: %s", result, self.fetch_row(
+                "SELECT * FROM Trip WHERE Trip_ID = ?", (result,)
+            ))
+        return success, result
     
+    @cached('User', 'Trip', 'Bike', 'Station')
     def get_users_with_active_trips(self):
         """Get only users who have active trips"""
-        conn = self.get_connection()
-        users_with_trips = pd.read_sql_query(
-            """
-            SELECT DISTINCT u.User_ID, u.User_Name, u.User_Phone, t.Trip_ID, 
-                t.Bike_ID, b.Bike_Name, t.Start_Station_ID, s.Station_Name as Start_Station_Name,
-                t.Start_Time
-            FROM User u
-            JOIN Trip t ON u.User_ID = t.User_ID
-            JOIN Bike b ON t.Bike_ID = b.Bike_ID
-            JOIN Station s ON t.Start_Station_ID = s.Station_ID
-            WHERE t.End_Time IS NULL
-            ORDER BY u.User_Name
-            """,
-            conn
-        )
-        # Debug: print found trips
-        print(f"Found {len(users_with_trips)} active trips:")
-        for _, row in users_with_trips.iterrows():
-            print(f"User: {row['User_ID']} ({row['User_Name']}), Trip: {row['Trip_ID']}, Bike: {row['Bike_ID']} ({row['Bike_Name']})")
-    
-        conn.close()
-        return users_with_trips
-
-    def create_card_dropoff(self, user_id, bike_id, station_id):
-        """Create a card DROPOFF and update bike status"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-    
-        try:
-            # Try to standardize types
-            try:
-                user_id = int(user_id)
-                bike_id = int(bike_id)  
-                station_id = int(station_id)
-            except (ValueError, TypeError):
-                print(f"Type conversion failed for one of the values")
-        
-            print(f"Looking for active trip for User={user_id} (type: {type(user_id)}), Bike={bike_id} (type: {type(bike_id)})")
-        
-            # First, check if the trip exists at all
-            trip_exists = pd.read_sql_query(
-                "SELECT * FROM Trip WHERE Trip_ID = 10",  # Hardcoded for testing
-                conn
-            )
-            print(f"Trip 10 exists in database: {not trip_exists.empty}")
-            if not trip_exists.empty:
-                print(trip_exists)
-        
-            # Get ALL active trips for debugging
-            all_active = pd.read_sql_query(
-                "SELECT Trip_ID, User_ID, Bike_ID, End_Time FROM Trip WHERE End_Time IS NULL", 
+        with self.get_connection() as conn:
+            users_with_trips = pd.read_sql_query(
+                """
+                SELECT DISTINCT u.User_ID, u.User_Name, u.User_Phone, t.Trip_ID, 
+                    t.Bike_ID, b.Bike_Name, t.Start_Station_ID, s.Station_Name as Start_Station_Name,
+                    t.Start_Time
+                FROM User u
+                JOIN Trip t ON u.User_ID = t.User_ID
+                JOIN Bike b ON t.Bike_ID = b.Bike_ID
+                JOIN Station s ON t.Start_Station_ID = s.Station_ID
+                WHERE t.End_Time IS NULL
+                ORDER BY u.User_Name
+                """,
                 conn
             )
-            print("All active trips:")
-            print(all_active)
-        
+            self.tracer.trace("Found %d active trips", len(users_with_trips))
+            return users_with_trips
+
+    @invalidates('Bike', 'Trip', 'Station')
+    def create_card_dropoff(self, user_id, bike_id, station_id, raise_errors=False):
+        """Create a card DROPOFF and update bike status (results as for create_card_checkout)"""
+        # Try to standardize types
+        try:
+            user_id = int(user_id)
+            bike_id = int(bike_id)  
+            station_id = int(station_id)
+        except (ValueError, TypeError):
+            logger.warning("Dropoff: type conversion failed for user=%r bike=%r station=%r",
+                           user_id, bike_id, station_id)
+
+        # Diagnostic reads only run for sampled calls when tracing is on
+        trace = self.tracer.sampled()
+        if trace:
+            logger.debug("Dropoff: looking for active trip for user=%s bike=%s", user_id, bike_id)
+            logger.debug("Dropoff: all active trips: %s", self.fetch_rows(
+                "SELECT Trip_ID, User_ID, Bike_ID FROM Trip WHERE End_Time IS NULL"
+            ))
+
+        def dropoff(conn):
             # Find the trip by User and Bike
-            trip_result = pd.read_sql_query(
+            trip = TripRef.from_row(conn.execute(
                 """
-                SELECT Trip_ID 
+                SELECT Trip_ID, User_ID, Bike_ID, Start_Station_ID
                 FROM Trip 
                 WHERE User_ID = ? AND Bike_ID = ? AND End_Time IS NULL
+                LIMIT 1
                 """,
-                conn,
-                params=[user_id, bike_id]
-            )
-        
-            if trip_result.empty:
-                print("No active trip found matching user_id and bike_id")
-                conn.close()
+                (user_id, bike_id)
+            ).fetchone())
+            if trip is None:
                 return False, "No active trip found for this user and bike"
-        
-            trip_id = trip_result.iloc[0]['Trip_ID']
-            print(f"Found active trip: {trip_id}")
-        
-            # Test if we can update ANY record in the Trip table
-            test_trip = pd.read_sql_query(
-                "SELECT * FROM Trip WHERE Trip_ID = ?", 
-                conn, 
-                params=[trip_id]
-            )
-            print(f"Target trip record before update:")
-            print(test_trip)
-        
-            # Begin transaction
-            print("Starting transaction")
-            cursor.execute("BEGIN TRANSACTION")
-        
-            # Directly update by Trip_ID to avoid any join issues
-            update_query = """
-            UPDATE Trip
-            SET End_Station_ID = ?, End_Time = CURRENT_TIMESTAMP
-            WHERE Trip_ID = ?
-            """
-            print(f"Executing update with params: station_id={station_id}, trip_id={trip_id}")
-            cursor.execute(update_query, (station_id, trip_id))
-        
-            # Check if update worked
-            rowcount = cursor.rowcount
-            print(f"Trip update affected {rowcount} rows")
-        
-            if rowcount == 0:
-                # Try direct SQL for debugging
-                print("Trying direct SQL update for debugging")
-                cursor.execute(f"UPDATE Trip SET End_Station_ID = {station_id}, End_Time = CURRENT_TIMESTAMP WHERE Trip_ID = {trip_id}")
-                print(f"Direct SQL update affected {cursor.rowcount} rows")
-            
-                # Check if anything changed
-                after_update = pd.read_sql_query(
-                    "SELECT * FROM Trip WHERE Trip_ID = ?", 
-                    conn, 
-                    params=[trip_id]
-                )
-                print("Trip record after update attempt:")
-                print(after_update)
-            
-                if cursor.rowcount == 0:
-                    print("Update failed, rolling back transaction")
-                    conn.rollback()
-                    conn.close()
-                    return False, "Failed to update trip record - no rows affected"
-        
+
+            # Close the trip only if it is still open, so a double submit
+            # can't end it twice
+            closed = conn.execute(
+                """
+                UPDATE Trip
+                SET End_Station_ID = ?, End_Time = CURRENT_TIMESTAMP
+                WHERE Trip_ID = ? AND End_Time IS NULL
+                """,
+                (station_id, trip.trip_id)
+            ).rowcount
+            if closed == 0:
+                return False, "Failed to update trip record - no rows affected"
+
+            # Keep the Analysis tab rollups in step with the closed trip
+            rollups.record_closed_trip(conn, trip.trip_id)
+
             # Update bike status
-            print(f"Updating Bike {bike_id} status to Parked")
-            cursor.execute(
+            conn.execute(
                 """
                 UPDATE Bike
                 SET Current_Status = 'Parked', Last_Station = ?
@@ -349,150 +772,132 @@ class BysykkelModel:
                 """,
                 (station_id, bike_id)
             )
-        
-            print(f"Bike update affected {cursor.rowcount} rows")
-        
-            # Commit the transaction
-            print("Committing transaction")
-            conn.commit()
-        
-            # Verify the changes were committed
-            final_check = pd.read_sql_query(
-                "SELECT * FROM Trip WHERE Trip_ID = ?", 
-                conn, 
-                params=[trip_id]
-            )
-            print("Trip record after commit:")
-            print(final_check)
-        
-            conn.close()
-            return True, trip_id
-        
+            return True, trip.trip_id
+
+        try:
+            success, result = self.run_write(dropoff)
         except Exception as e:
-            print(f"Error in dropoff: {str(e)}")
-            try:
-                conn.rollback()
-            except:
-                pass
-            conn.close()
+            logger.exception("Error in dropoff")
+            if raise_errors:
+                raise
             return False, str(e)
 
-    # This function is called after the bike has been dropped off
-    def report_bike_issue(self, bike_id, issues, notes=None):
-        """Report issues with a bike after dropoff"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-    
-        try:
-            print(f"Notes received: '{notes}'")
+        if not success:
+            self.tracer.trace("Dropoff: %s (user=%s bike=%s)", result, user_id, bike_id)
+            return success, result
+        if self.exporter is not None:
+            self.exporter.nudge()
+        if trace:
+            logger.debug("Dropoff: trip after commit: %s", self.fetch_row(
+                "SELECT * FROM Trip WHERE Trip_ID = ?", (result,)
+            ))
+        return success, result
 
-            # Begin transaction
-            cursor.execute("BEGIN TRANSACTION")
-        
-            # Create maintenance record for each reported issue
-            for issue in issues:
-                print(f"Adding complaint for Bike {bike_id}: {issue}")
+    # This function is called after the bike has been dropped off
+    def report_bike_issue(self, bike_id, issues, notes=None, wait=False):
+        """Report issues with a bike after dropoff.
 
-                # Check if notes is None or empty and provide a default
-                actual_notes = notes if notes else ""
-            
-                # Insert into Complaint table
-                cursor.execute(
-                    """
-                INSERT INTO Complaint (Bike_ID, Complaint_Type, Additional_Notes)
-                VALUES (?, ?, ?)
-                    """,
-                    (bike_id, issue, actual_notes)
-                )
-                
-            # If there are issues, update bike status to 'Missing'
-            if issues:
-                print(f"Updating Bike {bike_id} status to Missing")
-                cursor.execute(
-                """
-                UPDATE Bike
-                SET Current_Status = 'Missing'
-                WHERE Bike_ID = ?
-                """,
-                    (bike_id,)
-                )
-                
-            # Commit changes
-            conn.commit()
-            print(f"Successfully reported {len(issues)} issues for Bike {bike_id}")
-            conn.close()
-            return True, "Issues reported successfully"
-        
+        The report is queued for the background complaint writer and the
+        call returns right away; with ``wait=True`` it returns once the
+        report is committed.
+        """
+        if not issues:
+            return True, "No issues to report"
+        try:
+            future = self.complaints.submit(bike_id, issues, notes)
+            self.tracer.trace("Queued %d issues for bike %s", len(issues), bike_id)
+            if wait:
+                future.result()
+                return True, "Issues reported successfully"
+            return True, "Issues received and will be saved shortly"
         except Exception as e:
-            print(f"Error reporting issues: {str(e)}")
-            conn.rollback()
-            conn.close()
+            logger.exception("Error reporting issues")
             return False, str(e)
+
+    def flush_writes(self, timeout=None):
+        """Wait for queued background writes (complaint reports) to be committed"""
+        return self.complaints.flush(timeout)
         
     # This function is called to get active trips for a user or all active trips
+    @cached('Trip', 'Bike', 'Station')
     def get_active_trips(self, user_id=None):
         """Get active trips for a user or all active trips"""
-        conn = self.get_connection()
-        query = """
-            SELECT t.Trip_ID, t.User_ID, t.Bike_ID, b.Bike_Name, t.Start_Station_ID, 
-                   s.Station_Name as Start_Station_Name, t.Start_Time 
-            FROM Trip t
-            JOIN Bike b ON t.Bike_ID = b.Bike_ID
-            JOIN Station s ON t.Start_Station_ID = s.Station_ID
-            WHERE t.End_Time IS NULL
-        """
+        with self.get_connection() as conn:
+            query = """
+                SELECT t.Trip_ID, t.User_ID, t.Bike_ID, b.Bike_Name, t.Start_Station_ID, 
+                       s.Station_Name as Start_Station_Name, t.Start_Time 
+                FROM Trip t
+                JOIN Bike b ON t.Bike_ID = b.Bike_ID
+                JOIN Station s ON t.Start_Station_ID = s.Station_ID
+                WHERE t.End_Time IS NULL
+            """
         
-        params = []
-        if user_id:
-            query += " AND t.User_ID = ?"
-            params.append(user_id)
+            params = []
+            if user_id:
+                query += " AND t.User_ID = ?"
+                params.append(user_id)
             
-        query += " ORDER BY t.Start_Time DESC"
+            query += " ORDER BY t.Start_Time DESC"
         
-        active_trips = pd.read_sql_query(query, conn, params=params)
-        conn.close()
-        return active_trips
+            active_trips = pd.read_sql_query(query, conn, params=params)
+            return active_trips
     
     # This function is called to add a new user to the database
+    @invalidates('User')
     def add_user(self, user_name, user_phone, email, latitude=None, longitude=None):
         """Add a new user to the database"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute(
-                """
-                INSERT INTO User (User_Name, User_Phone, Email, Latitude, Longitude)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (user_name, user_phone, email, latitude, longitude)
-            )
-            conn.commit()
-            user_id = cursor.lastrowid
-            conn.close()
-            return user_id
-        except Exception as e:
-            conn.rollback()
-            conn.close()
-            raise e
-    
-    def get_stations_with_availability(self):
-        """Get all stations with their availability information"""
-        conn = self.get_connection()
-        stations = pd.read_sql_query(
+        _, user_id = self.execute_write(
             """
-            SELECT 
-                Station_ID, 
-                Station_Name, 
-                Latitude, 
-                Longitude, 
-                Max_Parking, 
-                Available_Parking
-            FROM Station
-            ORDER BY Station_Name
+            INSERT INTO User (User_Name, User_Phone, Email, Latitude, Longitude)
+            VALUES (?, ?, ?, ?, ?)
             """,
-            conn
+            (user_name, user_phone, email, latitude, longitude)
         )
-        conn.close()
-        return stations
-        
+        return user_id
+    
+    @cached('Station')
+    def get_stations_with_availability(self):
+        """Get all stations with their availability information"""
+        with self.get_connection() as conn:
+            stations = pd.read_sql_query(
+                """
+                SELECT 
+                    Station_ID, 
+                    Station_Name, 
+                    Latitude, 
+                    Longitude, 
+                    Max_Parking, 
+                    Available_Parking
+                FROM Station
+                ORDER BY Station_Name
+                """,
+                conn
+            )
+            return stations
+
+    @cached('Station', 'Bike')
+    def station_index(self):
+        """Get the spatial index of stations and their parked bikes, rebuilt after changes"""
+        with self.get_connection() as conn:
+            stations = pd.read_sql_query(
+                """
+                SELECT s.Station_ID, s.Station_Name, s.Latitude, s.Longitude,
+                       COUNT(b.Bike_ID) AS Parked_Bikes
+                FROM Station s
+                LEFT JOIN Bike b ON b.Last_Station = s.Station_ID AND b.Current_Status = 'Parked'
+                GROUP BY s.Station_ID
+                """,
+                conn
+            )
+        return StationGrid(stations)
+
+    def nearest_stations(self, lat, lon, k=5, min_available_bikes=0):
+        """Get the k stations closest to (lat, lon) with at least min_available_bikes parked bikes"""
+        return self.station_index().nearest(float(lat), float(lon), k, min_available_bikes)
 
+    def get_user_location(self, user_id):
+        """Get (Latitude, Longitude) of a user, or None if unknown"""
+        row = self.fetch_row("SELECT Latitude, Longitude FROM User WHERE User_ID = ?", (int(user_id),))
+        if row is None or row[0] is None or row[1] is None:
+            return None
+        return row
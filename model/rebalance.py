@@ -0,0 +1,253 @@
+"""Rebalancing plans: which bikes to move, and truck routes that move them.
+
+Every station gets a target of ``target_fill`` of its docks in use,
+optionally shifted by the forecast net flow (a station expected to lose
+10 bikes gets 10 more). Stations at least ``min_move`` bikes above target
+are pickups, limited to their parked bikes; those at least ``min_move``
+below are dropoffs.
+
+Routes are built over a haversine distance matrix of the depot and the
+stations involved, in two phases:
+
+1. Greedy: the truck with the shortest route so far adds the stop that
+   moves the most bikes per km (each stop costs ``stop_km`` extra).
+   Trucks leave the depot empty and only pick up bikes that some dropoff
+   station still needs, so every truck ends its route empty.
+2. 2-opt: each route is shortened by reversing segments of stops, as long
+   as the load stays within [0, capacity] at every stop. All segment pairs
+   are scored at once with numpy and non-overlapping improvements are
+   applied together, until none is left or ``time_limit`` runs out.
+
+Pickups take the station's parked bikes (``get_bikes_at_stations``);
+dropoffs unload the bikes loaded last first.
+
+    python -m model.rebalance [bysykkel.db] [trucks] [capacity]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from model.geo import haversine_km
+
+
+def distance_matrix(lat, lon):
+    """Haversine distances in km between all points, shape (n, n)"""
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    return haversine_km(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+
+
+def station_supply(stations, parked, target_fill=0.5, min_move=2, net_flow=None):
+    """Bikes to pick up (> 0) or drop off (< 0) per station, and the targets.
+
+    ``stations`` needs Station_ID, Max_Parking and Available_Parking;
+    ``parked`` is the number of movable bikes per Station_ID and
+    ``net_flow`` the expected arrivals minus departures per Station_ID.
+    """
+    capacity = stations["Max_Parking"].fillna(0).to_numpy()
+    bikes_now = capacity - stations["Available_Parking"].fillna(0).to_numpy()
+    target = target_fill * capacity
+    if net_flow is not None:
+        target = target - stations["Station_ID"].map(net_flow).fillna(0).to_numpy()
+    target = np.clip(np.round(target), 0, capacity).astype(np.int64)
+    movable = stations["Station_ID"].map(parked).fillna(0).to_numpy().astype(np.int64)
+    surplus = np.minimum(bikes_now - target, movable)
+    supply = np.where(surplus >= min_move, surplus, np.where(target - bikes_now >= min_move, bikes_now - target, 0))
+    return supply.astype(np.int64), target, bikes_now.astype(np.int64)
+
+
+def greedy_routes(dist, supply, trucks, capacity, stop_km=0.5):
+    """Routes from the depot (node 0) as lists of (node, bikes picked up > 0 / dropped off < 0)"""
+    remaining = np.asarray(supply, dtype=np.int64).copy()
+    remaining[0] = 0
+    routes = [[] for _ in range(trucks)]
+    position = np.zeros(trucks, dtype=np.int64)
+    load = np.zeros(trucks, dtype=np.int64)
+    length = np.zeros(trucks)
+    active = np.ones(trucks, dtype=bool)
+    # Bikes wanted by dropoff stations and not yet on a truck; picking up more
+    # than that could leave bikes on a truck with nowhere to go
+    unclaimed = int(-remaining[remaining < 0].sum())
+    while active.any():
+        truck = np.flatnonzero(active)[np.argmin(length[active])]
+        pick = np.minimum(np.maximum(remaining, 0), min(capacity - load[truck], unclaimed))
+        drop = np.minimum(np.maximum(-remaining, 0), load[truck])
+        amount = pick + drop
+        if not amount.any():
+            active[truck] = False
+            continue
+        node = int(np.argmax(amount / (dist[position[truck]] + stop_km)))
+        if pick[node]:
+            moved = int(pick[node])
+            unclaimed -= moved
+        else:
+            moved = -int(drop[node])
+        remaining[node] -= moved
+        load[truck] += moved
+        length[truck] += dist[position[truck], node]
+        position[truck] = node
+        routes[truck].append((node, moved))
+    return routes
+
+
+def route_km(dist, nodes):
+    """Length of a route through ``nodes``, starting and ending at the depot"""
+    path = np.concatenate([[0], nodes, [0]]).astype(np.int64)
+    return float(dist[path[:-1], path[1:]].sum())
+
+
+def two_opt(dist, nodes, moves, capacity, deadline=None):
+    """Shorten a route by load-feasible segment reversals; returns (nodes, moves)"""
+    path = np.concatenate([[0], nodes, [0]]).astype(np.int64)
+    change = np.concatenate([[0], moves, [0]]).astype(np.int64)
+    stops = len(nodes)
+    if stops < 3:
+        return np.asarray(nodes, dtype=np.int64), np.asarray(moves, dtype=np.int64)
+    edges = np.arange(stops + 1)  # edge a joins positions a and a+1
+    later = edges[None, :] >= edges[:, None] + 2  # reversing positions a+1..b needs b >= a+2
+    while deadline is None or time.perf_counter() < deadline:
+        head, tail = path[:-1], path[1:]
+        edge_km = dist[head, tail]
+        # Replace edges a and b by (path[a], path[b]) and (path[a+1], path[b+1])
+        delta = dist[head[:, None], head[None, :]] + dist[tail[:, None], tail[None, :]] \
+            - edge_km[:, None] - edge_km[None, :]
+
+        # Load after position k is prefix[k]; after reversing a+1..b the loads
+        # there become prefix[a] + prefix[b] - prefix[k] for k in a..b-1
+        prefix = np.cumsum(change)[:-1]
+        spread = np.where(edges[None, :] >= edges[:, None], prefix[None, :], np.nan)
+        high = np.fmax.accumulate(spread, axis=1)
+        low = np.fmin.accumulate(spread, axis=1)
+        high = np.concatenate([np.full((stops + 1, 1), np.nan), high[:, :-1]], axis=1)
+        low = np.concatenate([np.full((stops + 1, 1), np.nan), low[:, :-1]], axis=1)
+        ends = prefix[:, None] + prefix[None, :]
+        feasible = later & (ends - high >= 0) & (ends - low <= capacity)
+
+        gain = np.where(feasible, delta, 0.0)
+        candidates = np.flatnonzero(gain < -1e-9)
+        if not len(candidates):
+            break
+        # Best first; reversals over disjoint edges don't affect each other
+        candidates = candidates[np.argsort(gain.ravel()[candidates])][:4 * (stops + 1)]
+        used = np.zeros(stops + 1, dtype=bool)
+        for a, b in zip(*np.unravel_index(candidates, gain.shape)):
+            if used[a:b + 1].any():
+                continue
+            used[a:b + 1] = True
+            path[a + 1:b + 1] = path[a + 1:b + 1][::-1]
+            change[a + 1:b + 1] = change[a + 1:b + 1][::-1]
+    return path[1:-1], change[1:-1]
+
+
+def plan(stations, bikes, trucks=3, capacity=20, target_fill=0.5, min_move=2, depot=None,
+         net_flow=None, stop_km=0.5, time_limit=2.0):
+    """Plan the bikes to move and a route per truck.
+
+    ``stations`` needs Station_ID, Station_Name, Latitude, Longitude,
+    Max_Parking and Available_Parking; ``bikes`` the parked bikes with
+    Station_ID, Bike_ID and Bike_Name. ``depot`` is (lat, lon), by default
+    the middle of the stations.
+
+    Returns a dict with
+        stops       Truck, Stop, Station_ID, Station_Name, Action, Bikes, Load, Km, Bike_IDs, Bike_Names
+        routes      Truck, Stops, Bikes_Moved, Km, Greedy_Km (before 2-opt)
+        stations    Station_ID, Station_Name, Bikes_Now, Target, Planned (bikes added, < 0 removed),
+                    Off_Target (bikes still missing, < 0 extra, after the plan)
+        seconds     time spent per phase
+    """
+    timings = {}
+    started = time.perf_counter()
+    stations = stations.dropna(subset=["Latitude", "Longitude"]).reset_index(drop=True)
+    parked = bikes.groupby("Station_ID").size()
+    supply, target, bikes_now = station_supply(stations, parked, target_fill, min_move, net_flow)
+
+    # Only stations with something to move become nodes (node 0 is the depot)
+    involved = np.flatnonzero(supply)
+    if depot is None:
+        depot = (stations["Latitude"].mean(), stations["Longitude"].mean())
+    lat = np.concatenate([[depot[0]], stations["Latitude"].to_numpy()[involved]])
+    lon = np.concatenate([[depot[1]], stations["Longitude"].to_numpy()[involved]])
+    dist = distance_matrix(lat, lon)
+    node_supply = np.concatenate([[0], supply[involved]])
+    timings["matrix"] = time.perf_counter() - started
+
+    start = time.perf_counter()
+    routes = greedy_routes(dist, node_supply, trucks, capacity, stop_km)
+    timings["greedy"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    deadline = start + time_limit
+    improved = []
+    for route in routes:
+        nodes = np.array([node for node, _ in route], dtype=np.int64)
+        moves = np.array([moved for _, moved in route], dtype=np.int64)
+        improved.append((nodes, moves, route_km(dist, nodes), *two_opt(dist, nodes, moves, capacity, deadline)))
+    timings["two_opt"] = time.perf_counter() - start
+
+    # Hand out the parked bikes: pickups take a station's bikes in order,
+    # dropoffs unload the ones loaded last
+    start = time.perf_counter()
+    order = bikes.sort_values("Station_ID", kind="stable")
+    parked_bikes = list(zip(order["Bike_ID"].tolist(), order["Bike_Name"].tolist()))
+    station_ids, first = np.unique(order["Station_ID"].to_numpy(), return_index=True)
+    next_bike = dict(zip(station_ids.tolist(), first.tolist()))  # each station's first bike not yet taken
+    ids, names = stations["Station_ID"].tolist(), stations["Station_Name"].tolist()
+    rows, summary = [], []
+    planned = np.zeros(len(stations), dtype=np.int64)
+    for truck, (_, _, greedy_km, nodes, moves) in enumerate(improved, start=1):
+        on_board, load, previous = [], 0, 0
+        for stop, (node, moved) in enumerate(zip(nodes.tolist(), moves.tolist()), start=1):
+            row = involved[node - 1]
+            if moved > 0:
+                first_bike = next_bike[ids[row]]
+                taken = parked_bikes[first_bike:first_bike + moved]
+                next_bike[ids[row]] = first_bike + moved
+                on_board.extend(taken)
+            else:
+                taken = on_board[moved:]
+                del on_board[moved:]
+            load += moved
+            planned[row] -= moved
+            rows.append((truck, stop, ids[row], names[row], "Pick up" if moved > 0 else "Drop off",
+                         abs(moved), load, round(float(dist[previous, node]), 3),
+                         [bike_id for bike_id, _ in taken], [name for _, name in taken]))
+            previous = node
+        summary.append((truck, len(nodes), int(moves[moves > 0].sum()),
+                        round(route_km(dist, nodes), 3), round(greedy_km, 3)))
+    timings["assign"] = time.perf_counter() - start
+    timings["total"] = time.perf_counter() - started
+
+    return {
+        "stops": pd.DataFrame(rows, columns=["Truck", "Stop", "Station_ID", "Station_Name", "Action", "Bikes",
+                                             "Load", "Km", "Bike_IDs", "Bike_Names"]),
+        "routes": pd.DataFrame(summary, columns=["Truck", "Stops", "Bikes_Moved", "Km", "Greedy_Km"]),
+        "stations": pd.DataFrame({
+            "Station_ID": stations["Station_ID"],
+            "Station_Name": stations["Station_Name"],
+            "Bikes_Now": bikes_now,
+            "Target": target,
+            "Planned": planned,
+            "Off_Target": target - bikes_now - planned,
+        }),
+        "seconds": timings,
+    }
+
+
+def _main(argv):
+    from model.model import BysykkelModel
+
+    db_path = argv[0] if argv else "bysykkel.db"
+    trucks = int(argv[1]) if len(argv) > 1 else 3
+    capacity = int(argv[2]) if len(argv) > 2 else 20
+    model = BysykkelModel(db_path)
+    try:
+        result = plan(model.get_stations_with_availability(), model.get_bikes_at_stations(), trucks, capacity)
+    finally:
+        model.close()
+    print(result["routes"].to_string(index=False))
+    print(", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in result["seconds"].items()))
+
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
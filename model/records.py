@@ -0,0 +1,31 @@
+class Record:
+    """Small fixed-field row object for point lookups.
+
+    Subclasses only list their fields in ``__slots__``. Records are built
+    straight from sqlite row tuples, which is far cheaper than a one-row
+    DataFrame, and still unpack like a tuple.
+    """
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    @classmethod
+    def from_row(cls, row):
+        """Build a record from a row tuple, or return None for no row"""
+        return None if row is None else cls(*row)
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class TripRef(Record):
+    __slots__ = ("trip_id", "user_id", "bike_id", "start_station_id")
@@ -0,0 +1,248 @@
+"""Read replica: a snapshot copy of the database for dashboard reads.
+
+Long Analysis scans and the checkout/dropoff writes used to share one
+database file and one connection pool, so a few slow reports could hold
+every pooled connection while checkouts waited. In replica mode:
+
+* a background thread copies the database with the SQLite backup API into
+  a new file every ``refresh_interval`` seconds (and skips the copy when
+  nothing was committed since the last one);
+* the copy is opened read-only and immutable (no locks at all) by its own
+  connection pool; the previous copy's pool is retired and closed at the
+  next refresh, once reads still running on it have finished;
+* the model sends the queries of its read methods to the replica and
+  everything else (writes, migrations, exports) to the primary.
+
+Reads are at most ``max_staleness`` seconds behind the primary: while the
+newest snapshot is older than that (the first one is still being taken,
+or refreshing failed) reads go to the primary instead. After a swap the
+query cache drops results of tables written since the previous snapshot,
+so the cache doesn't keep serving what the old snapshot returned.
+
+    python -m model.replica bysykkel.db [copies]
+"""
+import atexit
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from model.connection_pool import DEFAULT_PRAGMAS, ConnectionPool
+from model.tracing import logger
+
+# Snapshots are never written: no journal or WAL settings, just read tuning
+READ_PRAGMAS = {
+    name: value for name, value in DEFAULT_PRAGMAS.items() if name not in ("journal_mode", "synchronous")
+}
+
+
+def take_snapshot(source, path):
+    """Copy the database open on ``source`` into a new file at ``path``.
+
+    The copy is done in one step: a stepwise backup restarts whenever
+    another connection commits, so under steady writes it might never
+    finish. In WAL mode the source only holds a read snapshot meanwhile,
+    which doesn't block writers.
+    """
+    target = sqlite3.connect(path)
+    try:
+        target.execute("PRAGMA journal_mode = OFF")
+        target.execute("PRAGMA synchronous = OFF")
+        source.backup(target)
+        # The copy inherits WAL mode; immutable readers need a rollback-journal file
+        target.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        target.close()
+
+
+class ReadReplica:
+    """Periodically refreshed read-only snapshot of the model's database"""
+
+    def __init__(self, model, max_staleness=5.0, refresh_interval=None, directory=None):
+        self.model = model
+        self.max_staleness = max_staleness
+        # Refresh well inside the bound, so a slow copy doesn't exceed it
+        self.refresh_interval = refresh_interval if refresh_interval is not None else max_staleness / 2
+        self.directory = tempfile.mkdtemp(prefix="bysykkel-replica-", dir=directory)
+        self.pool = None
+        self.path = None
+        self.taken_at = None  # time.monotonic() when the current snapshot was started
+        self._retired = []  # (pool, path) of replaced snapshots, closed at the next refresh
+        self._source = None
+        self._data_version = None
+        self._cache_generations = {}
+        self._copies = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.refreshes = 0
+        self.unchanged = 0
+        self.failures = 0
+        self.fallbacks = 0
+        self.last_refresh_seconds = None
+
+    def start(self):
+        """Start the background refresh thread (the first snapshot is taken there)"""
+        with self._lock:
+            if self._thread is None and not self._stop.is_set():
+                self._thread = threading.Thread(target=self._run, name="read-replica", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                self.failures += 1
+                logger.exception("Refreshing the read replica failed")
+            taken_at = self.taken_at if self.taken_at is not None else time.monotonic()
+            self._stop.wait(max(0.0, taken_at + self.refresh_interval - time.monotonic()))
+
+    def age(self):
+        """Seconds since the current snapshot was taken, or None before the first one"""
+        return None if self.taken_at is None else time.monotonic() - self.taken_at
+
+    def is_fresh(self):
+        """True if there is a snapshot within the staleness bound"""
+        age = self.age()
+        return age is not None and age <= self.max_staleness
+
+    def holds_lease(self):
+        """True if the calling thread has a snapshot connection leased"""
+        return getattr(self._local, "pool", None) is not None
+
+    def refresh(self, force=False):
+        """Take a new snapshot if anything was committed since the last one; True if it did"""
+        with self._refresh_lock:
+            if self._stop.is_set():
+                return False
+            started = time.monotonic()
+            if self._source is None:
+                self._source = sqlite3.connect(self.model.db_path, timeout=self.model.pool.timeout,
+                                               check_same_thread=False)
+            # data_version changes whenever another connection commits
+            data_version = self._source.execute("PRAGMA data_version").fetchone()[0]
+            if not force and self.pool is not None and data_version == self._data_version:
+                self.taken_at = started
+                self.unchanged += 1
+                return False
+
+            # Cached results of tables written from here on may be missing from
+            # the new snapshot; only those written before now are safe to refill
+            generations = self.model.cache.generations()
+            self._copies += 1
+            path = os.path.join(self.directory, f"snapshot-{self._copies}.db")
+            take_snapshot(self._source, path)
+            pool = ConnectionPool(
+                f"file:{quote(path)}?mode=ro&immutable=1", size=self.model.pool.size,
+                timeout=self.model.pool.timeout, pragmas=READ_PRAGMAS, metrics=self.model.pool.metrics, uri=True,
+            )
+            with self._lock:
+                retired, self._retired = self._retired, []
+                if self.pool is not None:
+                    self._retired.append((self.pool, self.path))
+                self.pool, self.path, self.taken_at = pool, path, started
+            self._data_version = data_version
+            self.refreshes += 1
+            self.last_refresh_seconds = time.monotonic() - started
+
+            # Results cached from the old snapshot (or the primary) lack writes the
+            # new one has; invalidate() bumps each table's counter once more itself
+            written = [table for table, generation in generations.items()
+                       if generation != self._cache_generations.get(table, 0)]
+            self.model.cache.invalidate(written)
+            self._cache_generations = {**generations, **{table: generations[table] + 1 for table in written}}
+
+            for old_pool, old_path in retired:
+                self._discard(old_pool, old_path)
+            return True
+
+    @staticmethod
+    def _discard(pool, path):
+        """Close a retired snapshot's pool and delete its file"""
+        pool.close()
+        try:
+            os.remove(path)
+        except OSError:
+            # Still open elsewhere (Windows); removed with the directory on close
+            pass
+
+    @contextmanager
+    def connection(self):
+        """Lease a connection to the current snapshot.
+
+        A thread that already holds one gets the same connection (and so the
+        same snapshot) back, even if a newer snapshot was swapped in since.
+        """
+        pool = getattr(self._local, "pool", None)
+        if pool is not None:
+            with pool.connection() as conn:
+                yield conn
+            return
+        pool = self.pool
+        self._local.pool = pool
+        try:
+            with pool.connection() as conn:
+                yield conn
+        finally:
+            self._local.pool = None
+
+    def stats(self):
+        """Return snapshot age and refresh counters"""
+        age = self.age()
+        return {
+            "age": None if age is None else round(age, 3),
+            "max_staleness": self.max_staleness,
+            "refreshes": self.refreshes,
+            "unchanged": self.unchanged,
+            "failures": self.failures,
+            "fallbacks": self.fallbacks,
+            "last_refresh_seconds": self.last_refresh_seconds,
+        }
+
+    def close(self):
+        """Stop refreshing, close every snapshot pool and delete the snapshots"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        with self._refresh_lock:
+            with self._lock:
+                pools = self._retired + ([(self.pool, self.path)] if self.pool is not None else [])
+                self._retired, self.pool, self.path, self.taken_at = [], None, None, None
+            for pool, path in pools:
+                self._discard(pool, path)
+            if self._source is not None:
+                self._source.close()
+                self._source = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _main(argv):
+    from model.model import BysykkelModel
+
+    db_path = argv[0] if argv else "bysykkel.db"
+    copies = int(argv[1]) if len(argv) > 1 else 3
+    model = BysykkelModel(db_path)
+    replica = ReadReplica(model)
+    try:
+        for _ in range(copies):
+            start = time.perf_counter()
+            replica.refresh(force=True)
+            size = os.path.getsize(replica.path) / 1e6
+            print(f"Snapshot of {size:.1f} MB in {time.perf_counter() - start:.2f}s")
+    finally:
+        replica.close()
+        model.close()
+
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
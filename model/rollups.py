@@ -0,0 +1,247 @@
+"""Pre-aggregated trip statistics for the Analysis tab.
+
+A trip is counted once it is closed (``End_Time`` set):
+
+    Station_Trip_Stats     trips started / ended per station
+    Station_Hourly_Trips   trips started / ended per station, day and hour
+    Station_Hour_Totals    the same summed over all days, per station and hour
+                           (its size doesn't grow with the history)
+    Bike_Usage             closed trips per bike
+
+``create_card_dropoff`` adds the trip it closes in the same transaction.
+Incremental imports rewrite trips with ``remove_trips`` before and
+``add_trips`` after each chunk, so a re-imported trip is not counted twice.
+``backfill`` rebuilds everything from the Trip table in batches, committing
+after each one, so it can run next to live dropoffs and be resumed. The
+``Rollup_State`` row records how far it got: dropoffs only add trips the
+backfill has already passed (or everything once it is complete), so no
+trip is counted twice.
+
+    python -m model.rollups [bysykkel.db] [batch_size]
+"""
+import sqlite3
+import sys
+
+TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS Station_Trip_Stats (
+        Station_ID INTEGER PRIMARY KEY,
+        Trips_Started INTEGER NOT NULL DEFAULT 0,
+        Trips_Ended INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS Station_Hourly_Trips (
+        Station_ID INTEGER NOT NULL,
+        Trip_Date TEXT NOT NULL,
+        Trip_Hour INTEGER NOT NULL,
+        Starts INTEGER NOT NULL DEFAULT 0,
+        Ends INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (Station_ID, Trip_Date, Trip_Hour)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS Station_Hour_Totals (
+        Station_ID INTEGER NOT NULL,
+        Trip_Hour INTEGER NOT NULL,
+        Starts INTEGER NOT NULL DEFAULT 0,
+        Ends INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (Station_ID, Trip_Hour)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS Bike_Usage (
+        Bike_ID INTEGER PRIMARY KEY,
+        Trips INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS Rollup_State (
+        Name TEXT PRIMARY KEY,
+        Last_Trip_ID INTEGER NOT NULL DEFAULT 0,
+        Complete INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+]
+
+# Each statement adds {count} (COUNT(*), or -COUNT(*) to remove them) of the
+# closed trips matching {where} to one rollup table
+APPLY = [
+    """
+    INSERT INTO Station_Trip_Stats (Station_ID, Trips_Started, Trips_Ended)
+    SELECT Start_Station_ID, {count}, 0 FROM Trip
+    WHERE {where} AND Start_Station_ID IS NOT NULL GROUP BY Start_Station_ID
+    ON CONFLICT(Station_ID) DO UPDATE SET Trips_Started = Trips_Started + excluded.Trips_Started
+    """,
+    """
+    INSERT INTO Station_Trip_Stats (Station_ID, Trips_Started, Trips_Ended)
+    SELECT End_Station_ID, 0, {count} FROM Trip
+    WHERE {where} AND End_Station_ID IS NOT NULL GROUP BY End_Station_ID
+    ON CONFLICT(Station_ID) DO UPDATE SET Trips_Ended = Trips_Ended + excluded.Trips_Ended
+    """,
+    """
+    INSERT INTO Station_Hourly_Trips (Station_ID, Trip_Date, Trip_Hour, Starts, Ends)
+    SELECT Start_Station_ID, date(Start_Time), CAST(strftime('%H', Start_Time) AS INTEGER), {count}, 0
+    FROM Trip
+    WHERE {where} AND Start_Station_ID IS NOT NULL AND Start_Time IS NOT NULL
+    GROUP BY 1, 2, 3
+    ON CONFLICT(Station_ID, Trip_Date, Trip_Hour) DO UPDATE SET Starts = Starts + excluded.Starts
+    """,
+    """
+    INSERT INTO Station_Hourly_Trips (Station_ID, Trip_Date, Trip_Hour, Starts, Ends)
+    SELECT End_Station_ID, date(End_Time), CAST(strftime('%H', End_Time) AS INTEGER), 0, {count}
+    FROM Trip
+    WHERE {where} AND End_Station_ID IS NOT NULL
+    GROUP BY 1, 2, 3
+    ON CONFLICT(Station_ID, Trip_Date, Trip_Hour) DO UPDATE SET Ends = Ends + excluded.Ends
+    """,
+    """
+    INSERT INTO Station_Hour_Totals (Station_ID, Trip_Hour, Starts, Ends)
+    SELECT Start_Station_ID, CAST(strftime('%H', Start_Time) AS INTEGER), {count}, 0
+    FROM Trip
+    WHERE {where} AND Start_Station_ID IS NOT NULL AND Start_Time IS NOT NULL
+    GROUP BY 1, 2
+    ON CONFLICT(Station_ID, Trip_Hour) DO UPDATE SET Starts = Starts + excluded.Starts
+    """,
+    """
+    INSERT INTO Station_Hour_Totals (Station_ID, Trip_Hour, Starts, Ends)
+    SELECT End_Station_ID, CAST(strftime('%H', End_Time) AS INTEGER), 0, {count}
+    FROM Trip
+    WHERE {where} AND End_Station_ID IS NOT NULL
+    GROUP BY 1, 2
+    ON CONFLICT(Station_ID, Trip_Hour) DO UPDATE SET Ends = Ends + excluded.Ends
+    """,
+    """
+    INSERT INTO Bike_Usage (Bike_ID, Trips)
+    SELECT Bike_ID, {count} FROM Trip
+    WHERE {where} AND Bike_ID IS NOT NULL GROUP BY Bike_ID
+    ON CONFLICT(Bike_ID) DO UPDATE SET Trips = Trips + excluded.Trips
+    """,
+]
+
+# Added later (migration 8): filled from the dated rollup, which counts the same trips
+HOUR_TOTALS_FILL = [
+    TABLES[2],  # Station_Hour_Totals
+    "DELETE FROM Station_Hour_Totals",
+    """
+    INSERT INTO Station_Hour_Totals (Station_ID, Trip_Hour, Starts, Ends)
+    SELECT Station_ID, Trip_Hour, SUM(Starts), SUM(Ends) FROM Station_Hourly_Trips
+    GROUP BY Station_ID, Trip_Hour
+    """,
+]
+
+CLOSED = "End_Time IS NOT NULL"
+ADD = "COUNT(*)"
+REMOVE = "-COUNT(*)"
+
+# Used by the migration: fill everything in one go and mark the state complete
+INITIAL_FILL = [
+    *(statement.format(where=CLOSED, count=ADD) for statement in APPLY),
+    """
+    INSERT OR REPLACE INTO Rollup_State (Name, Last_Trip_ID, Complete)
+    SELECT 'trips', COALESCE(MAX(Trip_ID), 0), 1 FROM Trip
+    """,
+]
+
+
+def _apply_range(conn, after_id, upto_id):
+    """Add closed trips with after_id < Trip_ID <= upto_id to all rollups"""
+    where = f"{CLOSED} AND Trip_ID > ? AND Trip_ID <= ?"
+    for statement in APPLY:
+        conn.execute(statement.format(where=where, count=ADD), (after_id, upto_id))
+
+
+def _apply_trips(conn, trip_ids, count):
+    """Add or remove the counted closed trips among ``trip_ids`` (inside the caller's transaction)"""
+    state = conn.execute(
+        "SELECT Last_Trip_ID, Complete FROM Rollup_State WHERE Name = 'trips'"
+    ).fetchone()
+    if state is None:
+        return
+    last_trip_id, complete = state
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS Rollup_Trips (Trip_ID INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM temp.Rollup_Trips")
+    # Trips a running backfill hasn't reached yet are left to it, as in record_closed_trip
+    conn.executemany("INSERT OR IGNORE INTO temp.Rollup_Trips (Trip_ID) VALUES (?)",
+                     [(trip_id,) for trip_id in trip_ids if complete or trip_id <= last_trip_id])
+    where = f"{CLOSED} AND Trip_ID IN (SELECT Trip_ID FROM temp.Rollup_Trips)"
+    for statement in APPLY:
+        conn.execute(statement.format(where=where, count=count))
+
+
+def remove_trips(conn, trip_ids):
+    """Take trips about to be rewritten out of the rollups (inside the caller's transaction)"""
+    _apply_trips(conn, trip_ids, REMOVE)
+
+
+def add_trips(conn, trip_ids):
+    """Count rewritten trips again, as they are now (inside the caller's transaction)"""
+    _apply_trips(conn, trip_ids, ADD)
+
+
+def record_closed_trip(conn, trip_id):
+    """Add one just-closed trip to the rollups (inside the caller's transaction)"""
+    state = conn.execute(
+        "SELECT Last_Trip_ID, Complete FROM Rollup_State WHERE Name = 'trips'"
+    ).fetchone()
+    if state is None:
+        return False
+    last_trip_id, complete = state
+    # A running backfill will pick up trips it hasn't reached yet
+    if not complete and trip_id > last_trip_id:
+        return False
+    _apply_range(conn, trip_id - 1, trip_id)
+    return True
+
+
+def backfill(conn, batch_size=50000, restart=True):
+    """Rebuild the rollups from Trip in batches; returns the number of batches.
+
+    With ``restart=False`` an interrupted backfill continues where it stopped.
+    """
+    if restart:
+        conn.execute("BEGIN IMMEDIATE")
+        for table in ("Station_Trip_Stats", "Station_Hourly_Trips", "Station_Hour_Totals", "Bike_Usage"):
+            conn.execute(f"DELETE FROM {table}")
+        conn.execute("INSERT OR REPLACE INTO Rollup_State (Name, Last_Trip_ID, Complete) VALUES ('trips', 0, 0)")
+        conn.commit()
+
+    batches = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            last_trip_id, complete = conn.execute(
+                "SELECT Last_Trip_ID, Complete FROM Rollup_State WHERE Name = 'trips'"
+            ).fetchone()
+            if complete:
+                conn.commit()
+                return batches
+            # Upper Trip_ID of the next batch, or the last trip if fewer remain
+            upto = conn.execute(
+                "SELECT Trip_ID FROM Trip WHERE Trip_ID > ? ORDER BY Trip_ID LIMIT 1 OFFSET ?",
+                (last_trip_id, batch_size - 1)
+            ).fetchone()
+            done = upto is None
+            if done:
+                upto = conn.execute("SELECT MAX(Trip_ID) FROM Trip").fetchone()
+            upto_id = max(upto[0] or 0, last_trip_id)
+            _apply_range(conn, last_trip_id, upto_id)
+            conn.execute(
+                "UPDATE Rollup_State SET Last_Trip_ID = ?, Complete = ? WHERE Name = 'trips'",
+                (upto_id, int(done))
+            )
+            conn.commit()
+            batches += 1
+        except Exception:
+            conn.rollback()
+            raise
+
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "bysykkel.db"
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    conn = sqlite3.connect(db_path)
+    try:
+        print(f"Rebuilt trip rollups in {backfill(conn, batch_size)} batches")
+    finally:
+        conn.close()
@@ -0,0 +1,177 @@
+"""Name search for users, stations and bikes.
+
+``LIKE '%term%'`` can't use an index, so every filter used to scan the
+whole table. Migration 6 adds an FTS5 table with the ``trigram`` tokenizer
+next to each of User, Station and Bike, kept in sync by triggers:
+
+    User_Search      User.User_Name
+    Station_Search   Station.Station_Name
+    Bike_Search      Bike.Bike_Name
+
+A trigram index answers "name contains term" for any term of three or
+more characters, case-insensitively and including Æ/Ø/Å. Shorter terms
+fall back to a scan with ``casefold()``, a SQL function registered on
+every pooled connection (LIKE only folds ASCII, so "ø" missed "Ø").
+``search`` ranks the hits (prefix matches first, then the closest in
+length) and, when nothing contains the term, falls back to fuzzy matching
+on shared trigrams so small typos still find something.
+
+    python -m model.search bysykkel.db User|Station|Bike term
+"""
+import sqlite3
+import sys
+
+# entity table -> (search table, id column, name column)
+ENTITIES = {
+    "User": ("User_Search", "User_ID", "User_Name"),
+    "Station": ("Station_Search", "Station_ID", "Station_Name"),
+    "Bike": ("Bike_Search", "Bike_ID", "Bike_Name"),
+}
+
+# Fuzzy hits must share at least this fraction of the term's trigrams
+FUZZY_THRESHOLD = 0.5
+
+
+def _statements():
+    tables, triggers, rebuild = [], [], []
+    for table, (fts, id_col, name_col) in ENTITIES.items():
+        tables.append(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+            f"{name_col}, content='{table}', content_rowid='{id_col}', tokenize='trigram')"
+        )
+        triggers += [
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts.lower()}_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO {fts}(rowid, {name_col}) VALUES (NEW.{id_col}, NEW.{name_col});
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts.lower()}_delete AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO {fts}({fts}, rowid, {name_col}) VALUES ('delete', OLD.{id_col}, OLD.{name_col});
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts.lower()}_update AFTER UPDATE OF {id_col}, {name_col} ON {table}
+            BEGIN
+                INSERT INTO {fts}({fts}, rowid, {name_col}) VALUES ('delete', OLD.{id_col}, OLD.{name_col});
+                INSERT INTO {fts}(rowid, {name_col}) VALUES (NEW.{id_col}, NEW.{name_col});
+            END
+            """,
+        ]
+        rebuild.append(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+    return tables, triggers, rebuild
+
+
+TABLES, TRIGGERS, REBUILD = _statements()
+
+
+def trigrams(text):
+    """The set of case-folded three-character substrings of ``text``"""
+    text = text.casefold()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def casefold(text):
+    """SQL casefold(): Unicode case folding, where LIKE and lower() only fold ASCII"""
+    return None if text is None else str(text).casefold()
+
+
+def register_functions(conn):
+    """Add the SQL functions the name filters use to a connection"""
+    conn.create_function("casefold", 1, casefold, deterministic=True)
+
+
+def _quote(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def match_query(term):
+    """FTS5 query for names containing ``term``, or None if it is too short"""
+    term = term.strip()
+    if len(term) < 3:
+        return None
+    return _quote(term)
+
+
+def filter_clause(entity, term, id_expr=None, name_expr=None):
+    """SQL condition (and params) keeping rows whose name contains ``term``.
+
+    ``id_expr``/``name_expr`` are the id and name columns as written in the
+    caller's query (e.g. ``"b.Bike_ID"``). SQLite looks the matching rows up
+    by primary key, provided the tables have been ANALYZEd since they grew.
+    """
+    fts, id_col, name_col = ENTITIES[entity]
+    query = match_query(term)
+    if query is None:
+        return f"instr(casefold({name_expr or name_col}), ?) > 0", [term.strip().casefold()]
+    return f"{id_expr or id_col} IN (SELECT rowid FROM {fts} WHERE {fts} MATCH ?)", [query]
+
+
+def rank(names, term):
+    """Order positions of ``names``: prefix matches, then closest length, then name"""
+    folded = term.strip().casefold()
+    return sorted(
+        range(len(names)),
+        key=lambda i: (not names[i].casefold().startswith(folded), len(names[i]), names[i].casefold()),
+    )
+
+
+def _candidates(conn, entity, term, limit):
+    """Up to ``limit`` (id, name) rows whose name contains ``term``"""
+    fts, id_col, name_col = ENTITIES[entity]
+    query = match_query(term)
+    if query is None:
+        return conn.execute(
+            f"SELECT {id_col}, {name_col} FROM {entity} WHERE instr(casefold({name_col}), ?) > 0 LIMIT ?",
+            (term.casefold(), limit)
+        ).fetchall()
+    # No ORDER BY rank: scoring every hit of a common term costs more than
+    # re-ranking a bounded sample here
+    return conn.execute(
+        f"SELECT rowid, {name_col} FROM {fts} WHERE {fts} MATCH ? LIMIT ?",
+        (query, limit)
+    ).fetchall()
+
+
+def search(conn, entity, term, limit=20, fuzzy=True):
+    """Return up to ``limit`` (id, name) pairs for ``term``, best match first"""
+    term = term.strip()
+    if not term:
+        return []
+    candidates = max(limit * 10, 100)
+
+    rows = _candidates(conn, entity, term, candidates)
+    if rows:
+        order = rank([row[1] for row in rows], term)
+        return [rows[i] for i in order[:limit]]
+    if not fuzzy or len(term) < 6:
+        return []
+
+    # A typo usually leaves one half of the term intact: collect names that
+    # contain either half and keep those sharing enough trigrams with the term
+    middle = len(term) // 2
+    rows = {}
+    for part in (term[:middle], term[middle:]):
+        rows.update(_candidates(conn, entity, part, candidates))
+    wanted = trigrams(term)
+    scored = []
+    for row_id, name in rows.items():
+        share = len(wanted & trigrams(name)) / len(wanted)
+        if share >= FUZZY_THRESHOLD:
+            scored.append((-share, len(name), name.casefold(), row_id, name))
+    scored.sort()
+    return [(row_id, name) for *_, row_id, name in scored[:limit]]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        sys.exit("usage: python -m model.search bysykkel.db User|Station|Bike term")
+    conn = sqlite3.connect(sys.argv[1])
+    register_functions(conn)
+    try:
+        for row_id, name in search(conn, sys.argv[2], " ".join(sys.argv[3:])):
+            print(row_id, name)
+    finally:
+        conn.close()
@@ -0,0 +1,52 @@
+"""Logging and tracing switch for the model layer.
+
+Diagnostics go through the standard ``logging`` module under the
+``bysykkel.model`` logger. Extra diagnostic *queries* (re-reading rows
+before/after a write etc.) are only run when tracing is on and the call is
+sampled; with tracing off the check is a single attribute test.
+
+Configure with environment variables or by passing a Tracer to the model:
+
+    BYSYKKEL_TRACE=1            turn tracing on
+    BYSYKKEL_TRACE_SAMPLE=0.1   trace roughly 10% of calls
+    BYSYKKEL_LOG_LEVEL=DEBUG    level of the bysykkel.model logger
+"""
+import logging
+import os
+import random
+
+logger = logging.getLogger("bysykkel.model")
+
+
+def _env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+class Tracer:
+    """Decides when diagnostic queries and trace output should run"""
+
+    def __init__(self, enabled=None, sample_rate=None, level=None):
+        if enabled is None:
+            enabled = _env_flag("BYSYKKEL_TRACE")
+        if sample_rate is None:
+            sample_rate = float(os.environ.get("BYSYKKEL_TRACE_SAMPLE", 1.0))
+        if level is None:
+            level = os.environ.get("BYSYKKEL_LOG_LEVEL")
+        if level is not None:
+            logger.setLevel(level)
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+
+    def sampled(self):
+        """True if this call should run its diagnostics"""
+        if not self.enabled:
+            return False
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def trace(self, msg, *args):
+        """Log a trace message (formatted lazily, only when tracing is on)"""
+        if self.enabled:
+            logger.debug(msg, *args)
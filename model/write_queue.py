@@ -0,0 +1,159 @@
+"""Background writer for bike complaint reports.
+
+Reports used to be written inside the Streamlit request: one INSERT per
+issue plus a Bike update, holding the write lock while the user waited.
+``ComplaintWriter`` takes reports off a queue on its own thread and writes
+them in groups, one short transaction per group:
+
+* all complaint rows of the group go in with one ``executemany``;
+* a bike reported several times is marked 'Missing' once.
+
+Durability: ``submit`` returns a ``Future`` that completes once the
+report's transaction has committed (or fails with the error). Callers
+that must not lose a report can wait on it; ``flush()`` waits for
+everything queued so far; ``close()`` (also run at interpreter exit)
+drains the queue before the thread stops. Reports still queued when the
+process is killed are lost, at most ``max_delay`` seconds worth.
+"""
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from model.tracing import logger
+
+_STOP = object()
+
+
+class ComplaintReport:
+    __slots__ = ("bike_id", "issues", "notes", "future")
+
+    def __init__(self, bike_id, issues, notes):
+        # Plain ints: numpy integers would be stored as blobs
+        self.bike_id = int(bike_id)
+        self.issues = list(issues)
+        self.notes = notes or ""
+        self.future = Future()
+
+
+def write_reports(conn, reports):
+    """Write a group of reports in the caller's transaction"""
+    conn.executemany(
+        "INSERT INTO Complaint (Bike_ID, Complaint_Type, Additional_Notes) VALUES (?, ?, ?)",
+        [(report.bike_id, issue, report.notes) for report in reports for issue in report.issues]
+    )
+    # Coalesce: each reported bike is updated once per group
+    bikes = sorted({report.bike_id for report in reports if report.issues})
+    conn.executemany(
+        "UPDATE Bike SET Current_Status = 'Missing' WHERE Bike_ID = ?",
+        [(bike_id,) for bike_id in bikes]
+    )
+
+
+class ComplaintWriter:
+    """Queue of complaint reports written in batches by a background thread"""
+
+    def __init__(self, model, batch_size=200, max_delay=0.25):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self.batches = 0
+        self.reports = 0
+
+    def _put(self, item):
+        """Queue an item, starting the thread on first use; False once closed"""
+        with self._lock:
+            if self._closed:
+                return False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="complaint-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+            self._queue.put(item)
+            return True
+
+    def submit(self, bike_id, issues, notes=None):
+        """Queue a report and return a Future that completes when it is committed"""
+        report = ComplaintReport(bike_id, issues, notes)
+        if not self._put(report):
+            raise RuntimeError("complaint writer is closed")
+        return report.future
+
+    def flush(self, timeout=None):
+        """Wait until every report queued so far is written; True if it finished in time"""
+        marker = Future()
+        if not self._put(marker):
+            return True  # close() already drained the queue
+        try:
+            marker.result(timeout)
+            return True
+        except FutureTimeout:
+            return False
+
+    def close(self, timeout=10.0):
+        """Write what is still queued and stop the thread"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(_STOP)
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self):
+        """Return reports/batches written and the current queue length"""
+        return {"reports": self.reports, "batches": self.batches, "queued": self._queue.qsize()}
+
+    def _take_batch(self):
+        """Block for the first item, then gather more for up to max_delay"""
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(items) < self.batch_size and items[-1] is not _STOP:
+            remaining = deadline - time.monotonic()
+            try:
+                items.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._take_batch()
+            reports = [item for item in items if isinstance(item, ComplaintReport)]
+            if reports:
+                with self.model.metrics.operation("ComplaintWriter.write"):
+                    self._write(reports)
+            # Flush markers complete only after everything queued before them
+            for item in items:
+                if isinstance(item, Future):
+                    item.set_result(None)
+            if items[-1] is _STOP:
+                return
+
+    def _write(self, reports):
+        try:
+            self.model.run_write(lambda conn: write_reports(conn, reports))
+        except Exception as e:
+            if len(reports) > 1:
+                # Don't let one bad report fail the others
+                logger.warning("Complaint batch of %d failed, writing reports one by one", len(reports))
+                for report in reports:
+                    self._write([report])
+                return
+            logger.exception("Error writing complaint for bike %s", reports[0].bike_id)
+            reports[0].future.set_exception(e)
+            return
+        finally:
+            self.model.cache.invalidate(("Complaint", "Bike"))
+        self.batches += 1
+        self.reports += len(reports)
+        self.model.tracer.trace("Wrote %d complaint reports in one batch", len(reports))
+        for report in reports:
+            report.future.set_result(len(report.issues))
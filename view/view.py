@@ -2,15 +2,79 @@ import streamlit as st
 import pandas as pd
 
 class BysykkelView:
+    # Sort-key columns of the paginated tables, used as the keyset cursor
+    PAGE_KEYS = {
+        "users": ["User_Name", "User_ID"],
+        "bikes": ["Bike_Name", "Bike_ID"],
+        "bikes_at_stations": ["Station_Name", "Bike_Name", "Bike_ID"],
+    }
+
+    def page_cursor(self, name):
+        """Return the keyset cursor of the page currently shown for a table"""
+        starts = st.session_state.get(f"{name}_page_starts", [None])
+        return starts[-1]
+
+    def reset_pages(self, *names):
+        """Go back to the first page of the given tables"""
+        for name in names:
+            st.session_state[f"{name}_page_starts"] = [None]
+
+    def _next_page(self, name, cursor):
+        st.session_state.setdefault(f"{name}_page_starts", [None]).append(cursor)
+
+    def _previous_page(self, name):
+        starts = st.session_state.setdefault(f"{name}_page_starts", [None])
+        if len(starts) > 1:
+            starts.pop()
+
+    def show_pager(self, name, page_df, total, page_size):
+        """Show Previous/Next controls under a paginated table"""
+        if total is None:
+            return
+        starts = st.session_state.get(f"{name}_page_starts", [None])
+        page = len(starts)
+        pages = max((total + page_size - 1) // page_size, 1)
+
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            st.button("Previous", key=f"{name}_prev", disabled=page <= 1,
+                      on_click=self._previous_page, args=(name,))
+        with col2:
+            st.caption(f"Page {page} of {pages} ({total} rows)")
+        with col3:
+            cursor = None
+            if not page_df.empty:
+                # Plain Python values so the cursor can be bound as SQL parameters
+                cursor = tuple(v.item() if hasattr(v, "item") else v
+                               for v in page_df.iloc[-1][self.PAGE_KEYS[name]])
+            st.button("Next", key=f"{name}_next", disabled=page >= pages or cursor is None,
+                      on_click=self._next_page, args=(name, cursor))
+
+    def show_suggestions(self, names):
+        """Show close matches when a filter found nothing"""
+        if names:
+            st.caption("No exact matches. Did you mean: " + ", ".join(names) + "?")
+
+    @staticmethod
+    def label_map(labels, name, df, id_column, name_column):
+        """Id -> name dict for a selectbox; built from ``df`` if the controller gave none"""
+        if labels and name in labels:
+            return labels[name]
+        return dict(zip(df[id_column], df[name_column]))
+
     def show_title(self):
         """Display the main title of the app"""
         st.title("Bysykkel Dashboard")
     
-    def show_tabs(self):
-        """Create and return tabs for different sections of the app"""
-        return st.tabs(["Dashboard", "Add User", "Analysis", "CHECKOUT", "DROPOFF", "Mapping"])
+    def show_tabs(self, diagnostics=False):
+        """Create and return tabs for different sections of the app (plus Diagnostics if asked)"""
+        names = ["Dashboard", "Add User", "Analysis", "CHECKOUT", "DROPOFF", "Mapping", "Forecast", "Rebalancing"]
+        if diagnostics:
+            names.append("Diagnostics")
+        return st.tabs(names)
     
-    def show_dashboard(self, tab, users_df, bikes_df, subscriptions_df):
+    def show_dashboard(self, tab, users_df, bikes_df, subscriptions_df,
+                       users_total=None, bikes_total=None, page_size=50, suggestions=None):
         """Display the dashboard with all tables"""
         with tab:
             # (a) Users - with filter
@@ -26,20 +90,29 @@ class BysykkelView:
             
             # The users dataframe will be updated in the controller based on the filter
             st.dataframe(users_df)
+            self.show_suggestions((suggestions or {}).get("users"))
+            self.show_pager("users", users_df, users_total, page_size)
             
             # (b) Bikes and status
             st.header("Bikes and status")
             st.dataframe(bikes_df)
+            self.show_pager("bikes", bikes_df, bikes_total, page_size)
             
             # (c) Subscription types count
             st.header("Number of subscriptions per type")
             st.dataframe(subscriptions_df)
     
-    def show_analysis(self, tab, station_trips_df, bikes_at_stations_df):
+    def show_analysis(self, tab, station_trips_df, bikes_at_stations_df, hourly_trips_df=None,
+                      bikes_at_stations_total=None, page_size=50, suggestions=None):
         with tab:
             # (a) Station trips count
             st.header("Number of trips ending at each station")
             st.dataframe(station_trips_df.copy())  # Use copy to ensure we have a clean dataframe
+
+            # Trips per hour of day, read from the pre-aggregated rollups
+            if hourly_trips_df is not None and not hourly_trips_df.empty:
+                st.header("Trips per hour of day")
+                st.bar_chart(hourly_trips_df.set_index("Hour"))
     
             # (b) Bikes at stations with filters
             st.header("Bikes available at stations")
@@ -54,15 +127,52 @@ class BysykkelView:
                 st.write(" ")
                 filter_button = st.button("Filter", key="filter_stations_button")
     
-            # Make sure we have the expected columns and convert to simple format
+            # Only the current page is sent to the browser
             try:
-                # Reset index to avoid any index-related issues
-                df_to_show = bikes_at_stations_df.reset_index(drop=True).copy()
-                st.dataframe(df_to_show)
+                st.dataframe(bikes_at_stations_df, hide_index=True)
+                self.show_suggestions((suggestions or {}).get("bikes_at_stations"))
+                self.show_pager("bikes_at_stations", bikes_at_stations_df, bikes_at_stations_total, page_size)
             except Exception as e:
                 st.error(f"Error displaying dataframe: {str(e)}")
                 st.write("DataFrame info:", bikes_at_stations_df.info())
 
+    @staticmethod
+    def trip_report_window():
+        """Return (start, end, station_id) picked for the trip history report; end is exclusive"""
+        picked = st.session_state.get("report_range") or ()
+        start = pd.Timestamp(picked[0]) if len(picked) else None
+        # The range picker includes its last day
+        end = pd.Timestamp(picked[-1]) + pd.Timedelta(days=1) if len(picked) else None
+        return start, end, st.session_state.get("report_station")
+
+    def show_trip_reports(self, tab, reports, stations_df, labels=None):
+        """Display the trip history report last run (input keys: report_range, report_station, run_trip_report)"""
+        with tab:
+            st.header("Trip history")
+            today = pd.Timestamp.today().date()
+            station_names = self.label_map(labels, "stations", stations_df, "Station_ID", "Station_Name")
+            col1, col2, col3 = st.columns([2, 2, 1])
+            col1.date_input("Trips started between:", value=(today - pd.Timedelta(days=30), today), key="report_range")
+            col2.selectbox("Station (hours of day):", options=[None] + list(station_names),
+                           format_func=lambda x: "All stations" if x is None else station_names.get(x, x),
+                           key="report_station")
+            with col3:
+                st.write(" ")
+                st.write(" ")
+                st.button("Run report", key="run_trip_report")
+            if reports is None:
+                st.caption("Pick a period and click Run report.")
+                return
+
+            start = reports["start"].strftime("%Y-%m-%d") if reports["start"] is not None else "the start"
+            end = (reports["end"] - pd.Timedelta(days=1)).strftime("%Y-%m-%d") if reports["end"] is not None else "now"
+            source = "the trip archive" if reports["source"] == "archive" else "the database"
+            st.caption(f"Closed trips started from {start} through {end}, read from {source}")
+            st.subheader("Trips per station")
+            st.dataframe(reports["stations"], hide_index=True)
+            st.subheader("Trips per hour of day")
+            st.bar_chart(reports["hourly"].set_index("Hour"))
+
     def show_user_form(self, tab):
         """Display user registration form and return input values"""
         with tab:
@@ -130,7 +240,8 @@ class BysykkelView:
                 if all(validation_results.values()):
                     st.success("User successfully registered!")
     
-    def show_checkout_tab(self, tab, users_df, stations_df, available_bikes_df=None):
+    def show_checkout_tab(self, tab, users_df, stations_df, available_bikes_df=None, labels=None,
+                          nearby_stations_df=None):
         """Display the checkout interface"""
         with tab:
             st.header("Bike Checkout")
@@ -138,10 +249,12 @@ class BysykkelView:
             # Select user
             st.subheader("Select User")
             if not users_df.empty:
+                user_names = self.label_map(labels, "users", users_df, 'User_ID', 'User_Name')
                 selected_user = st.selectbox(
                     "Select a user:",
                     options=users_df['User_ID'].tolist(),
-                    format_func=lambda x: f"{users_df[users_df['User_ID'] == x]['User_Name'].values[0]}"
+                    format_func=lambda x: f"{user_names[x]}",
+                    key="checkout_user"
                 )
             else:
                 st.warning("No users available")
@@ -149,11 +262,20 @@ class BysykkelView:
                 
             # Select station
             st.subheader("Select Station")
+            if nearby_stations_df is not None and not nearby_stations_df.empty:
+                nearby = ", ".join(
+                    f"{name} ({distance:.1f} km, {bikes} bikes)"
+                    for name, distance, bikes in zip(nearby_stations_df['Station_Name'],
+                                                     nearby_stations_df['Distance_km'],
+                                                     nearby_stations_df['Parked_Bikes'])
+                )
+                st.caption(f"Closest stations with bikes: {nearby}")
             if not stations_df.empty:
+                station_names = self.label_map(labels, "stations", stations_df, 'Station_ID', 'Station_Name')
                 selected_station_id = st.selectbox(
                     "Select a station:",
                     options=stations_df['Station_ID'].tolist(),
-                    format_func=lambda x: f"{stations_df[stations_df['Station_ID'] == x]['Station_Name'].values[0]}"
+                    format_func=lambda x: f"{station_names[x]}"
                 )
                 
                 # Get bikes at selected station
@@ -162,10 +284,11 @@ class BysykkelView:
                     
                     if not station_bikes.empty:
                         st.subheader("Available Bikes")
+                        bike_names = self.label_map(labels, "bikes", station_bikes, 'Bike_ID', 'Bike_Name')
                         selected_bike = st.selectbox(
                             "Select a bike:",
                             options=station_bikes['Bike_ID'].tolist(),
-                            format_func=lambda x: f"{station_bikes[station_bikes['Bike_ID'] == x]['Bike_Name'].values[0]} ({x})"
+                            format_func=lambda x: f"{bike_names[x]} ({x})"
                         )
                         
                         checkout_button = st.button("Checkout Bike")
@@ -200,7 +323,7 @@ class BysykkelView:
                     "bike_id": None
                 }
     
-    def show_dropoff_tab(self, tab, users_with_active_trips, stations_df):
+    def show_dropoff_tab(self, tab, users_with_active_trips, stations_df, labels=None):
         """Display the simplified dropoff interface with integrated issue reporting"""
         with tab:
             st.header("Bike Dropoff")
@@ -227,10 +350,11 @@ class BysykkelView:
                 user_options = users_with_active_trips['User_ID'].unique().tolist()
                 
                 if user_options:
+                    user_names = self.label_map(labels, "users", users_with_active_trips, 'User_ID', 'User_Name')
                     selected_user = st.selectbox(
                         "Select a user:",
                         options=user_options,
-                        format_func=lambda x: f"{users_with_active_trips[users_with_active_trips['User_ID'] == x]['User_Name'].values[0]} ({x})",
+                        format_func=lambda x: f"{user_names[x]} ({x})",
                         key="dropoff_user"
                     )
                     
@@ -257,10 +381,11 @@ class BysykkelView:
                         # Select dropoff station
                         st.subheader("Select Dropoff Station")
                         if not stations_df.empty:
+                            station_names = self.label_map(labels, "stations", stations_df, 'Station_ID', 'Station_Name')
                             selected_station = st.selectbox(
                                 "Select a station:",
                                 options=stations_df['Station_ID'].tolist(),
-                                format_func=lambda x: f"{stations_df[stations_df['Station_ID'] == x]['Station_Name'].values[0]} ({x})",
+                                format_func=lambda x: f"{station_names[x]} ({x})",
                                 key="dropoff_station"
                             )
                         
@@ -431,10 +556,11 @@ class BysykkelView:
                 # Station selector
                 if not stations_df.empty:
                     station_options = stations_df.index.tolist()
+                    station_names = stations_df['Station_Name'].to_dict()
                     selected_station = st.selectbox(
                         "Select a station:",
                         options=station_options,
-                        format_func=lambda x: stations_df.loc[x, 'Station_Name'],
+                        format_func=lambda x: station_names[x],
                         key="mapping_station_selector"
                     )
                 else:
@@ -450,11 +576,134 @@ class BysykkelView:
         
             # Display the table with availability info
             if selected_station is not None:
-                # Filter the data for the selected station in the controller
-                st.subheader(f"Availability for {stations_df.loc[selected_station, 'Station_Name']}")
+                # Both percentages are precomputed; the toggle only picks one
+                column = 'Free_Docks_Percent' if in_progress else 'Bikes_Percent'
+                row = stations_df.loc[[selected_station]]
+                table = pd.DataFrame({
+                    'Station_Name': row['Station_Name'],
+                    'Availability': row[column].astype(str) + '%',
+                    'Location': row['Location'],
+                })
+                st.subheader(f"Availability for {station_names[selected_station]}")
                 # Use st.markdown to render HTML links
                 st.markdown(
-                    stations_df.loc[[selected_station]].to_html(escape=False),
+                    table.to_html(escape=False),
                     unsafe_allow_html=True
                 )
 
+    def show_forecast_tab(self, tab, forecast):
+        """Display the forecast last run (input keys: forecast_hours, run_forecast)"""
+        with tab:
+            st.header("Demand Forecast")
+            st.slider("Hours ahead:", min_value=6, max_value=72, value=24, step=6, key="forecast_hours")
+            st.button("Forecast", key="run_forecast")
+            if forecast is None:
+                st.caption("Pick how far ahead to look and click Forecast.")
+                return
+            if forecast["trained_through"] is None:
+                st.info("No trip history to forecast from yet.")
+                return
+            start = pd.Timestamp(forecast["start"]).strftime("%Y-%m-%d %H:00")
+            st.caption(f"From {start}, based on trips through {forecast['trained_through']}")
+
+            summary = forecast["summary"]
+            col1, col2 = st.columns(2)
+            col1.metric("Stations running out of bikes", int(summary["Hours_Until_Empty"].notna().sum()))
+            col2.metric("Stations running out of docks", int(summary["Hours_Until_Full"].notna().sum()))
+
+            # Most urgent stations first
+            st.subheader("Stations")
+            st.dataframe(summary, hide_index=True)
+
+            # Hour by hour for one station
+            station_names = dict(zip(summary["Station_ID"], summary["Station_Name"]))
+            selected = st.selectbox("Station:", options=list(station_names),
+                                    format_func=lambda x: station_names[x], key="forecast_station")
+            hourly = forecast["hourly"]
+            station = hourly[hourly["Station_ID"] == selected].set_index("Time")
+            st.subheader(f"Expected trips at {station_names[selected]}")
+            st.line_chart(station[["Departures", "Arrivals"]])
+            st.subheader("Projected bikes")
+            st.line_chart(station[["Projected_Bikes"]])
+
+    def show_rebalancing_tab(self, tab, plan):
+        """Display the plan last made (input keys: rebalance_trucks, rebalance_capacity, rebalance_forecast, plan_routes)"""
+        with tab:
+            st.header("Rebalancing")
+            col1, col2, col3 = st.columns(3)
+            col1.number_input("Trucks:", min_value=1, max_value=50, value=3, key="rebalance_trucks")
+            col2.number_input("Bikes per truck:", min_value=1, max_value=100, value=20, key="rebalance_capacity")
+            col3.toggle("Allow for the next 6 hours' demand", value=False, key="rebalance_forecast")
+            st.button("Plan routes", key="plan_routes")
+            if plan is None:
+                st.caption("Set the trucks and click Plan routes.")
+                return
+
+            routes, stops, stations = plan["routes"], plan["stops"], plan["stations"]
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Bikes to move", int(routes["Bikes_Moved"].sum()))
+            col2.metric("Driving", f"{routes['Km'].sum():.1f} km")
+            col3.metric("Stations still off target", int((stations["Off_Target"].abs() >= 2).sum()))
+            st.caption(f"Planned in {plan['seconds']['total']:.2f}s")
+
+            st.subheader("Trucks")
+            st.dataframe(routes, hide_index=True)
+            if stops.empty:
+                st.info("Every station is close enough to its target.")
+                return
+
+            # One truck's route, stop by stop
+            truck = st.selectbox("Truck:", options=routes["Truck"].tolist(), key="rebalance_truck")
+            route = stops[stops["Truck"] == truck]
+            st.map(route, latitude="Latitude", longitude="Longitude")
+            table = route.drop(columns=["Truck", "Station_ID", "Bike_IDs", "Latitude", "Longitude"])
+            st.dataframe(table.assign(Bike_Names=table["Bike_Names"].str.join(", ")), hide_index=True)
+
+    def show_diagnostics_tab(self, tab, diagnostics):
+        """Display query timings, query plans and full scans; returns whether Reset was clicked"""
+        with tab:
+            st.header("Diagnostics")
+            if not diagnostics["enabled"]:
+                st.info("Instrumentation is off (set BYSYKKEL_METRICS=1).")
+                return {"reset": False}
+
+            col1, col2, col3, col4 = st.columns(4)
+            wait = diagnostics["connection_wait"]
+            cache = diagnostics["cache"]
+            statements = diagnostics["statements"]
+            col1.metric("Statements run", int(statements["calls"].sum()))
+            col2.metric("Time in SQL", f"{statements['total_ms'].sum():.0f} ms")
+            col3.metric("Connection wait p95", f"{wait['p95_ms']:.2f} ms")
+            col4.metric("Cache hit rate", f"{cache['hit_rate']:.0%}")
+            since = pd.Timestamp(diagnostics["since"], unit="s").strftime("%H:%M:%S")
+            st.caption(f"Since {since} UTC, {wait['leases']} connection leases")
+            reset = st.button("Reset", key="reset_diagnostics")
+
+            # Methods and statements, most total time first
+            st.subheader("Methods")
+            st.dataframe(diagnostics["methods"].round(2), hide_index=True)
+
+            st.subheader("Statements")
+            st.dataframe(statements.drop(columns=["plan"]).round(2), hide_index=True)
+
+            st.subheader("Full table scans")
+            full_scans = diagnostics["full_scans"]
+            if full_scans.empty:
+                st.caption("No statement scans a whole table.")
+            else:
+                st.dataframe(full_scans[["method", "statement", "full_scan", "calls", "total_ms", "sql"]].round(2),
+                             hide_index=True)
+
+            # Query plan of one statement
+            if not statements.empty:
+                ids = statements["statement"].drop_duplicates().tolist()
+                sql = dict(zip(statements["statement"], statements["sql"]))
+                plans = dict(zip(statements["statement"], statements["plan"]))
+                selected = st.selectbox("Query plan of:", options=ids,
+                                        format_func=lambda x: f"{x}  {sql[x][:80]}", key="diagnostics_statement")
+                st.code(sql[selected], language="sql")
+                st.code(plans[selected] or "(no plan)", language="text")
+
+            with st.expander("Prometheus metrics"):
+                st.code(diagnostics["prometheus"], language="text")
+        return {"reset": reset}